@@ -8,11 +8,15 @@ Copyright (c) 2011 douban.com. All rights reserved.
 Last Update by hurricane <lilinghui@douban.com>.
 """
 
-import cmemcached
+import os
 import sys
 import time
 import random
 import socket
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from operator import itemgetter
 from warnings import warn
 
 
@@ -21,17 +25,40 @@ def fnv1a(s):
     return get_hash(s) & 0xffffffff
 
 
+def _mix32(h):
+    """murmur3 finalizer, spreads the few bits fnv1a changes over all."""
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    return h ^ (h >> 16)
+
+
 from douban.utils import ThreadedObject
 from douban.utils.config import read_config
 from douban.utils.slog import log as slog
 
 MAX_KEYS_IN_GET_MULTI = 200
+# cmemcached return codes of requests the server answered:
+# MEMCACHED_SUCCESS, MEMCACHED_NOTSTORED and MEMCACHED_NOTFOUND
+ANSWERED = (0, 14, 16)
 ONE_DAY = 24 * 3600
 ONE_MINUTE = 60
 
 log = lambda message: slog('beansdb', message)
 
 
+def bucket_depth(buckets_count):
+    """Number of hex digits of the key hash which select a bucket."""
+    depth = 1
+    while 16 ** depth < buckets_count:
+        depth += 1
+    if 16 ** depth != buckets_count:
+        raise ValueError('buckets count must be a power of 16: %r'
+                         % buckets_count)
+    return depth
+
+
 class WriteFailedError(IOError):
 
     def __init__(self, key, servers='unknown'):
@@ -74,7 +101,59 @@ class DeleteFailedError(IOError):
         return repr(self)
 
 
+class OverloadedError(IOError):
+
+    def __init__(self, server):
+        IOError.__init__(self)
+        self.server = server
+
+    def __repr__(self):
+        return 'server %r overloaded' % (self.server,)
+
+    def __str__(self):
+        return repr(self)
+
+
+class Deadline(object):
+
+    """A time budget shared by all the attempts of one call."""
+
+    def __init__(self, timeout=None):
+        self.end = time.time() + timeout if timeout is not None else None
+
+    @classmethod
+    def of(cls, timeout, default=None):
+        """The Deadline for a `timeout` argument, in seconds if not a
+        Deadline already, falling back to the `default` timeout."""
+        if isinstance(timeout, Deadline):
+            return timeout
+        return cls(timeout if timeout is not None else default)
+
+    def remaining(self):
+        """Seconds left, None if unbounded."""
+        if self.end is not None:
+            return self.end - time.time()
+
+
+def bounded(servers, deadline, server=None):
+    """Yield the servers to try in turn until the deadline is spent.
+
+    Requests to a yielded server are limited to the remaining time.  With
+    `server`, the items yielded are anything it gets the server from.
+    """
+    for item in servers:
+        remaining = deadline.remaining()
+        if remaining is None:
+            yield item
+        elif remaining <= 0:
+            return
+        else:
+            with (server(item) if server else item).time_limit(remaining):
+                yield item
+
+
 def connect(server, **kwargs):
+    import cmemcached
     c = cmemcached.Client([server], do_split=0, **kwargs)
     c.set_behavior(cmemcached.BEHAVIOR_CONNECT_TIMEOUT, 300)  # 0.3 s
     c.set_behavior(cmemcached.BEHAVIOR_POLL_TIMEOUT, 3000)  # 3 s
@@ -84,14 +163,167 @@ def connect(server, **kwargs):
     return c
 
 
+_last = threading.local()
+
+
+def _rejected(store):
+    """Whether the last limited request of this thread to store was
+    rejected by its limit, so it did not reach the server."""
+    return getattr(_last, 'rejected', None) is store
+
+
+def _limited(overloaded=None, failed=None, size=None):
+    """Count the decorated MCStore requests against the store's limit.
+
+    Over the limit, the request raises OverloadedError, or returns
+    `overloaded(*args, **kwargs)` as a failed server would, telling
+    _rejected(store) so.  A request fails when it raises or
+    `failed(store, result)` is true, it is of `size(args)` keys.
+    """
+    def decorator(func):
+        @wraps(func)
+        def _(self, *args, **kwargs):
+            limit = self.limit
+            if limit is None:
+                return func(self, *args, **kwargs)
+            if not limit.acquire():
+                _last.rejected = self
+                if overloaded is None:
+                    raise OverloadedError(self.addr)
+                return overloaded(*args, **kwargs)
+            _last.rejected = None
+            t = time.time()
+            ok = False
+            try:
+                r = func(self, *args, **kwargs)
+                ok = failed is None or not failed(self, r)
+                return r
+            finally:
+                limit.release(time.time() - t, ok,
+                              size(args) if size is not None else 1)
+        return _
+    return decorator
+
+
+def _write_failed(store, r):
+    """A write returning False failed, unless the server answered it, as
+    to the delete of a missing key."""
+    if isinstance(r, tuple):
+        r = r[0]
+    if r:
+        return False
+    mc = getattr(store, 'mc', None)
+    return mc is None or mc.get_last_error() not in ANSWERED
+
+
+def _keys_count(args):
+    return len(args[0])
+
+
+def _profiled(op, values):
+    """Record the values of the decorated MCStore request in the store's
+    profiler, `values(args, result)` returning them as {key: value}."""
+    def decorator(func):
+        @wraps(func)
+        def _(self, *args, **kwargs):
+            r = func(self, *args, **kwargs)
+            if self.profiler is not None:
+                self.profiler.record_multi(op, values(args, r))
+            return r
+        return _
+    return decorator
+
+
+def _failed(*args, **kwargs):
+    return False
+
+
+def _multi_failed(keys, return_failure=False):
+    return (False, list(keys)) if return_failure else False
+
+
 class MCStore(object):
 
-    def __init__(self, addr, threaded=True, **kwargs):
+    connector = staticmethod(connect)
+    poll_timeout = 3000  # ms, as set by connector
+    serializer = None
+    threaded = True
+    limit = None
+    profiler = None
+    _mc = None
+    _mc_pid = None
+    _mc_factory = None
+
+    def __init__(self, addr, threaded=True, serializer=None, limit=None,
+                 profiler=None, **kwargs):
+        """Init.
+
+        The connection is made at the first request, or by warmup(), and
+        made again in a forked child process.
+
+        serializer:
+            a douban.beansdb.serializer.Serializer to encode the values of
+            set() and decode get() with, instead of cmemcached.
+        limit:
+            a callable returning the concurrency limit of this store, such
+            as douban.beansdb.limit.AIMDLimit.  Reads over the limit raise
+            OverloadedError, writes fail.
+        profiler:
+            a douban.beansdb.profiler.SizeProfiler recording the sizes of
+            the values read and written, shared by the stores of a client.
+
+        """
         self.addr = addr
+        self.serializer = serializer
+        if limit is not None:
+            self.limit = limit()
+        self.profiler = profiler
+        self.threaded = threaded
         if threaded:
-            self.mc = ThreadedObject(connect, addr, **kwargs)
+            self._mc_factory = lambda: ThreadedObject(
+                self.connector, addr, **kwargs)
         else:
-            self.mc = connect(addr, **kwargs)
+            self._mc_factory = lambda: self.connector(addr, **kwargs)
+
+    def _get_mc(self):
+        if self._mc is None or (self._mc_pid != os.getpid()
+                                and self._mc_factory is not None):
+            self._mc = self._mc_factory()
+            self._mc_pid = os.getpid()
+        return self._mc
+
+    def _set_mc(self, mc):
+        self._mc = mc
+        self._mc_pid = os.getpid()
+
+    mc = property(_get_mc, _set_mc)
+
+    @contextmanager
+    def time_limit(self, seconds):
+        """Wait no longer than seconds for each request made inside.
+
+        Only threaded stores, whose connections belong to a thread, are
+        limited: the deadline of a thread would apply to the requests of
+        the others on a shared connection.
+        """
+        ms = int(seconds * 1000) if seconds is not None else None
+        if ms is None or ms >= self.poll_timeout or not self.threaded:
+            yield
+            return
+        from cmemcached import BEHAVIOR_POLL_TIMEOUT
+        self.mc.set_behavior(BEHAVIOR_POLL_TIMEOUT, max(ms, 1))
+        try:
+            yield
+        finally:
+            self.mc.set_behavior(BEHAVIOR_POLL_TIMEOUT, self.poll_timeout)
+
+    def warmup(self):
+        """Connect now, return False if the server did not answer."""
+        try:
+            self.get_version('__warmup__')
+            return True
+        except IOError:
+            return False
 
     def __repr__(self):
         return '<MCStore(addr=%s)>' % repr(self.addr)
@@ -99,18 +331,38 @@ class MCStore(object):
     def __str__(self):
         return self.addr
 
+    @_limited(_failed, _write_failed)
+    @_profiled('set', lambda args, r: {args[0]: args[1]})
     def set(self, key, data, rev=0):
+        if self.serializer is not None:
+            data, flag = self.serializer.dumps(data)
+            return bool(self._set_raw(key, data, rev, flag))
         return bool(self.mc.set(key, data, rev))
 
-    def set_raw(self, key, data, rev=0, flag=0):
+    def _set_raw(self, key, data, rev=0, flag=0):
         if rev < 0:
-            raise str(rev)
+            # a deletion, see delete_at()
+            raise ValueError('negative revision %d of a set' % rev)
         return self.mc.set_raw(key, data, rev, flag)
 
+    set_raw = _limited(_failed, _write_failed)(_set_raw)
+
+    @_limited(_multi_failed, _write_failed, _keys_count)
+    @_profiled('set_multi', lambda args, r: args[0])
     def set_multi(self, values, return_failure=False):
         return self.mc.set_multi(values, return_failure=return_failure)
 
+    @_limited()
+    @_profiled('get', lambda args, r: {args[0]: r})
     def get(self, key):
+        if self.serializer is not None:
+            r, flag = self._get_raw(key)
+            try:
+                return self.serializer.loads(r, flag)
+            except ValueError, e:
+                # keep the data, beansdb is not a cache
+                log('beansdb can not decode %r from %s: %s' % (key, self, e))
+                return None
         try:
             r = self.mc.get(key)
             if r is None and self.mc.get_last_error() != 0:
@@ -119,13 +371,18 @@ class MCStore(object):
         except ValueError:
             self.mc.delete(key)
 
-    def get_raw(self, key):
+    def _get_raw(self, key):
         r, flag = self.mc.get_raw(key)
         if r is None and self.mc.get_last_error() != 0:
             raise IOError(
                 self.mc.get_last_error(), self.mc.get_last_strerror())
         return r, flag
 
+    get_raw = _limited()(_get_raw)
+
+    @_limited(size=_keys_count)
+    @_profiled('get_multi',
+               lambda args, r: dict((k, r.get(k)) for k in args[0]))
     def get_multi(self, keys):
         r = self.mc.get_multi(keys)
         if self.mc.get_last_error() != 0:
@@ -133,46 +390,225 @@ class MCStore(object):
                 self.mc.get_last_error(), self.mc.get_last_strerror())
         return r
 
+    @_limited(_failed, _write_failed)
+    @_profiled('delete', lambda args, r: {args[0]: None})
     def delete(self, key):
         return bool(self.mc.delete(key))
 
+    @_limited(_multi_failed, _write_failed, _keys_count)
+    @_profiled('delete_multi', lambda args, r: dict.fromkeys(args[0]))
     def delete_multi(self, keys, return_failure=False):
         return self.mc.delete_multi(keys, return_failure=return_failure)
 
+    @_limited(_failed, _write_failed)
+    def delete_at(self, key, rev):
+        """Delete key at revision -rev, unless it has a newer revision.
+
+        beansdb keeps a deleted key as a tombstone of the negative
+        revision of its deletion, and stores a set at a negative revision,
+        as sent by the sync of another replica, as that tombstone.  rev
+        must be negative, and set_raw() refuses negative revisions.
+        """
+        if rev >= 0:
+            raise ValueError('revision %d of a deletion' % rev)
+        return bool(self.mc.set_raw(key, '', rev, 0))
+
+    @_limited()
     def exists(self, key):
         return bool(self.mc.get('?' + key))
 
+    @_limited()
+    def get_version(self, key):
+        """Revision of key, 0 if missing and negative if deleted."""
+        r = self.mc.get('?' + key)
+        if r is None:
+            if self.mc.get_last_error() != 0:
+                raise IOError(
+                    self.mc.get_last_error(), self.mc.get_last_strerror())
+            return 0
+        return int(r.split(' ')[0])
+
+    @_limited(lambda *args, **kwargs: None)
     def incr(self, key, value):
         return self.mc.incr(key, int(value))
 
 
-class BeansdbClient(object):
+def warmup_stores(stores):
+    """Connect stores, return the number of them which answered.
+
+    Unthreaded stores are connected in parallel, the connections of
+    threaded ones belong to the calling thread so they are made here.
+    """
+    from douban.beansdb.parallel import fanout
+    f = fanout(lambda s: s.warmup(), [(s,) for s in stores if not s.threaded],
+               is_ok=bool)
+    return f.succeeded + sum(1 for s in stores if s.threaded and s.warmup())
+
+
+class IterMulti(object):
+
+    """iter_multi() over the get_multi(keys, default, timeout) of a client."""
+
+    def iter_multi(self, keys, default=None, timeout=None, batch_size=100,
+                   parallel=2, ordered=False):
+        """Yield (key, value) of an iterable of keys, as get_multi() of
+        batch_size keys return, `parallel` of them running ahead.  With
+        `ordered` the keys come in their order."""
+        from douban.beansdb.parallel import iter_batches
+        for batch, rs in iter_batches(
+                lambda ks: self.get_multi(ks, default, timeout), keys,
+                batch_size, parallel, ordered):
+            for k in batch:
+                yield k, rs.get(k, default)
+
+
+class BeansdbClient(IterMulti):
 
     store_cls = MCStore
 
-    def __init__(self, addrs, update_period=10, **kwargs):
+    def __init__(self, addrs, update_period=10, buckets_count=None,
+                 timeout=None, affinity=False, on_partial_write=None,
+                 **kwargs):
+        """Init.
+
+        buckets_count:
+            Number of buckets the servers are configured with, must be a
+            power of 16 (16, 256, 4096).  None means to discover it from the
+            `@` listings at every update, calls raise ValueError until the
+            servers hold enough keys to tell it.
+        timeout:
+            Default time budget in seconds of every call, over all the
+            replicas it tries.  Each call can give its own `timeout`.
+        affinity:
+            Read every key from the same replica first, chosen by
+            rendezvous hashing of the key and the replicas, instead of the
+            random order of the replicas, so that each replica caches its
+            own share of the keys.
+        on_partial_write:
+            Called with the name of the operation, 'set' or 'delete', and
+            the keys which set_multi() or delete_multi() wrote to fewer
+            than N replicas, also when their bucket is listed on fewer.
+
+        """
         self.addrs = addrs
+        self.timeout = timeout
+        self.affinity = affinity
+        self.on_partial_write = on_partial_write
         self.servers = [self.store_cls(s, **kwargs) for s in addrs]
         self.update_period = update_period
+        if buckets_count is not None:
+            bucket_depth(buckets_count)  # validate
+        self.buckets_count = buckets_count
+        self.discover_buckets = buckets_count is None
         self.buckets = []
         self.last_update = 0
         self.stat = [None] * len(addrs)
         self.W = 2
         self.N = 3
 
-    def update(self):
+    def _listdir(self, s, prefix=''):
+        """[(hash, count)] of the sub directories in `@prefix` of server s.
+
+        Return None if the listing is not of directories or s failed.
+        """
+        try:
+            r = []
+            for l in s.get('@' + prefix).strip().split('\n'):
+                name, h, count = l.split(' ')
+                if not name.endswith('/'):
+                    return None
+                r.append((int(h), int(count)))
+            return r
+        except Exception:
+            pass
+
+    def _discover_buckets_count(self, max_depth=3, min_votes=2):
+        """Guess the buckets count from the `@` listings.
+
+        A well filled directory of some server, with 256 keys or more,
+        which has empty and non-empty sub directories side by side is only
+        partly held by the server, so the buckets are below it.  The
+        buckets are at the first level where none of the well filled
+        directories of all the servers is partial, they are further down
+        if at least min_votes of them are, or all of them.  Raise
+        ValueError if it can not be told, when the servers hold too few
+        keys or the directories disagree.
+        """
+        level = [(s, '') for s in self.servers]
+        for depth in range(1, max_depth + 1):
+            partial = []
+            complete = 0
+            for s, prefix in level:
+                for i, (_, count) in enumerate(self._listdir(s, prefix) or []):
+                    if count < 256:
+                        continue
+                    sub = self._listdir(s, prefix + '%x' % i)
+                    if not sub:
+                        continue
+                    if all(n > 0 for _, n in sub):
+                        complete += 1
+                    else:
+                        partial.append((s, prefix + '%x' % i))
+            if not partial:
+                if depth == 1 and not complete:
+                    raise ValueError('too few keys to discover the buckets '
+                                     'count, configure buckets_count')
+                return 16 ** depth
+            if len(partial) < min_votes and complete:
+                raise ValueError('ambiguous buckets layout, %d partial and %d '
+                                 'complete directories at depth %d, configure '
+                                 'buckets_count' % (len(partial), complete,
+                                                    depth))
+            level = partial
+        raise ValueError('more than %d buckets, configure buckets_count'
+                         % 16 ** max_depth)
+
+    def _rediscover(self):
+        """Discover the buckets count again, logging when it changed."""
+        try:
+            count = self._discover_buckets_count()
+        except ValueError, e:
+            if self.buckets_count is None:
+                raise
+            log('beansdb client keeps %d buckets: %s'
+                % (self.buckets_count, e))
+            return
+        if self.buckets_count is not None and count != self.buckets_count:
+            log('beansdb client buckets count changed from %d to %d'
+                % (self.buckets_count, count))
+        self.buckets_count = count
+
+    def update(self, parallel=False):
+        if self.discover_buckets:
+            self._rediscover()
+        depth = bucket_depth(self.buckets_count)
+
         def listdir(s):
+            dirs = ['@%0*x' % (depth - 1, i)
+                    for i in range(self.buckets_count / 16)]
             try:
+                if depth == 1:
+                    return [count for _, count in self._listdir(s)]
+                rs = {}
+                for i in range(0, len(dirs), MAX_KEYS_IN_GET_MULTI):
+                    rs.update(s.get_multi(dirs[i:i + MAX_KEYS_IN_GET_MULTI]))
                 return [int(l.split(' ')[2])
-                        for l in s.get('@').strip().split('\n')]
+                        for d in dirs for l in rs[d].strip().split('\n')]
             except Exception:
                 pass
-        for i, s in enumerate(self.servers):
-            if not self.stat[i]:
+        todo = [(i, s) for i, s in enumerate(self.servers)
+                if not self.stat[i] or len(self.stat[i]) != self.buckets_count]
+        if parallel:
+            from douban.beansdb.parallel import fanout
+            f = fanout(listdir, [(s,) for i, s in todo])
+            for j, (i, _) in enumerate(todo):
+                self.stat[i] = f.results.get(j)
+        else:
+            for i, s in todo:
                 self.stat[i] = listdir(s)
 
         self.buckets = []
-        for i in range(16):
+        for i in range(self.buckets_count):
             ss = sorted([(st[i], j) for j, st in enumerate(self.stat) if st],
                         reverse=True)[:self.N]
             top = ss[0][0]
@@ -180,18 +616,69 @@ class BeansdbClient(object):
             random.shuffle(ss)
             self.buckets.append(ss)
 
-    def _get_servers(self, key):
+    def warmup(self):
+        """Load the bucket table and connect to all servers.
+
+        Call it before forking worker processes, which then share the
+        bucket table and connect again by themselves, or in each worker.
+        """
+        self.update(parallel=True)
+        self.last_update = time.time()
+        return warmup_stores(self.servers)
+
+    def _check_update(self):
         now = time.time()
         if self.last_update + self.update_period < now:
             self.update()
             self.last_update = now
 
-        return self.buckets[(fnv1a(key) * 16) >> 32]
+    def _get_servers(self, key):
+        self._check_update()
+        ss = self.buckets[(fnv1a(key) * self.buckets_count) >> 32]
+        if self.affinity and len(ss) > 1:
+            ss = sorted(ss, key=lambda s: _mix32(fnv1a(s.addr + key)),
+                        reverse=True)
+        return ss
+
+    def _get_bucket_servers(self, bucket):
+        self._check_update()
+        return self.buckets[bucket]
+
+    def _get_bucket_replicas(self, bucket):
+        """All the servers holding keys of bucket, also those left out of
+        its reads for holding fewer keys than the others."""
+        self._check_update()
+        readers = self.buckets[bucket]
+        return [s for s, st in zip(self.servers, self.stat)
+                if s in readers or st and st[bucket] > 0]
+
+    def scan(self, buckets=None, cursor=None, parallel=1, deleted=False):
+        """Iterate (key, hash, version) of the keys stored in beansdb.
+
+        Each bucket is listed from one of its replicas.  With `parallel` > 1
+        that many buckets are walked at the same time.  The returned
+        scanner has a `cursor` attribute, pass it back as `cursor` to
+        resume an interrupted scan.  Deleted keys, with negative versions,
+        are only included if `deleted` is true.
+        """
+        from douban.beansdb.scan import KeyScanner
+        return KeyScanner(self, buckets, cursor, parallel, deleted)
+
+    def diff(self, buckets=None, parallel=1, repair=False):
+        """[(key, {addr: version})] of the keys on which the replicas of
+        the buckets disagree, the version is 0 where a key is missing.
 
-    def get(self, key, default=None):
+        Only the directories whose `@` listing hashes differ are walked.
+        With `repair`, the newest version of each key is copied to the
+        replicas behind.
+        """
+        from douban.beansdb.antientropy import ReplicaDiff
+        return ReplicaDiff(self, buckets, parallel, repair).run()
+
+    def get(self, key, default=None, timeout=None):
         successful = False
         ss = self._get_servers(key)
-        for s in ss:
+        for s in bounded(ss, Deadline.of(timeout, self.timeout)):
             try:
                 r = s.get(key)
                 successful = True
@@ -214,15 +701,33 @@ class BeansdbClient(object):
         sc = sorted([(len(ks), addr) for addr, ks in ss.items()])
         return [(servers[addr], ss[addr]) for _, addr in sc]
 
-    def get_multi(self, keys, default=None):
+    def _dispatch_ranked(self, keys):
+        """[(server, keys)] asking each key of its first replica first,
+        then of the second one and so on."""
+        ranks = []
+        for key in keys:
+            for i, s in enumerate(self._get_servers(key)):
+                if i == len(ranks):
+                    ranks.append({})
+                ranks[i].setdefault(s, []).append(key)
+        return [item for rank in ranks for item in rank.items()]
+
+    def get_multi(self, keys, default=None, timeout=None):
+        deadline = Deadline.of(timeout, self.timeout)
         if len(keys) > MAX_KEYS_IN_GET_MULTI:
-            r = self.get_multi(keys[:-MAX_KEYS_IN_GET_MULTI], default)
-            r.update(self.get_multi(keys[-MAX_KEYS_IN_GET_MULTI:], default))
+            r = self.get_multi(keys[:-MAX_KEYS_IN_GET_MULTI], default,
+                               deadline)
+            r.update(self.get_multi(keys[-MAX_KEYS_IN_GET_MULTI:], default,
+                                    deadline))
             return r
         rs = {}
-        for s, ks in self._dispatch(keys):
+        dispatch = self._dispatch_ranked if self.affinity else self._dispatch
+        for s, ks in bounded(dispatch(keys), deadline, itemgetter(0)):
+            ks = [k for k in ks if k not in rs]
+            if not ks:
+                continue
             try:
-                r = s.get_multi([k for k in ks if k not in rs])
+                r = s.get_multi(ks)
                 rs.update(r)
             except IOError, e:
                 log("beansdb client get_multi() failed %s %s" % (s, e))
@@ -231,10 +736,20 @@ class BeansdbClient(object):
                 rs[k] = default
         return rs
 
-    def exists(self, key):
+    def batch(self, timeout=None):
+        """A douban.beansdb.batch.Batch of mixed operations, sent to each
+        server together."""
+        from douban.beansdb.batch import Batch
+        return Batch(self, timeout)
+
+    def exists(self, key, timeout=None):
         pos = '@%08x' % fnv1a(key)
-        for s in self._get_servers(key):
-            r = s.get(pos) or ''
+        for s in bounded(self._get_servers(key),
+                         Deadline.of(timeout, self.timeout)):
+            try:
+                r = s.get(pos) or ''
+            except OverloadedError:
+                continue
             for l in r.split('\n'):
                 parts = l.split(' ')
                 if not parts:
@@ -246,76 +761,120 @@ class BeansdbClient(object):
         #        return True
         return False
 
-    def set(self, key, value):
+    def set(self, key, value, timeout=None):
         if value is not None:
             ss = self._get_servers(key)
-            success_count = sum(1 if s.set(key, value) else 0 for s in ss[:self.N])
+            deadline = Deadline.of(timeout, self.timeout)
+            success_count = sum(1 if s.set(key, value) else 0
+                                for s in bounded(ss[:self.N], deadline))
             if success_count < self.W:
                 raise WriteFailedError(key, ss)
             return True
         else:
-            return self.delete(key)
+            return self.delete(key, timeout)
+
+    def _write_multi(self, op, keys, batch, deadline):
+        """Send `op` of the keys to all their replicas concurrently.
+
+        Return the keys acknowledged by fewer than W replicas.
+        """
+        from douban.beansdb.parallel import fanout
 
-    def set_multi(self, values):
+        def write(s, ks):
+            for s in bounded([s], deadline):
+                r, failures = getattr(s, op)(batch(ks), return_failure=True)
+                return set(failures or ()) if not r else ()
+            return ks
+
+        dispatch_result = self._dispatch(keys)
+        f = fanout(write, dispatch_result, timeout=deadline.remaining())
+        acks = dict.fromkeys(keys, 0)
+        for i, (s, ks) in enumerate(dispatch_result):
+            if i in f.errors:
+                log("beansdb client %s() failed %s %s" % (op, s, f.errors[i]))
+            failures = f.results.get(i, ks)
+            for k in ks:
+                if k not in failures:
+                    acks[k] += 1
+        # against N, as a bucket may be listed on fewer servers
+        partial = [k for k, n in acks.iteritems() if n < self.N]
+        if partial and self.on_partial_write is not None:
+            self.on_partial_write(op[:-len('_multi')], partial)
+        return [k for k, n in acks.iteritems() if n < self.W]
+
+    def set_multi(self, values, timeout=None):
+        deadline = Deadline.of(timeout, self.timeout)
         to_delete = [k for k, v in values.iteritems() if v is None]
-        self.delete_multi(to_delete)
-        all_failures = []
+        if to_delete:
+            self.delete_multi(to_delete, deadline)
         values = dict((k, v) for k, v in values.iteritems() if v is not None)
-        dispatch_result = self._dispatch(values.keys())
-        for s, ks in dispatch_result:
-            vs = dict((k, values[k]) for k in ks)
-            r, failures = s.set_multi(vs, return_failure=True)
-            if not r:
-                all_failures += failures
-        if len(all_failures) != 0:
-            raise WriteFailedError(
-                all_failures, [s for s, _ in dispatch_result])
+        failures = self._write_multi(
+            'set_multi', values.keys(),
+            lambda ks: dict((k, values[k]) for k in ks), deadline)
+        if failures:
+            raise WriteFailedError(failures, self.addrs)
         return True
 
-    def delete(self, key):
+    def delete(self, key, timeout=None):
         ss = self._get_servers(key)
-        if not all([s.delete(key) for s in ss]):
+        deadline = Deadline.of(timeout, self.timeout)
+        rs = [s.delete(key) for s in bounded(ss, deadline)]
+        if len(rs) < len(ss) or not all(rs):
             raise WriteFailedError(key, ss)
         return True
 
-    def delete_multi(self, keys):
-        all_failures = []
-        dispatch_result = self._dispatch(keys)
-        for s, ks in dispatch_result:
-            r, failures = s.delete_multi(ks, return_failure=True)
-            if not r:
-                all_failures += failures
-        if len(all_failures) != 0:
-            raise DeleteFailedError(
-                all_failures, [s for s, _ in dispatch_result])
+    def delete_multi(self, keys, timeout=None):
+        failures = self._write_multi('delete_multi', keys, lambda ks: ks,
+                                     Deadline.of(timeout, self.timeout))
+        if failures:
+            raise DeleteFailedError(failures, self.addrs)
         return True
 
-    def incr(self, key, incr=1):
+    def incr(self, key, incr=1, timeout=None):
         v = 0
-        for s in self._get_servers(key):
+        for s in bounded(self._get_servers(key),
+                         Deadline.of(timeout, self.timeout)):
             v = max(v, s.incr(key, incr))
         return v
 
 
-class BeansDBProxy(object):
+class BeansDBProxy(IterMulti):
     store_cls = MCStore
     threaded = True
+    min_backoff = 0.5  # seconds a failed proxy is avoided, doubled per
+    max_backoff = 30   # failure in a row up to max_backoff, with jitter
 
-    def __init__(self, proxies, rechoose_period=60, **kwargs):
+    def __init__(self, proxies, rechoose_period=60, timeout=None,
+                 retry_budget=None, **kwargs):
         """Init.
 
         rechoose_period:
             Seconds to re-choose a proxy to communicate, to keep connection to
             two proxies.  Otherwise when one proxy fails, too many connect
             requests will overwhelm remaining proxies.
+        timeout:
+            Default time budget in seconds of every call, over all the
+            proxies it tries.  Each call can give its own `timeout`.
+        retry_budget:
+            A douban.beansdb.limit.RetryBudget bounding the calls retried
+            on another proxy, by default 10% of the calls.  Its counters
+            tell how often the budget was exhausted.
 
         """
+        from douban.beansdb.limit import RetryBudget
+        self.timeout = timeout
         self.servers = [self.store_cls(i, threaded=self.threaded, **kwargs)
                         for i in proxies]
         # make the servers to be a random sequence
         random.shuffle(self.servers)
         self.rechoose_period = rechoose_period
         self._time_to_rechoose = time.time() + rechoose_period
+        self.retry_budget = retry_budget or RetryBudget()
+        self._failures = {}  # server -> (failures in a row, avoided until)
+
+    def warmup(self):
+        """Connect to the two proxies in use."""
+        return warmup_stores(self.servers[:2])
 
     def _get_servers(self, key):
         now = time.time()
@@ -326,124 +885,239 @@ class BeansDBProxy(object):
             self._time_to_rechoose = now + self.rechoose_period
         return self.servers
 
-    def get(self, key, default=None):
+    def _tries(self, key, timeout):
+        """Yield the proxies to try for one call.
+
+        Proxies which failed recently come last, and every proxy after the
+        first one is a retry taken from the retry budget, unless the
+        limit of the previous one rejected the call.
+        """
+        now = time.time()
         servers = self._get_servers(key)
-        for s in servers:
+        ready = [s for s in servers
+                 if self._failures.get(s, (0, 0))[1] <= now]
+        if len(ready) < len(servers):
+            servers = ready + [s for s in servers if s not in ready]
+        self.retry_budget.deposit()
+        deadline = Deadline.of(timeout, self.timeout)
+        last = None
+        for s in bounded(servers, deadline):
+            if last is not None and not _rejected(last) \
+                    and not self.retry_budget.withdraw():
+                return
+            yield s
+            last = s
+
+    def _succeeded(self, s):
+        self._failures.pop(s, None)
+        i = self.servers.index(s)
+        if i > 0:
+            self.servers = self.servers[i:] + self.servers[:i]
+
+    def _failed(self, s):
+        n = self._failures.get(s, (0, 0))[0] + 1
+        backoff = min(self.min_backoff * 2 ** (n - 1), self.max_backoff)
+        self._failures[s] = (
+            n, time.time() + backoff * random.uniform(0.5, 1.5))
+        if self.servers[0] is s:
+            self.servers = self.servers[1:] + self.servers[:1]
+
+    def _write_failed(self, s, r):
+        """Back s off if the write failed on it, not if it was answered,
+        as the delete of a missing key is, or rejected by its limit."""
+        if not _rejected(s) and _write_failed(s, r):
+            self._failed(s)
+
+    def get(self, key, default=None, timeout=None):
+        for s in self._tries(key, timeout):
             try:
                 r = s.get(key)
+                self._succeeded(s)
                 if r is None:
                     r = default
                 return r
+            except OverloadedError:
+                pass
             except IOError:
-                self.servers = self.servers[1:] + self.servers[:1]
+                self._failed(s)
 
         log('all backends read failed, ' + key)
-        raise ReadFailedError(key, servers)
+        raise ReadFailedError(key, self.servers)
 
-    def exists(self, key):
-        for s in self._get_servers(key):
+    def batch(self, timeout=None):
+        """A douban.beansdb.batch.Batch of mixed operations, sent to the
+        chosen proxy together."""
+        from douban.beansdb.batch import Batch
+        return Batch(self, timeout)
+
+    def exists(self, key, timeout=None):
+        for s in self._tries(key, timeout):
             try:
-                return s.exists(key)
+                r = s.exists(key)
+                self._succeeded(s)
+                return r
+            except OverloadedError:
+                pass
             except IOError:
-                self.servers = self.servers[1:] + self.servers[:1]
+                self._failed(s)
         return False
 
-    def get_multi(self, keys, default=None):
+    def get_multi(self, keys, default=None, timeout=None):
+        deadline = Deadline.of(timeout, self.timeout)
         if len(keys) > MAX_KEYS_IN_GET_MULTI:
-            r = self.get_multi(keys[:-MAX_KEYS_IN_GET_MULTI], default)
-            r.update(self.get_multi(keys[-MAX_KEYS_IN_GET_MULTI:], default))
+            r = self.get_multi(keys[:-MAX_KEYS_IN_GET_MULTI], default,
+                               deadline)
+            r.update(self.get_multi(keys[-MAX_KEYS_IN_GET_MULTI:], default,
+                                    deadline))
             return r
-        for s in self._get_servers(''):
+        for s in self._tries('', deadline):
             try:
                 rs = s.get_multi(keys)
+                self._succeeded(s)
                 for k in keys:
                     if k not in rs:
                         rs[k] = default
                 return rs
+            except OverloadedError:
+                pass
             except IOError:
-                self.servers = self.servers[1:] + self.servers[:1]
+                self._failed(s)
 
         log('all backends read failed, with %s' % str(keys))
         raise ReadFailedError(keys, self.servers)
 
-    def set(self, key, value):
+    def set(self, key, value, timeout=None):
         if value is None:
             return False
-        for i, s in enumerate(self._get_servers('')):
-            if s.set(key, value):
-                if i > 0:
-                    self.servers = self.servers[i:] + self.servers[:i]
+        for s in self._tries('', timeout):
+            r = s.set(key, value)
+            if r:
+                self._succeeded(s)
                 return True
+            self._write_failed(s, r)
         log('all backends set failed, with %s' % str(key))
         raise WriteFailedError(key)
 
-    def set_multi(self, values):
+    def set_multi(self, values, timeout=None):
         """
         set_multi will try every proxy until all keys have been set
         if all of proxies have been tried, but there are some keys are failed
         yet, record them in a exception and raise it.
         """
-        for i, s in enumerate(self._get_servers('')):
+        failures = values.keys()
+        for s in self._tries('', timeout):
             r, failures = s.set_multi(values, return_failure=True)
             if r:
-                if i > 0:
-                    self.servers = self.servers[i:] + self.servers[:i]
+                self._succeeded(s)
                 return True
             else:
+                self._write_failed(s, r)
                 values = dict((k, values[k]) for k in failures)
         if failures:
             raise WriteFailedError(failures)
 
-    def delete(self, key):
-        for i, s in enumerate(self._get_servers('')):
-            if s.delete(key):
-                if i > 0:
-                    self.servers = self.servers[i:] + self.servers[:i]
+    def delete(self, key, timeout=None):
+        for s in self._tries('', timeout):
+            r = s.delete(key)
+            if r:
+                self._succeeded(s)
                 return True
+            self._write_failed(s, r)
         log('all backends delete failed, with %s' % str(key))
         #raise DeleteFailedError(key)
         return False
 
-    def delete_multi(self, keys):
+    def delete_multi(self, keys, timeout=None):
         """
         delete_multi will try every proxy until all keys have been deleted.
         if all of proxies have been tried, but there are some keys are failed
         yet, record them in a exception and raise it.
         """
-        for i, s in enumerate(self._get_servers('')):
+        failures = keys
+        for s in self._tries('', timeout):
             r, failures = s.delete_multi(keys, return_failure=True)
             if r:
-                if i > 0:
-                    self.servers = self.servers[i:] + self.servers[:i]
+                self._succeeded(s)
                 return True
             else:
+                self._write_failed(s, r)
                 keys = failures
         if failures:
             #raise DeleteFailedError(failures)
             return False
 
-    def incr(self, key, value):
+    def incr(self, key, value, timeout=None):
         if value is None:
             return
-        for i, s in enumerate(self._get_servers(key)):
+        for s in self._tries(key, timeout):
             v = s.incr(key, value)
             if v:
-                if i > 0:
-                    self.servers = self.servers[i:] + self.servers[:i]
+                self._succeeded(s)
                 return v
 
 _empty_slot = '__empty_slot__##'
 
 
-class CacheWrapper(object):
+def _timeout(timeout):
+    """The timeout kwarg of a call, left out if not given, so that dbs
+    whose methods have no timeout can be wrapped."""
+    return dict(timeout=timeout) if timeout is not None else {}
+
+
+class DelayCleaner(object):
+
+    """Base of delay cleaners which take a batch of keys at once.
+
+    CacheWrapper gives them all the keys of a multi call in one
+    clean_multi(), and a single key as a batch of one.  The default
+    cleans the keys one by one with the cleaner called on a key.
+    """
+
+    def clean_multi(self, keys):
+        for key in keys:
+            self(key)
+
+
+class CacheWrapper(IterMulti):
 
     """a cached wrapper of BeansDBProxy"""
 
-    def __init__(self, db, mc, delay_cleaner=None):
+    def __init__(self, db, mc, delay_cleaner=None, pipeline=None,
+                 profiler=None, shared_cache=None):
+        """Init.
+
+        delay_cleaner:
+            a callable to clean a key from mc again a while later, or a
+            DelayCleaner.  Without it a delayed delete is sent to mc.
+        pipeline:
+            a CacheFillPipeline to fill mc with values read from db in
+            background.  It also cleans keys later if there is no
+            delay_cleaner.
+        profiler:
+            a douban.beansdb.profiler.SizeProfiler recording the sizes of
+            the values read and written, from mc or db.
+        shared_cache:
+            a douban.beansdb.shmcache.SharedMemoryCache read before mc,
+            made before the worker processes are forked to be shared.
+
+        """
+        if shared_cache is not None:
+            from douban.beansdb.shmcache import SharedCachedMC
+            mc = SharedCachedMC(mc, shared_cache)
         self.db = db
         self.mc = mc
+        self.pipeline = pipeline
+        self.profiler = profiler
+        if delay_cleaner is None:
+            delay_cleaner = pipeline
         self.delay_cleaner = delay_cleaner
 
+    def __clean_later(self, keys):
+        if isinstance(self.delay_cleaner, DelayCleaner):
+            self.delay_cleaner.clean_multi(keys)
+        else:
+            for k in keys:
+                self.delay_cleaner(k)
 
     def __delete_multi_with_delay(self, keys):
         """
@@ -452,8 +1126,7 @@ class CacheWrapper(object):
         """
         self.mc.delete_multi(keys)
         if self.delay_cleaner:
-            for k in keys:
-                self.delay_cleaner(k)
+            self.__clean_later(keys)
         else:
             # dealy delete_multi will conform deleting work
             # it will cover conflict situation.
@@ -465,8 +1138,7 @@ class CacheWrapper(object):
         """
         self.mc.set_multi(values, time=ONE_MINUTE)
         if self.delay_cleaner:
-            for k in values:
-                self.delay_cleaner(k)
+            self.__clean_later(values.keys())
         else:
             self.mc.delete_multi(values.keys(), time=ONE_MINUTE)
 
@@ -479,7 +1151,7 @@ class CacheWrapper(object):
         """
         self.mc.set(key, value, time=ONE_MINUTE)
         if self.delay_cleaner:
-            self.delay_cleaner(key)
+            self.__clean_later([key])
         else:
             # to confirm the expire must work
             # even set with expire was overwriten by an another set action,
@@ -492,14 +1164,14 @@ class CacheWrapper(object):
         """
         self.mc.delete(key)
         if self.delay_cleaner:
-            self.delay_cleaner(key)
+            self.__clean_later([key])
         else:
             # to confirm the expire must work
             # even set with expire was overwriten by an another set action,
             # the delay delete will do the same thing
             self.mc.delete(key, time=ONE_MINUTE)
 
-    def get(self, key, default=None):
+    def get(self, key, default=None, timeout=None):
         """
         _empty_slot is a legacy value, it means mc do not has the key,
         we just clear it. and treat it as mc do not has key's situation.
@@ -508,18 +1180,25 @@ class CacheWrapper(object):
         """
         r = self.mc.get(key)
         if r is not None and r != _empty_slot:
+            if self.profiler is not None:
+                self.profiler.record('get', key, r)
             return r
         else:
-            value = self.db.get(key)
+            value = self.db.get(key, **_timeout(timeout))
+            if self.profiler is not None:
+                self.profiler.record('get', key, value)
             if value is not None:
-                self.mc.set(key, value, time=ONE_DAY)
+                if self.pipeline is not None:
+                    self.pipeline.fill({key: value}, ONE_DAY)
+                else:
+                    self.mc.set(key, value, time=ONE_DAY)
             else:
                 value = default
                 if r is not None:
                     self.mc.delete(key) #delete _empty_slot from mc
             return value
 
-    def exists(self, key):
+    def exists(self, key, timeout=None):
         """
         exists is used to test whether the db has the key
         equal to db.get() is not None
@@ -528,9 +1207,9 @@ class CacheWrapper(object):
         if r not in (None, _empty_slot):
             return True
         else:
-            return self.db.exists(key)
+            return self.db.exists(key, **_timeout(timeout))
 
-    def get_multi(self, keys, default=None):
+    def get_multi(self, keys, default=None, timeout=None):
         """
         just get the values, do not do anything to mc
         """
@@ -539,34 +1218,45 @@ class CacheWrapper(object):
             k for k in keys if rs.get(k) in (None, _empty_slot)]
 
         if non_exist_keys:
-            nrs = self.db.get_multi(non_exist_keys)
+            nrs = self.db.get_multi(non_exist_keys, **_timeout(timeout))
             rs.update((k, v if v is not None else default)
                       for k, v in nrs.iteritems())
-            self.mc.set_multi(nrs, time=ONE_DAY)
+            if self.pipeline is not None:
+                self.pipeline.fill(nrs, ONE_DAY)
+            else:
+                self.mc.set_multi(nrs, time=ONE_DAY)
 
+        if self.profiler is not None:
+            self.profiler.record_multi(
+                'get_multi', dict((k, rs.get(k)) for k in keys))
         return rs
 
-    def set(self, key, value):
+    def set(self, key, value, timeout=None):
         """
         if value is None, it means delete.
         set will cause a set with expire, and a delayed delete.
         if db.set failed, should clean mc twice
         """
+        if self.profiler is not None:
+            self.profiler.record('set' if value is not None else 'delete',
+                                 key, value)
         try:
             if value is None:
                 log("%s is deleted in both mc and db explicitly" % key)
-                self.db.delete(key)
+                self.db.delete(key, **_timeout(timeout))
             else:
-                self.db.set(key, value)
+                self.db.set(key, value, **_timeout(timeout))
             self.__set_with_expire(key, value)
             return True
         except:
             self.__delete_with_delay(key)
             raise
 
-    def set_multi(self, values):
+    def set_multi(self, values, timeout=None):
+        if self.profiler is not None:
+            self.profiler.record_multi('set_multi', values)
         try:
-            self.db.set_multi(values)
+            self.db.set_multi(values, **_timeout(timeout))
             self.__set_multi_with_expire(values)
             # because BeansDBProxy's set_multi will return True or raise
             return True
@@ -574,23 +1264,27 @@ class CacheWrapper(object):
             self.__delete_multi_with_delay(values.keys())
             raise
 
-    def delete(self, key):
+    def delete(self, key, timeout=None):
+        if self.profiler is not None:
+            self.profiler.record('delete', key, None)
         try:
-            return self.db.delete(key)
+            return self.db.delete(key, **_timeout(timeout))
         finally:
             self.__delete_with_delay(key)
 
-    def delete_multi(self, keys):
+    def delete_multi(self, keys, timeout=None):
+        if self.profiler is not None:
+            self.profiler.record_multi('delete_multi', dict.fromkeys(keys))
         try:
-            return self.db.delete_multi(keys)
+            return self.db.delete_multi(keys, **_timeout(timeout))
         finally:
             self.__delete_multi_with_delay(keys)
 
-    def incr(self, key, value):
+    def incr(self, key, value, timeout=None):
         if value is None:
             return
         try:
-            r = self.db.incr(key, value)
+            r = self.db.incr(key, value, **_timeout(timeout))
         finally:
             self.__delete_with_delay(key)
         return r
@@ -598,8 +1292,13 @@ class CacheWrapper(object):
     def clear_thread_ident(self):
         self.mc.clear_thread_ident()
 
+    def warmup(self):
+        return self.db.warmup()
+
 
-def beansdb_from_config(config, mc=None, direct=False, delay_cleaner=None, **kwargs):
+def beansdb_from_config(config, mc=None, direct=False, delay_cleaner=None,
+                        pipeline=None, tracer=None, shared_cache=None,
+                        **kwargs):
     if isinstance(config, basestring):
         config = read_config(config, 'beansdb')
 
@@ -609,10 +1308,18 @@ def beansdb_from_config(config, mc=None, direct=False, delay_cleaner=None, **kwa
     else:
         nodes = config.get('servers') if direct else config.get('proxies')
 
+    if direct and isinstance(config, dict) and 'buckets_count' in config:
+        kwargs.setdefault('buckets_count', config['buckets_count'])
+
     db = BeansdbClient(
         nodes, **kwargs) if direct else BeansDBProxy(nodes, **kwargs)
 
     if mc:
-        db = CacheWrapper(db, mc, delay_cleaner=delay_cleaner)
+        db = CacheWrapper(db, mc, delay_cleaner=delay_cleaner,
+                          pipeline=pipeline, shared_cache=shared_cache)
+
+    if tracer:
+        from douban.beansdb.trace import TracedClient
+        db = TracedClient(db, tracer)
 
     return db
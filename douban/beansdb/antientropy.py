@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+antientropy.py
+
+Find and repair the keys on which the replicas of a bucket disagree.
+
+The `@<hex>` listings of a directory give a hash and a count for each
+sub directory, so the listings of the replicas are compared from the
+bucket down, entering only the directories whose hash or count differ,
+like a Merkle tree.  Values are read only to repair a divergent key, so
+the cost grows with the divergence, not with the data.
+
+A divergent key is repaired by copying the raw value and flags of its
+newest version to the replicas behind, or by deleting it there at the
+revision of the newest deletion.  A key deleted or missing on every
+replica is not divergent, though its deletions are brought to the same
+revision when repairing.  Two replicas with different values of the
+same version are reported as conflicts and left alone.
+
+Usage: beansdb-diff [options] CONFIG
+"""
+
+import sys
+import time
+import threading
+from optparse import OptionParser
+
+from douban.beansdb import beansdb_from_config, bucket_depth, log, \
+    ReadFailedError
+from douban.beansdb.parallel import iter_workers
+from douban.beansdb.scan import walk, parse_listing
+
+
+class ReplicaDiff(object):
+
+    """Compare the replicas of the buckets of a BeansdbClient.
+
+    run() returns [(key, {addr: version})] of the divergent keys, the
+    version being 0 where the key is missing.  With `repair`, they are
+    repaired as they are found.  `parallel` buckets are compared at the
+    same time.
+    """
+
+    def __init__(self, client, buckets=None, parallel=1, repair=False):
+        self.client = client
+        client._check_update()
+        self.depth = bucket_depth(client.buckets_count)
+        if buckets is None:
+            buckets = range(client.buckets_count)
+        self.buckets = list(buckets)
+        self.parallel = parallel
+        self.repair = repair
+        self.stats = dict(listings=0, divergent=0, repaired=0, conflicts=0,
+                          elapsed=0)
+        self._lock = threading.Lock()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def _items(self, s, prefix):
+        """All (hash, ver) of the keys under prefix on s."""
+        items = {}
+        for leaf, its in walk([s], prefix):
+            self._count('listings')
+            items.update((k, (h, ver)) for k, h, ver in its)
+        return items
+
+    def _listing(self, s, prefix):
+        """({sub: (hash, count)}, {key: (hash, ver)}) of `@prefix` on s."""
+        r = s.get('@' + prefix)
+        if r is None:
+            raise ReadFailedError('@' + prefix, [s])
+        dirs, items = parse_listing(r)
+        return (dict((d, (h, n)) for d, h, n in dirs),
+                dict((k, (h, ver)) for k, h, ver in items))
+
+    def _diff(self, servers, prefix):
+        """Yield (key, {addr: (hash, ver)}) diverging under prefix."""
+        listings = [self._listing(s, prefix) for s in servers]
+        self._count('listings', len(servers))
+        if all(dirs or not items for dirs, items in listings) \
+                and any(dirs for dirs, items in listings):
+            subs = set()
+            for dirs, items in listings:
+                subs.update(dirs)
+            for sub in sorted(subs):
+                if len(set(dirs.get(sub, (0, 0)) for dirs, _ in listings)) > 1:
+                    for d in self._diff(servers, prefix + sub):
+                        yield d
+            return
+        # leaf directories, or the tree is split differently
+        per_server = []
+        for s, (dirs, items) in zip(servers, listings):
+            if dirs:
+                items = self._items(s, prefix)
+            per_server.append(items)
+        keys = set()
+        for items in per_server:
+            keys.update(items)
+        for key in sorted(keys):
+            vs = [items.get(key, (0, 0)) for items in per_server]
+            if len(set(vs)) > 1:
+                yield key, dict((s.addr, v) for s, v in zip(servers, vs))
+
+    def _repair(self, servers, key, hvs):
+        """Bring the replicas behind to the newest revision of key,
+        return whether they all were."""
+        newest = max(abs(ver) for h, ver in hvs.values())
+        latest = set(h for h, ver in hvs.values() if abs(ver) == newest)
+        if len(latest) > 1:
+            log('beansdb diff conflict of %r: %r' % (key, hvs))
+            self._count('conflicts')
+            return False
+        behind = [s for s in servers if abs(hvs[s.addr][1]) < newest]
+        source = [s for s in servers if abs(hvs[s.addr][1]) == newest][0]
+        ver = hvs[source.addr][1]
+        if ver < 0:
+            return all([s.delete_at(key, ver) for s in behind])
+        data, flag = source.get_raw(key)
+        if data is None or source.get_version(key) != ver:
+            return False  # changed since it was listed, for the next pass
+        return all([s.set_raw(key, data, ver, flag) for s in behind])
+
+    def _diff_bucket(self, b):
+        """Yield (key, {addr: version}) of the divergent keys of b."""
+        # the replicas furthest behind are not read from
+        servers = self.client._get_bucket_replicas(b)
+        if len(servers) < 2:
+            return
+        for key, hvs in self._diff(servers, '%0*x' % (self.depth, b)):
+            if all(ver <= 0 for h, ver in hvs.values()):
+                # deleted everywhere, only the deletions differ
+                if self.repair:
+                    self._repair(servers, key, hvs)
+                continue
+            self._count('divergent')
+            if self.repair and self._repair(servers, key, hvs):
+                self._count('repaired')
+            yield key, dict((addr, ver) for addr, (h, ver) in hvs.items())
+
+    def run(self):
+        start = time.time()
+        found = list(iter_workers(self._diff_bucket, self.buckets,
+                                  self.parallel))
+        self.stats['elapsed'] = time.time() - start
+        return found
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] CONFIG')
+    parser.add_option('-r', '--repair', action='store_true',
+                      help='repair the divergent keys')
+    parser.add_option('-p', '--parallel', type='int', default=4,
+                      help='buckets compared at the same time [%default]')
+    parser.add_option('--buckets',
+                      help='comma separated buckets to compare, all if not given')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('wrong number of arguments')
+    client = beansdb_from_config(args[0], direct=True)
+    buckets = opts.buckets and [int(b) for b in opts.buckets.split(',')]
+    d = ReplicaDiff(client, buckets, opts.parallel, opts.repair)
+    for key, vers in d.run():
+        print key, ' '.join('%s:%d' % it for it in sorted(vers.items()))
+    print >>sys.stderr, ('%(divergent)d divergent, %(repaired)d repaired, '
+                         '%(conflicts)d conflicts, %(listings)d listings '
+                         'in %(elapsed).1fs' % d.stats)
+    return 1 if d.stats['divergent'] > d.stats['repaired'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+batch.py
+
+Send mixed get, exists, set and delete operations of a client together.
+
+The operations of a Batch are grouped by kind into the multi operations
+of the client, which route them: BeansdbClient sends each server the keys
+it holds, BeansDBProxy sends them to its chosen proxy.  The groups are
+sent concurrently, so a flush takes about one round trip.  Operations on
+the same key keep their order: a write after another operation on its
+key, or a read after a write, goes in a later round.
+
+    with db.batch() as b:
+        user = b.get('user:1')
+        b.set('seen:1', now)
+        b.delete('session:1')
+    print user.result()
+"""
+
+from douban.beansdb import Deadline, ReadFailedError, WriteFailedError, \
+    DeleteFailedError
+from douban.beansdb.parallel import fanout, get_pool, OUTER
+
+READS = ('get', 'exists')
+ERRORS = dict(get=ReadFailedError, exists=ReadFailedError,
+              set=WriteFailedError, delete=DeleteFailedError)
+
+
+class Future(object):
+
+    """The result of an operation of a Batch, known once it is flushed."""
+
+    def __init__(self, op, key, arg=None):
+        self.op = op
+        self.key = key
+        self.arg = arg  # value of set, default of get
+        self.done = False
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self.done = True
+
+    def set_error(self, error):
+        self._error = error
+        self.done = True
+
+    def exception(self):
+        return self._error
+
+    def result(self):
+        if not self.done:
+            raise RuntimeError('batch not flushed')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def __repr__(self):
+        return '<Future %s %r>' % (self.op, self.key)
+
+
+class Batch(object):
+
+    """Operations of `client` sent by flush(), or when the with block
+    exits without error.
+
+    timeout:
+        time budget in seconds of the flush, the client's by default.
+    """
+
+    def __init__(self, client, timeout=None):
+        self.client = client
+        self.timeout = timeout
+        self._ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def _add(self, op, key, arg=None):
+        f = Future(op, key, arg)
+        self._ops.append(f)
+        return f
+
+    def get(self, key, default=None):
+        return self._add('get', key, default)
+
+    def exists(self, key):
+        return self._add('exists', key)
+
+    def set(self, key, value):
+        if value is None:
+            return self._add('delete', key)
+        return self._add('set', key, value)
+
+    def delete(self, key):
+        return self._add('delete', key)
+
+    def __len__(self):
+        return len(self._ops)
+
+    def _rounds(self, ops):
+        rounds = [[]]
+        touched = {}  # key -> written in the round
+        for f in ops:
+            written = touched.get(f.key)
+            if written is not None and (written or f.op not in READS):
+                rounds.append([])
+                touched = {}
+            rounds[-1].append(f)
+            touched[f.key] = touched.get(f.key) or f.op not in READS
+        return rounds
+
+    def _calls(self, ops, deadline):
+        """[(function, futures)] sending the operations of one round."""
+        client = self.client
+        groups = {}
+        for f in ops:
+            groups.setdefault(f.op, []).append(f)
+        calls = []
+        if 'get' in groups:
+            keys = [f.key for f in groups['get']]
+            calls.append((lambda keys=keys: client.get_multi(
+                keys, timeout=deadline), groups['get']))
+        if 'set' in groups:
+            values = dict((f.key, f.arg) for f in groups['set'])
+            calls.append((lambda: client.set_multi(values, timeout=deadline),
+                          groups['set']))
+        if 'delete' in groups:
+            keys = [f.key for f in groups['delete']]
+            calls.append((lambda keys=keys: client.delete_multi(
+                keys, timeout=deadline), groups['delete']))
+        for f in groups.get('exists', ()):
+            calls.append((lambda key=f.key: client.exists(
+                key, timeout=deadline), [f]))
+        return calls
+
+    def _resolve(self, futures, r):
+        for f in futures:
+            if f.op == 'get':
+                v = r.get(f.key)
+                f.set_result(f.arg if v is None else v)
+            elif f.op == 'exists':
+                f.set_result(r)
+            else:
+                f.set_result(bool(r))
+
+    def _fail(self, futures, error):
+        # multi writes tell the keys which failed
+        failed = getattr(error, 'key', None)
+        if futures[0].op not in READS and isinstance(failed, list):
+            failed = set(failed)
+            ok = [f for f in futures if f.key not in failed]
+            self._resolve(ok, True)
+            futures = [f for f in futures if f.key in failed]
+        for f in futures:
+            f.set_error(error)
+
+    def flush(self):
+        """Send the operations, return their results in order, with the
+        exception of the failed ones in their place."""
+        ops, self._ops = self._ops, []
+        deadline = Deadline.of(self.timeout,
+                               getattr(self.client, 'timeout', None))
+        for round_ops in self._rounds(ops):
+            remaining = deadline.remaining()
+            if remaining is not None and remaining <= 0:
+                calls, results, errors = [(None, round_ops)], {}, {}
+            else:
+                calls = self._calls(round_ops, deadline)
+                # the multi operations fan out to the servers in turn
+                f = fanout(lambda func: func(),
+                           [(func, ) for func, _ in calls], timeout=remaining,
+                           pool=get_pool(OUTER))
+                results, errors = f.results, f.errors
+            for i, (_, futures) in enumerate(calls):
+                if i in results:
+                    self._resolve(futures, results[i])
+                elif i in errors:
+                    self._fail(futures, errors[i])
+                else:
+                    for fu in futures:
+                        fu.set_error(ERRORS[fu.op](fu.key))
+        return [fu.exception() or fu._result for fu in ops]
+
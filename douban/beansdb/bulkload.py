@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bulkload.py
+
+Load a large number of records into beansdb through a BeansdbClient.
+
+Records are routed to their replicas up front and written by a few
+concurrent `set_multi` streams per server.  Each stream adapts its batch
+size to the latency of the server and backs off when it fails.
+
+Usage: beansdb-bulkload [options] CONFIG [FILE]
+"""
+
+import sys
+import time
+import marshal
+import threading
+import Queue
+from optparse import OptionParser
+
+from douban.beansdb import beansdb_from_config, log
+
+
+class _ServerStream(object):
+
+    """Batches for one server, written by `streams` threads."""
+
+    def __init__(self, loader, server):
+        self.loader = loader
+        self.server = server
+        self.batch_size = loader.batch_size
+        self.pending = {}
+        self.queue = Queue.Queue(loader.streams * 2)
+        self.backoff = 0
+        self.error = None  # exc_info of an unexpected exception
+        self.threads = [threading.Thread(target=self._run)
+                        for i in range(loader.streams)]
+        for t in self.threads:
+            t.setDaemon(True)
+            t.start()
+
+    def check(self):
+        """Raise the unexpected exception a thread of the stream got."""
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def add(self, key, value):
+        """Return True if a pending record of the key was replaced."""
+        self.check()
+        replaced = key in self.pending
+        self.pending[key] = value
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return replaced
+
+    def flush(self):
+        if self.pending:
+            # blocks while the server is behind
+            self.queue.put(self.pending)
+            self.pending = {}
+
+    def close(self):
+        if self.error is None:
+            self.flush()
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def _adapt(self, latency, failed):
+        l = self.loader
+        if failed:
+            self.batch_size = max(l.min_batch_size, self.batch_size / 2)
+            self.backoff = min(max(self.backoff * 2, 0.1), 5)
+        else:
+            self.backoff = 0
+            if latency < l.target_latency:
+                self.batch_size = min(l.max_batch_size,
+                                      self.batch_size + l.min_batch_size)
+            elif latency > l.target_latency * 2:
+                self.batch_size = max(l.min_batch_size,
+                                      self.batch_size * 3 / 4)
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                continue  # dropped, the loader raises the error
+            try:
+                self._write(batch)
+            except:
+                # keep taking batches so that nobody waits for the queue
+                self.error = sys.exc_info()
+
+    def _write(self, batch):
+        t = time.time()
+        try:
+            r, failures = self.server.set_multi(batch, return_failure=True)
+            failures = set(failures or ()) if not r else set()
+        except Exception, e:
+            log('bulkload set_multi() failed %s %s' % (self.server, e))
+            failures = set(batch)
+        self._adapt(time.time() - t, failures)
+        self.loader._done(batch, failures)
+        if self.backoff:
+            time.sleep(self.backoff)
+
+
+class BulkLoader(object):
+
+    """Write (key, value) records to the replicas of a BeansdbClient.
+
+    streams:
+        concurrent set_multi calls per server.
+    batch_size, min_batch_size, max_batch_size, target_latency:
+        a server's batch size starts at batch_size and grows while
+        set_multi takes less than target_latency seconds, it shrinks when
+        the server gets slower or fails.
+    max_rate:
+        records per second, no limit if None.
+    progress:
+        called with the stats every progress_interval seconds.
+    failed:
+        a file the failed keys are written to as they fail, one per line.
+
+    A key is written if at least client.W replicas stored it, otherwise it
+    fails: the first max_failed_keys failed keys are kept in
+    stats['failed_keys'].  Records with None values are skipped.  An
+    unexpected error of a writing thread is raised by load().
+    """
+
+    def __init__(self, client, streams=2, batch_size=100, min_batch_size=10,
+                 max_batch_size=1000, target_latency=0.1, max_rate=None,
+                 progress=None, progress_interval=10, failed=None,
+                 max_failed_keys=1000):
+        self.client = client
+        self.streams = streams
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.max_rate = max_rate
+        self.progress = progress or (lambda stats: log(format_stats(stats)))
+        self.progress_interval = progress_interval
+        self.failed = failed
+        self.max_failed_keys = max_failed_keys
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._acks = {}  # key -> [acks, replicas in flight]
+        self.stats = dict(records=0, written=0, failed=0, skipped=0,
+                          elapsed=0, throughput=0, failed_keys=[])
+
+    def _route(self, key, value):
+        ss = self.client._get_servers(key)[:self.client.N]
+        with self._lock:
+            self._acks.setdefault(key, [0, 0])[1] += len(ss)
+        for s in ss:
+            stream = self._streams.get(s.addr)
+            if stream is None:
+                stream = self._streams[s.addr] = _ServerStream(self, s)
+            if stream.add(key, value):
+                with self._lock:
+                    self._acks[key][1] -= 1
+        if not ss:
+            self._done({key: value}, set([key]))
+
+    def _done(self, batch, failures):
+        with self._lock:
+            for k in batch:
+                st = self._acks[k]
+                if k not in failures:
+                    st[0] += 1
+                st[1] -= 1
+                if st[1] <= 0:
+                    del self._acks[k]
+                    if st[0] >= self.client.W:
+                        self.stats['written'] += 1
+                    else:
+                        self._failed(k)
+
+    def _failed(self, key):
+        self.stats['failed'] += 1
+        if len(self.stats['failed_keys']) < self.max_failed_keys:
+            self.stats['failed_keys'].append(key)
+        if self.failed is not None:
+            print >>self.failed, key
+
+    def _update_stats(self, start):
+        st = self.stats
+        st['elapsed'] = time.time() - start
+        st['throughput'] = st['written'] / max(st['elapsed'], 0.001)
+        st['batch_sizes'] = dict((addr, s.batch_size)
+                                 for addr, s in self._streams.items())
+        return st
+
+    def load(self, records):
+        """Write all records, return the stats."""
+        start = last_report = time.time()
+        try:
+            for key, value in records:
+                if value is None:
+                    self.stats['skipped'] += 1
+                    continue
+                self.stats['records'] += 1
+                self._route(key, value)
+                now = time.time()
+                if self.max_rate:
+                    ahead = self.stats['records'] / float(self.max_rate) \
+                        - (now - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+                if now - last_report > self.progress_interval:
+                    self.progress(self._update_stats(start))
+                    last_report = now
+        finally:
+            for stream in self._streams.values():
+                stream.close()
+        for stream in self._streams.values():
+            stream.check()
+        return self._update_stats(start)
+
+
+def format_stats(stats):
+    return ('bulkload %(records)d records, %(written)d written, '
+            '%(failed)d failed in %(elapsed).1fs, %(throughput).0f/s'
+            % stats)
+
+
+def read_records(f, format='tsv'):
+    """Yield (key, value) records from a file.
+
+    tsv: one record per line, key and value separated by a tab.
+    marshal: marshal dumped (key, value) tuples.
+    """
+    if format == 'tsv':
+        for line in f:
+            line = line.rstrip('\n')
+            if line:
+                key, value = line.split('\t', 1)
+                yield key, value
+    elif format == 'marshal':
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                break
+    else:
+        raise ValueError('unknown format %r' % format)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] CONFIG [FILE]')
+    parser.add_option('-f', '--format', default='tsv',
+                      help='records format, tsv or marshal [%default]')
+    parser.add_option('-s', '--streams', type='int', default=2,
+                      help='concurrent writes per server [%default]')
+    parser.add_option('-b', '--batch-size', type='int', default=100,
+                      help='initial keys per set_multi [%default]')
+    parser.add_option('-r', '--max-rate', type='float',
+                      help='records per second')
+    parser.add_option('-o', '--failed',
+                      help='file to write the failed keys to')
+    parser.add_option('-i', '--interval', type='float', default=10,
+                      help='seconds between progress reports [%default]')
+    opts, args = parser.parse_args(argv)
+    if not 1 <= len(args) <= 2:
+        parser.error('wrong number of arguments')
+
+    def progress(stats):
+        print >>sys.stderr, format_stats(stats)
+
+    client = beansdb_from_config(args[0], direct=True)
+    f = open(args[1], 'rb') if len(args) > 1 else sys.stdin
+    failed = open(opts.failed, 'w') if opts.failed else None
+    loader = BulkLoader(client, streams=opts.streams,
+                        batch_size=opts.batch_size, max_rate=opts.max_rate,
+                        progress=progress, progress_interval=opts.interval,
+                        failed=failed)
+    try:
+        stats = loader.load(read_records(f, opts.format))
+    finally:
+        if failed is not None:
+            failed.close()
+    progress(stats)
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
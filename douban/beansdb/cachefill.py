@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+cachefill.py
+
+Take memcached writes which are not needed for the answer off the request
+path of CacheWrapper: filling mc with values read from db, and the delayed
+deletes which protect against racing writers.  A background thread
+batches them into set_multi and delete_multi calls.
+
+TimerWheelCleaner is a delay cleaner only, which coalesces the delayed
+deletes of keys written again and again.
+"""
+
+import os
+import time
+import threading
+import Queue
+
+from douban.beansdb import DelayCleaner, ONE_DAY, ONE_MINUTE, log
+
+FILL, CLEAN = range(2)
+
+
+class CacheFillPipeline(DelayCleaner):
+
+    """Write cache fills and delayed deletes to mc in background.
+
+    maxsize:
+        bound of the queue.  When it is full new fills are dropped, and
+        delayed deletes are sent from the calling thread, as they must not
+        be lost.
+    batch_size:
+        keys sent in one set_multi or delete_multi.
+    delay:
+        `time` of the delayed deletes.
+    """
+
+    def __init__(self, mc, maxsize=10000, batch_size=200, delay=ONE_MINUTE):
+        self.mc = mc
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.delay = delay
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def _get_queue(self):
+        if self._pid != os.getpid():
+            # the worker thread does not survive fork
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = Queue.Queue(self.maxsize)
+                    t = threading.Thread(target=self._run)
+                    t.setDaemon(True)
+                    t.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def fill(self, values, time=ONE_DAY):
+        """Set values into mc later, drop them if the queue is full."""
+        values = dict((k, v) for k, v in values.iteritems() if v is not None)
+        if not values:
+            return
+        try:
+            self._get_queue().put_nowait((FILL, values, time))
+        except Queue.Full:
+            self.dropped += len(values)
+
+    def __call__(self, key):
+        self.clean_multi([key])
+
+    def clean_multi(self, keys):
+        """Delete keys from mc with the delay."""
+        keys = list(keys)
+        try:
+            self._get_queue().put_nowait((CLEAN, keys, self.delay))
+        except Queue.Full:
+            self.mc.delete_multi(keys, time=self.delay)
+
+    def flush(self):
+        """Wait until everything queued has been sent."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def _take_batch(self, queue):
+        items = [queue.get()]
+        n = len(items[0][1])
+        while n < self.batch_size:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                break
+            items.append(item)
+            n += len(item[1])
+        return items
+
+    def _send(self, items):
+        fills = {}  # time -> values
+        cleans = {}  # time -> keys
+        for op, data, time in items:
+            if op == FILL:
+                fills.setdefault(time, {}).update(data)
+            else:
+                cleans.setdefault(time, set()).update(data)
+        cleaned = set()
+        for keys in cleans.itervalues():
+            cleaned.update(keys)
+        # a value read before a write may be stale, so fills of keys
+        # cleaned in the same batch are dropped
+        for time, values in fills.iteritems():
+            values = dict((k, v) for k, v in values.iteritems()
+                          if k not in cleaned)
+            if values:
+                self.mc.set_multi(values, time=time)
+        for time, keys in cleans.iteritems():
+            self.mc.delete_multi(list(keys), time=time)
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            items = self._take_batch(queue)
+            try:
+                self._send(items)
+            except Exception, e:
+                log('cache fill pipeline failed: %s' % e)
+            finally:
+                for i in items:
+                    queue.task_done()
+
+
+class TimerWheelCleaner(DelayCleaner):
+
+    """Delete keys from mc once more, `delay` seconds later.
+
+    Keys are kept in a hashed timer wheel of `delay / tick` slots and are
+    deleted in batches of `batch_size` keys by a background thread.  A
+    key cleaned again before it fired is moved to the later slot, so a
+    key written many times during the delay is deleted only once.
+    """
+
+    def __init__(self, mc, delay=ONE_MINUTE, tick=1, batch_size=200):
+        self.mc = mc
+        self.tick = tick
+        self.batch_size = batch_size
+        # one more slot for the partial tick before the first advance
+        self.slots = [set() for i in range(int(delay / tick) + 2)]
+        self.current = 0
+        self.coalesced = 0
+        self._pending = {}  # key -> slot
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # keys of the parent are deleted by the parent
+                    for slot in self.slots:
+                        slot.clear()
+                    self._pending.clear()
+                    t = threading.Thread(target=self._run)
+                    t.setDaemon(True)
+                    t.start()
+                    self._pid = os.getpid()
+
+    def __call__(self, key):
+        self.clean_multi([key])
+
+    def clean_multi(self, keys):
+        self._start()
+        with self._lock:
+            i = (self.current - 1) % len(self.slots)
+            for k in keys:
+                old = self._pending.get(k)
+                if old is not None:
+                    self.slots[old].discard(k)
+                    self.coalesced += 1
+                self.slots[i].add(k)
+                self._pending[k] = i
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def advance(self):
+        """Move the wheel by one tick, delete the keys which are due."""
+        with self._lock:
+            self.current = (self.current + 1) % len(self.slots)
+            keys = list(self.slots[self.current])
+            self.slots[self.current] = set()
+            for k in keys:
+                del self._pending[k]
+        self._delete(keys)
+
+    def flush(self):
+        """Delete all pending keys now."""
+        with self._lock:
+            keys = list(self._pending)
+            for slot in self.slots:
+                slot.clear()
+            self._pending.clear()
+        self._delete(keys)
+
+    def _delete(self, keys):
+        for i in range(0, len(keys), self.batch_size):
+            try:
+                self.mc.delete_multi(keys[i:i + self.batch_size])
+            except Exception, e:
+                log('timer wheel cleaner failed: %s' % e)
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+dedup.py
+
+Content addressed storage over a DoubanFS or OfflineDoubanFS.
+
+The body of a file is stored once, as a blob under the sha1 of its
+content, and every path holding it stores a short pointer to the blob.
+Writing a file which is already stored only writes the pointer, and
+rename moves the pointer.  Files written before, without a pointer, are
+still read as they are.
+
+gc() deletes the blobs no path points to, by mark and sweep over the
+pointers, as beansdb can not update a counter of references together
+with the pointer.  It marks the blobs found without one first, and a
+path taking a marked blob uploads it again.
+"""
+
+import time
+import hashlib
+
+from douban.beansdb import Deadline, log
+
+POINTER = '\0blob:'
+BLOB_PREFIX = '/.blob/'
+
+
+def blob_key(digest):
+    return BLOB_PREFIX + digest
+
+
+def _digest(pointer):
+    if isinstance(pointer, str) and pointer.startswith(POINTER) \
+            and len(pointer) == len(POINTER) + 40:
+        return pointer[len(POINTER):]
+
+
+class DedupFS(object):
+
+    """Store the files of fs once per content.
+
+    Besides the methods on files, only the attributes in `passthrough`
+    are those of fs, the others would see the pointers.
+    """
+
+    passthrough = ('timeout', 'warmup', 'update', 'clear_thread_ident')
+
+    def __init__(self, fs):
+        self.fs = fs
+
+    def __getattr__(self, name):
+        if name in self.passthrough:
+            return getattr(self.fs, name)
+        raise AttributeError(name)
+
+    def get(self, path, default=None, timeout=None):
+        deadline = Deadline.of(timeout, self.fs.timeout)
+        r = self.fs.get(path, timeout=deadline)
+        digest = _digest(r)
+        if digest is None:
+            return r if r is not None else default
+        r = self.fs.get(blob_key(digest), timeout=deadline)
+        if r is None:
+            log('dedup blob %s of %s is missing' % (digest, path))
+            return default
+        return r
+
+    def get_multi(self, paths, default=None, timeout=None):
+        deadline = Deadline.of(timeout, self.fs.timeout)
+        rs = self.fs.get_multi(paths, default, timeout=deadline)
+        digests = dict((p, _digest(r)) for p, r in rs.items())
+        blobs = self.fs.get_multi(
+            list(set(blob_key(d) for d in digests.values() if d)),
+            timeout=deadline)
+        for p, digest in digests.items():
+            if digest is None:
+                continue
+            rs[p] = blobs.get(blob_key(digest))
+            if rs[p] is None:
+                log('dedup blob %s of %s is missing' % (digest, p))
+                rs[p] = default
+        return rs
+
+    def exists(self, path, timeout=None):
+        return self.fs.exists(path, timeout=timeout)
+
+    def set(self, path, data, timeout=None):
+        if data is None:
+            return self.delete(path, timeout)
+        deadline = Deadline.of(timeout, self.fs.timeout)
+        digest = hashlib.sha1(data).hexdigest()
+        if _digest(self.fs.get(path, timeout=deadline)) == digest:
+            return True
+        key = blob_key(digest)
+        if self.fs.exists(key + '.gc', timeout=deadline) \
+                or not self.fs.exists(key, timeout=deadline):
+            # gc() may be deleting it without seeing the pointer
+            if not self.fs.set(key, data, timeout=deadline):
+                return False
+        return self.fs.set(path, POINTER + digest, timeout=deadline)
+
+    def set_multi(self, values, timeout=None):
+        deadline = Deadline.of(timeout, self.fs.timeout)
+        rs = [self.set(p, data, deadline) for p, data in values.items()]
+        return all(rs)
+
+    def delete(self, path, timeout=None):
+        return self.fs.delete(path, timeout=timeout)
+
+    def delete_multi(self, paths, timeout=None):
+        return self.fs.delete_multi(paths, timeout=timeout)
+
+    def rename(self, path, new_path, timeout=None):
+        deadline = Deadline.of(timeout, self.fs.timeout)
+        pointer = self.fs.get(path, timeout=deadline)
+        if pointer is None:
+            return False
+        if _digest(pointer) is None:
+            # a file stored before dedup, stored as a blob now
+            return self.set(new_path, pointer, deadline) \
+                and self.fs.delete(path, timeout=deadline)
+        return self.fs.set(new_path, pointer, timeout=deadline) \
+            and self.fs.delete(path, timeout=deadline)
+
+    def _walk(self, parallel):
+        """({path: version}, {digest: version}) of the stored keys."""
+        paths, blobs = {}, {}
+        for key, _, ver in self.fs.scan(parallel=parallel):
+            if not key.startswith(BLOB_PREFIX):
+                paths[key] = ver
+            elif '.' not in key[len(BLOB_PREFIX):]:
+                blobs[key[len(BLOB_PREFIX):]] = ver
+        return paths, blobs
+
+    def _pointed(self, paths, parallel):
+        """The digests pointed to by paths."""
+        digests = set()
+        for path, r in self.fs.iter_multi(paths, parallel=max(2, parallel)):
+            digest = _digest(r)
+            if digest is not None:
+                digests.add(digest)
+        return digests
+
+    def gc(self, parallel=1, grace=60):
+        """Delete the blobs no path points to, return their number.
+
+        The keys are walked by scan(), so fs must be an OfflineDoubanFS,
+        and every path is read for its pointer.  Blobs found without one
+        are marked, and kept if `grace` seconds later a path written in
+        the meantime points to them, or they were written again.  A set()
+        is expected to take less than `grace`.  A blob is deleted at the
+        revision it was listed with, so that an upload racing the
+        deletion wins.
+        """
+        paths, blobs = self._walk(parallel)
+        live = self._pointed(paths, parallel)
+        candidates = dict((d, ver) for d, ver in blobs.items()
+                          if d not in live)
+        if not candidates:
+            return 0
+        for digest in candidates:
+            self.fs.set(blob_key(digest) + '.gc', int(time.time()))
+        if grace:
+            time.sleep(grace)
+        written, blobs = self._walk(parallel)
+        live = self._pointed([p for p, ver in written.items()
+                              if paths.get(p) != ver], parallel)
+        deleted = 0
+        for digest, ver in candidates.items():
+            key = blob_key(digest)
+            if digest not in live and blobs.get(digest) == ver:
+                if all([s.delete_at(key, -(ver + 1))
+                        for s in self.fs._get_servers(key)]):
+                    deleted += 1
+            self.fs.delete(key + '.gc')
+        return deleted
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+diskcache.py
+
+A bounded cache of DoubanFS files on the local disk, in memory mapped
+segment files.
+
+Records are appended to the newest segment, and the oldest segment is
+dropped as a whole when the cache grows over its size.  Files read from
+the oldest quarter of the segments are appended again, so that files
+which are read often stay cached, close to LRU.  The index is rebuilt
+from the record headers when the cache is opened again.
+
+The segments of a cache directory are shared by the processes of the
+host.  Records are appended under an exclusive flock of its `lock` file,
+and a process catches up with the records appended by the others under
+a shared one before each use, so that a file deleted or put by one
+worker is seen by all, and the size bound is that of the host.
+
+Record layout: crc32 of key and value, time of the put, key length,
+value length as '!IIHI', then the key and the value.  A value length of
+0xffffffff marks the deletion of the key.
+"""
+
+import os
+import time
+import mmap
+import zlib
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+
+HEADER = struct.Struct('!IIHI')
+DELETED = 0xffffffff
+
+
+class _Segment(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        f = open(path, 'a+b')
+        try:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(), size)
+        finally:
+            f.close()
+        self.end = 0
+
+    def check(self, pos):
+        """Return (time, key length, value length) of the record at pos,
+        None if its crc is wrong."""
+        mm = self.mm
+        if pos + HEADER.size > len(mm):
+            return None
+        crc, t, klen, vlen = HEADER.unpack_from(mm, pos)
+        n = 0 if vlen == DELETED else vlen
+        start = pos + HEADER.size
+        if not klen or start + klen + n > len(mm) or \
+                zlib.crc32(buffer(mm, start, klen + n)) & 0xffffffff != crc:
+            return None
+        return t, klen, vlen
+
+    def records(self):
+        """Yield (key, record offset, value length) from `end` up to the
+        first bad record, and leave `end` after the last good one."""
+        pos = self.end
+        while True:
+            r = self.check(pos)
+            if r is None:
+                break
+            t, klen, vlen = r
+            start = pos + HEADER.size
+            yield self.mm[start:start + klen], pos, vlen
+            pos = start + klen + (0 if vlen == DELETED else vlen)
+        self.end = pos
+
+    def append(self, key, value):
+        """Return the offset of the record, None if it does not fit."""
+        vlen = DELETED if value is None else len(value)
+        data = key + (value or '')
+        pos = self.end
+        if pos + HEADER.size + len(data) > len(self.mm):
+            return None
+        HEADER.pack_into(self.mm, pos, zlib.crc32(data) & 0xffffffff,
+                         int(time.time()), len(key), vlen)
+        self.mm[pos + HEADER.size:pos + HEADER.size + len(data)] = data
+        self.end = pos + HEADER.size + len(data)
+        return pos
+
+
+class DiskCache(object):
+
+    """Cache of up to `max_size` bytes in `segment_size` segment files of
+    `path`, shared by the processes of the host."""
+
+    def __init__(self, path, max_size=1 << 30, segment_size=64 << 20):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_size // segment_size)
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None  # the lock file
+        self._segments = None
+        self._loads = 0
+
+    def _open(self):
+        """Open the cache in this process, called with the lock held."""
+        if self._pid == os.getpid():
+            return
+        if self._file is not None:
+            # that of the parent process, its flock is the same as ours
+            self._file.close()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._file = open(os.path.join(self.path, 'lock'), 'a')
+        self._pid = os.getpid()
+        self._segments = None
+
+    @contextmanager
+    def _locked(self, op):
+        """Hold the lock and the flock `op` of the cache, caught up with
+        the records of every process."""
+        with self._lock:
+            self._open()
+            fcntl.flock(self._file.fileno(), op)
+            try:
+                self._catch_up()
+                yield
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _load(self):
+        self._index = {}  # key -> (segment number, record offset)
+        self._segments = {}  # number -> _Segment
+        # position of the last deletion of the keys hashed to them, or
+        # the number of the load, see stamp()
+        self._loads += 1
+        self._deleted = [self._loads] * 4096
+        numbers = sorted(int(name[4:]) for name in os.listdir(self.path)
+                         if name.startswith('seg.') and name[4:].isdigit())
+        for n in numbers[-self.max_segments:] or [0]:
+            self._add_segment(n)
+            self._scan()
+        self._evict()
+
+    def _catch_up(self):
+        if self._segments is None or \
+                not os.path.exists(self._segment_path(self._current)):
+            # evicted since this process last caught up
+            self._load()
+            return
+        self._scan()
+        while os.path.exists(self._segment_path(self._current + 1)):
+            self._add_segment(self._current + 1)
+            self._scan()
+        self._evict()
+
+    def _scan(self):
+        n = self._current
+        for key, pos, vlen in self._segments[n].records():
+            self._apply(n, key, pos, vlen)
+
+    def _bucket(self, key):
+        return zlib.crc32(key) % len(self._deleted)
+
+    def _apply(self, n, key, pos, vlen):
+        if vlen == DELETED:
+            self._index.pop(key, None)
+            self._deleted[self._bucket(key)] = (n, pos)
+        else:
+            self._index[key] = (n, pos)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._pid = self._file = self._segments = None
+
+    def _segment_path(self, n):
+        return os.path.join(self.path, 'seg.%08d' % n)
+
+    def _add_segment(self, n):
+        self._segments[n] = _Segment(self._segment_path(n), self.segment_size)
+        self._current = n
+
+    def _evict(self):
+        for n in sorted(self._segments):
+            if n > self._current - self.max_segments:
+                break
+            seg = self._segments.pop(n)
+            # views of its records keep the mapping alive
+            try:
+                os.unlink(seg.path)
+            except OSError:
+                pass  # by another process
+            for key, (sn, pos) in self._index.items():
+                if sn == n:
+                    del self._index[key]
+
+    def _append(self, key, value):
+        """Append at the end of the cache, with the exclusive flock."""
+        pos = self._segments[self._current].append(key, value)
+        if pos is None:
+            self._add_segment(self._current + 1)
+            self._evict()
+            pos = self._segments[self._current].append(key, value)
+        if pos is not None:
+            self._apply(self._current, key, pos,
+                        DELETED if value is None else len(value))
+
+    def stamp(self, key):
+        """Taken before reading the value of key from elsewhere, to put()
+        it only if no process deleted the key in the meantime."""
+        with self._locked(fcntl.LOCK_SH):
+            return self._deleted[self._bucket(key)]
+
+    def put(self, key, value, stamp=None):
+        if not key or len(key) >= 1 << 16 or \
+                HEADER.size + len(key) + len(value) > self.segment_size:
+            return
+        with self._locked(fcntl.LOCK_EX):
+            if stamp is not None and stamp != self._deleted[self._bucket(key)]:
+                return
+            self._append(key, value)
+
+    def delete(self, key):
+        # even if not cached, for the puts of the values read before
+        with self._locked(fcntl.LOCK_EX):
+            self._append(key, None)
+
+    def get_view(self, key, max_age=None):
+        """A memoryview of the cached value, read from the mapping, None
+        if it was put more than max_age seconds ago."""
+        keep = None
+        with self._locked(fcntl.LOCK_SH):
+            r = self._index.get(key)
+            if r is not None:
+                n, pos = r
+                seg = self._segments[n]
+                r = seg.check(pos)
+                if r is None:
+                    # overwritten on the disk
+                    del self._index[key]
+                elif max_age is not None and r[0] + max_age < time.time():
+                    r = None
+            if r is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            t, klen, vlen = r
+            offset = pos + HEADER.size + klen
+            if n <= self._current - self.max_segments * 3 // 4:
+                # about to be evicted, keep it
+                keep = (seg.mm[offset:offset + vlen],
+                        self._deleted[self._bucket(key)])
+            view = memoryview(buffer(seg.mm, offset, vlen))
+        if keep is not None:
+            self.put(key, *keep)
+        return view
+
+    def get(self, key, max_age=None):
+        view = self.get_view(key, max_age)
+        if view is not None:
+            return view.tobytes()
+
+    def __len__(self):
+        with self._locked(fcntl.LOCK_SH):
+            return len(self._index)
+
+
+class DiskCachedFS(object):
+
+    """Read the files of a DoubanFS through a DiskCache.
+
+    Cached files are read from fs again after `ttl` seconds, to see the
+    writes of other hosts.  Besides the methods on files, only the
+    attributes in `passthrough` are those of fs, so that no write
+    misses the invalidation of the cache.
+    """
+
+    passthrough = ('timeout', 'warmup', 'update', 'clear_thread_ident',
+                   'exists', 'scan', 'gc')
+
+    def __init__(self, fs, cache, ttl=300):
+        self.fs = fs
+        self.cache = cache
+        self.ttl = ttl
+
+    def __getattr__(self, name):
+        if name in self.passthrough:
+            return getattr(self.fs, name)
+        raise AttributeError(name)
+
+    def _fetch(self, path, timeout):
+        stamp = self.cache.stamp(path)
+        r = self.fs.get(path, timeout=timeout)
+        if isinstance(r, str):
+            self.cache.put(path, r, stamp)
+        return r
+
+    def get(self, path, default=None, timeout=None):
+        r = self.cache.get(path, self.ttl)
+        if r is None:
+            r = self._fetch(path, timeout)
+            if r is None:
+                return default
+        return r
+
+    def get_view(self, path, timeout=None):
+        """A memoryview of the file, without copying it when cached."""
+        view = self.cache.get_view(path, self.ttl)
+        if view is None:
+            r = self._fetch(path, timeout)
+            if r is None:
+                return None
+            view = memoryview(r)
+        return view
+
+    def get_multi(self, paths, default=None, timeout=None):
+        rs = {}
+        for path in paths:
+            r = self.cache.get(path, self.ttl)
+            if r is not None:
+                rs[path] = r
+        missing = [p for p in paths if p not in rs]
+        if missing:
+            stamps = dict((p, self.cache.stamp(p)) for p in missing)
+            fetched = self.fs.get_multi(missing, default, timeout=timeout)
+            for path, r in fetched.items():
+                if isinstance(r, str) and r is not default:
+                    self.cache.put(path, r, stamps[path])
+            rs.update(fetched)
+        return rs
+
+    def _invalidate(self, paths):
+        for path in paths:
+            self.cache.delete(path)
+
+    def set(self, path, data, timeout=None):
+        try:
+            return self.fs.set(path, data, timeout=timeout)
+        finally:
+            self.cache.delete(path)
+
+    def set_multi(self, values, timeout=None):
+        try:
+            return self.fs.set_multi(values, timeout=timeout)
+        finally:
+            self._invalidate(values)
+
+    def delete(self, path, timeout=None):
+        try:
+            return self.fs.delete(path, timeout=timeout)
+        finally:
+            self.cache.delete(path)
+
+    def delete_multi(self, paths, timeout=None):
+        try:
+            return self.fs.delete_multi(paths, timeout=timeout)
+        finally:
+            self._invalidate(paths)
+
+    def incr(self, key, value, timeout=None):
+        try:
+            return self.fs.incr(key, value, timeout=timeout)
+        finally:
+            self.cache.delete(key)
+
+    def rename(self, path, new_path, timeout=None):
+        try:
+            return self.fs.rename(path, new_path, timeout=timeout)
+        finally:
+            self._invalidate((path, new_path))
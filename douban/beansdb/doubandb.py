@@ -1,28 +1,47 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import threading
+
 from fnv1a import get_hash as _fnv1a
 
 BUCKETS_COUNT = 16
 
-from douban.beansdb import MCStore
+from douban.beansdb import MCStore, MAX_KEYS_IN_GET_MULTI, \
+    ReadFailedError, WriteFailedError, DeleteFailedError, Deadline, bounded, \
+    log
+from douban.beansdb.parallel import Fanout, fanout, BoundedPool
 
 def fnv1a(s):
     return 0xffffffff & _fnv1a(s)
-    
+
+def _bounded_call(deadline, func, s, *args):
+    for s in bounded([s], deadline):
+        return func(s, *args)
+    raise IOError('deadline exceeded')
+
 class DoubanDB(object):
     store_cls = MCStore
     hash_space = 1<<32
     cached = True
-    def __init__(self, servers, buckets_count=BUCKETS_COUNT, N=3, W=1, R=1):
+    # each replica is written by its own threads, a slow one sheds the
+    # writes queued over write_queue instead of holding the others'
+    write_threads = 4
+    write_queue = 64
+
+    def __init__(self, servers, buckets_count=BUCKETS_COUNT, N=3, W=1, R=1,
+                 timeout=None):
         self.buckets_count = buckets_count
         self.bucket_size = self.hash_space / buckets_count
         self.servers = {}
         self.server_buckets = {}
         self.buckets = [[] for i in range(buckets_count)]
+        self._write_pools = {}
         for s,bs in servers.items():
             server = self.store_cls(s)
             self.servers[s] = server
+            self._write_pools[server] = BoundedPool(self.write_threads,
+                                                    self.write_queue)
             self.server_buckets[s] = bs
             for b in bs:
                 self.buckets[b].append(server)
@@ -31,11 +50,174 @@ class DoubanDB(object):
         self.N = N
         self.W = W
         self.R = R
+        # default seconds to wait for a quorum, None means until every
+        # replica answers
+        self.timeout = timeout
+        # calls to a replica which failed, also those still running when
+        # the write returned; a failed set_multi() to a replica counts
+        # once, whatever the number of its keys
+        self.write_failures = 0
+        self._lock = threading.Lock()
+
+    def _get_bucket(self, key):
+        return fnv1a(key) / self.bucket_size
 
     def _get_servers(self, key):
-        hash = fnv1a(key)
-        b = hash / self.bucket_size
-        return self.buckets[b]
+        return self.buckets[self._get_bucket(key)][:self.N]
+
+    def _dispatch(self, keys):
+        """Group keys by bucket, in chunks of MAX_KEYS_IN_GET_MULTI."""
+        bs = {}
+        for key in keys:
+            bs.setdefault(self._get_bucket(key), []).append(key)
+        r = []
+        for b, ks in sorted(bs.items()):
+            for i in range(0, len(ks), MAX_KEYS_IN_GET_MULTI):
+                r.append((self.buckets[b][:self.N],
+                          ks[i:i + MAX_KEYS_IN_GET_MULTI]))
+        return r
+
+    @staticmethod
+    def _read_multi(s, keys):
+        """{key: (version, value)}, both read in one request."""
+        rs = s.get_multi(list(keys) + ['?' + k for k in keys])
+        vers = dict((k, int(rs['?' + k].split(' ')[0]))
+                    for k in keys if rs.get('?' + k))
+        return dict((k, (v, rs.get(k) if v > 0 else None))
+                    for k, v in vers.iteritems())
+
+    @classmethod
+    def _read(cls, s, key):
+        return cls._read_multi(s, [key]).get(key, (0, None))
+
+    def _write_pool(self, args):
+        return self._write_pools[args[2]]
+
+    def _write(self, s, op, *args):
+        """getattr(s, op)(*args), counting and logging the failures."""
+        try:
+            r = getattr(s, op)(*args)
+        except Exception, e:
+            self._write_failed(s, op, e)
+            raise
+        if not (r[0] if isinstance(r, tuple) else r):
+            self._write_failed(s, op, r)
+        return r
+
+    def _write_failed(self, s, op, r):
+        with self._lock:
+            self.write_failures += 1
+        log('doubandb %s to %s failed: %r' % (op, s, r))
+
+    @property
+    def shed_writes(self):
+        """Replica writes dropped as their replica had too many queued."""
+        return sum(p.rejected for p in self._write_pools.itervalues())
+
+    def get(self, key, default=None, timeout=None):
+        """Read from all replicas, return the newest of the first R answers."""
+        ss = self._get_servers(key)
+        deadline = Deadline.of(timeout, self.timeout)
+        f = fanout(_bounded_call, [(deadline, self._read, s, key) for s in ss],
+                   self.R, deadline.remaining())
+        rs = [r for _, r in f.items()]
+        if len(rs) < self.R:
+            raise ReadFailedError(key, ss)
+        # deleted keys have negative revisions
+        ver, value = max(rs, key=lambda r: abs(r[0]))
+        if ver <= 0 or value is None:
+            return default
+        return value
+
+    def get_multi(self, keys, default=None, timeout=None):
+        deadline = Deadline.of(timeout, self.timeout)
+        fs = [(ss, ks, Fanout(_bounded_call, [(deadline, self._read_multi, s, ks)
+                                              for s in ss]))
+              for ss, ks in self._dispatch(keys)]
+        rs = {}
+        for ss, ks, f in fs:
+            if f.wait(self.R, deadline.remaining()) < self.R:
+                raise ReadFailedError(ks, ss)
+            newest = {}
+            for _, r in f.items():
+                for k, (ver, value) in r.iteritems():
+                    if k not in newest or abs(ver) > abs(newest[k][0]):
+                        newest[k] = (ver, value)
+            for k in ks:
+                ver, value = newest.get(k, (0, None))
+                rs[k] = value if ver > 0 and value is not None else default
+        return rs
+
+    def set(self, key, value, rev=0, timeout=None):
+        """Write to all replicas, return once W of them succeeded.
+
+        The remaining replicas are written in background.
+        """
+        if value is None:
+            return self.delete(key, timeout)
+        ss = self._get_servers(key)
+        deadline = Deadline.of(timeout, self.timeout)
+        f = fanout(_bounded_call,
+                   [(deadline, self._write, s, 'set', key, value, rev)
+                    for s in ss],
+                   self.W, deadline.remaining(), is_ok=bool,
+                   pool=self._write_pool)
+        if f.succeeded < self.W:
+            raise WriteFailedError(key, ss)
+        return True
+
+    def _write_multi(self, op, keys, batch, deadline, error):
+        """Send `op` of batch(ks) to the replicas of each bucket of keys,
+        raise `error` with the keys written to fewer than W of them."""
+        def write(s, ks):
+            return self._write(s, op, batch(ks), True)
+
+        fs = [(ss, ks, Fanout(_bounded_call,
+                              [(deadline, write, s, ks) for s in ss],
+                              is_ok=lambda r: r[0], pool=self._write_pool))
+              for ss, ks in self._dispatch(keys)]
+        all_failures = []
+        for ss, ks, f in fs:
+            if f.wait(self.W, deadline.remaining()) >= self.W:
+                continue
+            # count acks per key from partially failed batches
+            acks = dict((k, 0) for k in ks)
+            for _, (r, failures) in f.items():
+                failed = set(failures or ()) if not r else ()
+                for k in ks:
+                    if k not in failed:
+                        acks[k] += 1
+            all_failures += [k for k in ks if acks[k] < self.W]
+        if all_failures:
+            raise error(all_failures, [ss for ss, _, _ in fs])
+
+    def set_multi(self, values, timeout=None):
+        deadline = Deadline.of(timeout, self.timeout)
+        to_delete = [k for k, v in values.iteritems() if v is None]
+        if to_delete:
+            self.delete_multi(to_delete, deadline)
+        values = dict((k, v) for k, v in values.iteritems() if v is not None)
+        self._write_multi('set_multi', values.keys(),
+                          lambda ks: dict((k, values[k]) for k in ks),
+                          deadline, WriteFailedError)
+        return True
+
+    def delete(self, key, timeout=None):
+        ss = self._get_servers(key)
+        deadline = Deadline.of(timeout, self.timeout)
+        f = fanout(_bounded_call,
+                   [(deadline, self._write, s, 'delete', key) for s in ss],
+                   self.W, deadline.remaining(), is_ok=bool,
+                   pool=self._write_pool)
+        if f.succeeded < self.W:
+            raise DeleteFailedError(key, ss)
+        return True
+
+    def delete_multi(self, keys, timeout=None):
+        self._write_multi('delete_multi', keys, lambda ks: ks,
+                          Deadline.of(timeout, self.timeout),
+                          DeleteFailedError)
+        return True
 
     def __getattr__(self, name):
         if name in ['exists', 'gets']:
@@ -1,12 +1,11 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import cmemcached
-from douban.beansdb import MCStore, BeansdbClient, BeansDBProxy
-from douban.utils import ThreadedObject
+from douban.beansdb import MCStore, BeansdbClient, BeansDBProxy, Deadline
 from douban.utils.config import read_config
 
 def connect(server, **kwargs):
+    import cmemcached
     c = cmemcached.Client([server], do_split=0, **kwargs)
     c.set_behavior(cmemcached.BEHAVIOR_CONNECT_TIMEOUT, 100)   # 0.1 s
     c.set_behavior(cmemcached.BEHAVIOR_POLL_TIMEOUT, 5*1000)  # 5 s
@@ -16,29 +15,30 @@ def connect(server, **kwargs):
     return c
 
 class FSStore(MCStore):
-    def __init__(self, server, threaded=True, **kwargs):
-        self.addr = server
-        if threaded:
-            self.mc = ThreadedObject(connect, server, **kwargs)
-        else:
-            self.mc = connect(server, **kwargs)
+    connector = staticmethod(connect)
+    poll_timeout = 5000
 
 class DoubanFS(BeansDBProxy):
     store_cls = FSStore
 
-    def rename(self, path, new_path):
-        data = self.get(path)
-        return data and self.set(new_path, data) and self.delete(path)
+    def rename(self, path, new_path, timeout=None):
+        deadline = Deadline.of(timeout, self.timeout)
+        data = self.get(path, timeout=deadline)
+        return data and self.set(new_path, data, timeout=deadline) \
+            and self.delete(path, timeout=deadline)
 
 class OfflineDoubanFS(BeansdbClient):
 
     store_cls = FSStore
 
-    def rename(self, path, new_path):
-        data = self.get(path)
-        return data and self.set(new_path, data) and self.delete(path)
+    def rename(self, path, new_path, timeout=None):
+        deadline = Deadline.of(timeout, self.timeout)
+        data = self.get(path, timeout=deadline)
+        return data and self.set(new_path, data, timeout=deadline) \
+            and self.delete(path, timeout=deadline)
 
-def doubanfs_from_config(config, offline=False, **kwargs):
+def doubanfs_from_config(config, offline=False, dedup=False, disk_cache=None,
+                         **kwargs):
     if isinstance(config, basestring):
         config = read_config(config, 'doubanfs')
 
@@ -46,9 +46,20 @@ def doubanfs_from_config(config, offline=False, **kwargs):
         offline = config['offline']
 
     if not isinstance(config, list):
+        if offline and 'buckets_count' in config:
+            kwargs.setdefault('buckets_count', config['buckets_count'])
         config = config.get(offline and 'servers' or 'proxies')
 
     if offline:
-        return OfflineDoubanFS(config, **kwargs)
+        fs = OfflineDoubanFS(config, **kwargs)
     else:
-        return DoubanFS(config, **kwargs)
+        fs = DoubanFS(config, **kwargs)
+    if dedup:
+        from douban.beansdb.dedup import DedupFS
+        fs = DedupFS(fs)
+    if disk_cache is not None:
+        from douban.beansdb.diskcache import DiskCache, DiskCachedFS
+        if isinstance(disk_cache, basestring):
+            disk_cache = DiskCache(disk_cache)
+        fs = DiskCachedFS(fs, disk_cache)
+    return fs
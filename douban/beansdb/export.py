@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+export.py
+
+Export the data of a BeansdbClient to a local snapshot file and read it
+back.
+
+Every bucket is walked and fetched from one healthy replica, several
+buckets at a time.  The snapshot is an append-only data file of
+records, with an index file of (key hash, offset) entries next to it and a
+checkpoint file which allows an interrupted export to be resumed.  When
+an export stops the index is sorted into a `.idx.sorted` file, which
+readers map and binary search.
+
+Record layout: crc32, key length, value length, version, encoding as
+'!IHIiB', then the key and the (optionally compressed) value.
+
+Usage: beansdb-export [options] CONFIG PATH
+"""
+
+import os
+import sys
+import mmap
+import time
+import zlib
+import json
+import heapq
+import struct
+import marshal
+import cPickle
+import tempfile
+from itertools import islice
+from optparse import OptionParser
+
+from douban.beansdb import beansdb_from_config, bucket_depth, fnv1a, log, \
+    MAX_KEYS_IN_GET_MULTI
+from douban.beansdb.parallel import iter_workers
+from douban.beansdb.scan import walk, healthy_replica, DONE
+
+MAGIC = 'BDBSNAP1'
+RECORD = struct.Struct('!IHIiB')
+INDEX = struct.Struct('!IQ')
+
+ENC_STR, ENC_MARSHAL, ENC_PICKLE = range(3)
+
+CODECS = {
+    'none': (lambda d: d, lambda d: d),
+    'zlib': (zlib.compress, zlib.decompress),
+}
+try:
+    import snappy
+    CODECS['snappy'] = (snappy.compress, snappy.decompress)
+except ImportError:
+    pass
+
+
+def encode(value):
+    if isinstance(value, str):
+        return ENC_STR, value
+    try:
+        return ENC_MARSHAL, marshal.dumps(value)
+    except ValueError:
+        return ENC_PICKLE, cPickle.dumps(value, -1)
+
+
+def _entries(f, n=None):
+    """Yield the packed index entries of a file, up to n of them."""
+    while n is None or n > 0:
+        e = f.read(INDEX.size)
+        if len(e) < INDEX.size:
+            return
+        if n is not None:
+            n -= 1
+        yield e
+
+
+def sort_index(path, chunk=1 << 20):
+    """Sort the checkpointed index entries of a snapshot into its
+    `.idx.sorted` file, `chunk` entries at a time in memory."""
+    ckpt = SnapshotWriter.read_checkpoint(path) or {}
+    size = ckpt.get('index')
+    runs = []
+    with open(path + '.idx', 'rb') as f:
+        entries = _entries(f, size / INDEX.size if size is not None else None)
+        while True:
+            # packed big endian, the entries sort by (hash, offset)
+            part = sorted(islice(entries, chunk))
+            if not part:
+                break
+            run = tempfile.TemporaryFile()
+            run.write(''.join(part))
+            run.seek(0)
+            runs.append(run)
+    tmp = path + '.idx.sorted.tmp'
+    with open(tmp, 'wb') as out:
+        for e in heapq.merge(*[_entries(run) for run in runs]):
+            out.write(e)
+    for run in runs:
+        run.close()
+    os.rename(tmp, path + '.idx.sorted')
+
+
+def decode(enc, data):
+    if enc == ENC_STR:
+        return data
+    elif enc == ENC_MARSHAL:
+        return marshal.loads(data)
+    return cPickle.loads(data)
+
+
+class SnapshotWriter(object):
+
+    """Append records to a snapshot, resuming from its checkpoint."""
+
+    def __init__(self, path, codec='zlib'):
+        self.path = path
+        ckpt = self.read_checkpoint(path)
+        if ckpt:
+            self.codec = ckpt['codec']
+            self.cursor = ckpt['cursor']
+            self.data = open(path, 'r+b')
+            self.data.truncate(ckpt['data'])
+            self.index = open(path + '.idx', 'r+b')
+            self.index.truncate(ckpt['index'])
+            self.data.seek(0, 2)
+            self.index.seek(0, 2)
+        else:
+            self.codec = codec
+            self.cursor = ''
+            self.data = open(path, 'wb')
+            self.index = open(path + '.idx', 'wb')
+            self.data.write(MAGIC + chr(len(codec)) + codec)
+        self.compress = CODECS[self.codec][0]
+
+    @staticmethod
+    def read_checkpoint(path):
+        try:
+            with open(path + '.ckpt') as f:
+                return json.load(f)
+        except IOError:
+            pass
+
+    def append(self, key, ver, value):
+        enc, data = encode(value)
+        data = self.compress(data)
+        offset = self.data.tell()
+        self.data.write(RECORD.pack(zlib.crc32(key + data) & 0xffffffff,
+                                    len(key), len(data), ver, enc))
+        self.data.write(key)
+        self.data.write(data)
+        self.index.write(INDEX.pack(fnv1a(key), offset))
+
+    def checkpoint(self, cursor):
+        """Make the appended records durable, resume after cursor."""
+        self.cursor = cursor
+        for f in (self.data, self.index):
+            f.flush()
+            os.fsync(f.fileno())
+        tmp = self.path + '.ckpt.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(codec=self.codec, cursor=cursor,
+                           data=self.data.tell(), index=self.index.tell()), f)
+        os.rename(tmp, self.path + '.ckpt')
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class SnapshotReader(object):
+
+    """Random lookup and iteration over a snapshot.
+
+    Lookups binary search the mapped sorted index, which is made when the
+    export stops, or by sort_index().
+    """
+
+    def __init__(self, path):
+        self.data = open(path, 'rb')
+        if self.data.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a beansdb snapshot: %s' % path)
+        self.codec = self.data.read(ord(self.data.read(1)))
+        self.decompress = CODECS[self.codec][1]
+        self.start = self.data.tell()
+        ckpt = SnapshotWriter.read_checkpoint(path) or {}
+        self.end = ckpt.get('data')
+        try:
+            self._sorted = open(path + '.idx.sorted', 'rb')
+        except IOError:
+            raise ValueError('index of %s not sorted, run sort_index()'
+                             % path)
+        size = os.fstat(self._sorted.fileno()).st_size
+        if ckpt.get('index') is not None and size != ckpt['index']:
+            raise ValueError('sorted index of %s is stale, run sort_index()'
+                             % path)
+        self.count = size / INDEX.size
+        self.index = mmap.mmap(self._sorted.fileno(), 0,
+                               access=mmap.ACCESS_READ) if size else ''
+
+    def __len__(self):
+        return self.count
+
+    def _offsets(self, h):
+        """Offsets of the records whose keys hash to h, in order."""
+        prefix = struct.pack('!I', h)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            pos = mid * INDEX.size
+            if self.index[pos:pos + 4] < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        offsets = []
+        pos = lo * INDEX.size
+        while pos < len(self.index) and self.index[pos:pos + 4] == prefix:
+            offsets.append(INDEX.unpack_from(self.index, pos)[1])
+            pos += INDEX.size
+        return offsets
+
+    def _read(self, offset):
+        self.data.seek(offset)
+        crc, klen, vlen, ver, enc = RECORD.unpack(self.data.read(RECORD.size))
+        key = self.data.read(klen)
+        data = self.data.read(vlen)
+        if zlib.crc32(key + data) & 0xffffffff != crc:
+            raise ValueError('corrupted record at %d' % offset)
+        return key, ver, enc, data
+
+    def get(self, key, default=None):
+        # the latest record of the key wins
+        for offset in reversed(self._offsets(fnv1a(key))):
+            k, ver, enc, data = self._read(offset)
+            if k == key:
+                return decode(enc, self.decompress(data))
+        return default
+
+    def __iter__(self):
+        """Yield (key, version, value) of all checkpointed records."""
+        offset = self.start
+        end = self.end
+        if end is None:
+            end = os.fstat(self.data.fileno()).st_size
+        while offset < end:
+            key, ver, enc, data = self._read(offset)
+            offset += RECORD.size + len(key) + len(data)
+            yield key, ver, decode(enc, self.decompress(data))
+
+    def close(self):
+        if self.count:
+            self.index.close()
+        self._sorted.close()
+        self.data.close()
+
+
+class Exporter(object):
+
+    """Export the buckets of a BeansdbClient into a snapshot.
+
+    `parallel` buckets are exported at the same time, each from one
+    replica, fetching values with get_multi of up to `batch_size` keys and
+    their versions.  Keys listed but gone when fetched are counted in
+    stats['missing'].
+    """
+
+    def __init__(self, client, path, parallel=4, batch_size=200,
+                 codec='zlib', checkpoint_interval=10, progress=None):
+        self.client = client
+        self.path = path
+        self.parallel = parallel
+        self.batch_size = min(batch_size, MAX_KEYS_IN_GET_MULTI)
+        self.codec = codec
+        self.checkpoint_interval = checkpoint_interval
+        self.progress = progress or (lambda stats: log(
+            'export %(keys)d keys, %(buckets)d buckets done in %(elapsed).1fs'
+            % stats))
+        self.stats = dict(keys=0, buckets=0, missing=0, elapsed=0)
+
+    def _fetch(self, s, keys):
+        """[(key, version, value)] of the keys still there, the version
+        read with the value."""
+        rs = s.get_multi(keys + ['?' + k for k in keys])
+        records = []
+        for k in keys:
+            meta = rs.get('?' + k)
+            ver = int(meta.split(' ')[0]) if meta else 0
+            if ver > 0 and rs.get(k) is not None:
+                records.append((k, ver, rs[k]))
+        return records
+
+    def _export_bucket(self, task):
+        """Yield (bucket, leaf, records, missing) of the leaves."""
+        b, prefix, cursor = task
+        s = healthy_replica(self.client._get_bucket_servers(b), prefix)
+        # a key and its `?` meta in each request
+        n = max(self.batch_size / 2, 1)
+        for leaf, items in walk([s], prefix, cursor):
+            keys = [k for k, _, ver in items if ver > 0]
+            records = []
+            for i in range(0, len(keys), n):
+                records += self._fetch(s, keys[i:i + n])
+            missing = len(keys) - len(records)
+            if missing:
+                log('export %d keys of %s gone from %s' % (missing, leaf, s))
+            yield b, leaf, records, missing
+        yield b, prefix + DONE, [], 0
+
+    def run(self, buckets=None):
+        """Export (the rest of) the buckets, return the stats."""
+        start = time.time()
+        self.client._check_update()
+        depth = bucket_depth(self.client.buckets_count)
+        writer = SnapshotWriter(self.path, self.codec)
+        progress = dict((int(c[:depth], 16), c)
+                        for c in writer.cursor.split(',') if c)
+        if buckets is None:
+            buckets = range(self.client.buckets_count)
+        todo = []
+        for b in buckets:
+            c = progress.get(b)
+            if not (c and c.endswith(DONE)):
+                todo.append((b, '%0*x' % (depth, b), c))
+        try:
+            last = time.time()
+            for b, leaf, records, missing in iter_workers(
+                    self._export_bucket, todo, self.parallel,
+                    self.parallel * 2):
+                for k, ver, value in records:
+                    writer.append(k, ver, value)
+                self.stats['keys'] += len(records)
+                self.stats['missing'] += missing
+                progress[b] = leaf
+                if leaf.endswith(DONE):
+                    self.stats['buckets'] += 1
+                if time.time() - last > self.checkpoint_interval:
+                    writer.checkpoint(
+                        ','.join(v for _, v in sorted(progress.items())))
+                    self.stats['elapsed'] = time.time() - start
+                    self.progress(self.stats)
+                    last = time.time()
+            writer.checkpoint(','.join(v for _, v in sorted(progress.items())))
+        finally:
+            writer.close()
+            sort_index(self.path)
+        self.stats['elapsed'] = time.time() - start
+        return self.stats
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] CONFIG PATH')
+    parser.add_option('-p', '--parallel', type='int', default=4,
+                      help='buckets exported at the same time [%default]')
+    parser.add_option('-b', '--batch-size', type='int', default=200,
+                      help='keys per get_multi [%default]')
+    parser.add_option('-c', '--codec', default='zlib',
+                      help='compression, one of %s [%%default]'
+                      % ', '.join(sorted(CODECS)))
+    parser.add_option('--buckets',
+                      help='comma separated buckets to export, all if not given')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('wrong number of arguments')
+
+    def progress(stats):
+        print >>sys.stderr, ('%(keys)d keys, %(buckets)d buckets done'
+                             ' in %(elapsed).1fs' % stats)
+
+    client = beansdb_from_config(args[0], direct=True)
+    buckets = opts.buckets and [int(b) for b in opts.buckets.split(',')]
+    exporter = Exporter(client, args[1], parallel=opts.parallel,
+                        batch_size=opts.batch_size, codec=opts.codec,
+                        progress=progress)
+    progress(exporter.run(buckets))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
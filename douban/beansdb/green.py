@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+green.py
+
+A MCStore speaking the memcached text protocol over plain Python sockets,
+for gevent.
+
+cmemcached blocks the whole process while it waits for a server, and
+ThreadedObject keeps a connection per thread.  With the sockets patched by
+gevent.monkey.patch_all(), called before the stores are made, the requests
+of the stores made by cooperative() only block their own greenlet, and the
+greenlets share a small pool of connections per server.
+
+    from gevent import monkey; monkey.patch_all()
+    from douban.beansdb import BeansDBProxy
+    from douban.beansdb.green import cooperative
+
+    db = cooperative(BeansDBProxy)(proxies, pool_size=8)
+
+The values are encoded with douban.beansdb.serializer, whose flags are the
+ones of cmemcached.
+"""
+
+import socket
+import threading
+import Queue
+from contextlib import contextmanager
+
+from douban.beansdb import MCStore
+from douban.beansdb.serializer import default_serializer
+
+MAX_KEY_LENGTH = 250
+ERR_BAD_KEY = 33  # MEMCACHED_BAD_KEY_PROVIDED
+ERR_PROTOCOL = 8  # MEMCACHED_PROTOCOL_ERROR
+
+
+def _valid(key):
+    return 0 < len(key) <= MAX_KEY_LENGTH and not any(
+        c in key for c in ' \r\n\0')
+
+
+class Connection(object):
+
+    def __init__(self, addr, connect_timeout):
+        host, port = addr.rsplit(':', 1)
+        self.sock = socket.create_connection((host, int(port)),
+                                             connect_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.f = self.sock.makefile('rb')
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        line = self.f.readline()
+        if not line.endswith('\r\n'):
+            raise IOError(ERR_PROTOCOL, 'connection closed')
+        line = line[:-2]
+        if line in ('ERROR', ) or line.startswith('CLIENT_ERROR') \
+                or line.startswith('SERVER_ERROR'):
+            raise IOError(ERR_PROTOCOL, line)
+        return line
+
+    def read(self, n):
+        data = self.f.read(n + 2)
+        if len(data) != n + 2 or not data.endswith('\r\n'):
+            raise IOError(ERR_PROTOCOL, 'connection closed')
+        return data[:-2]
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+
+class PooledMC(object):
+
+    """The part of the cmemcached client used by MCStore, for one server.
+
+    Requests take a connection from a pool of up to `pool_size`, connected
+    when first needed.  A connection goes back to the pool only once the
+    reply was read in full, it is closed when the request is interrupted
+    by anything, gevent.Timeout included.  Like cmemcached, failed
+    requests return None or False and leave the error in
+    get_last_error() and get_last_strerror(), which are kept per thread,
+    or per greenlet with gevent.
+    """
+
+    def __init__(self, addr, pool_size=8, connect_timeout=0.3, timeout=3,
+                 serializer=None):
+        self.addr = addr
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.serializer = serializer or default_serializer()
+        self._pool = Queue.LifoQueue(pool_size)
+        for i in range(pool_size):
+            self._pool.put(None)
+        self._local = threading.local()
+
+    def close(self):
+        """Close the idle connections."""
+        idle = []
+        while True:
+            try:
+                idle.append(self._pool.get_nowait())
+            except Queue.Empty:
+                break
+        for conn in idle:
+            if conn is not None:
+                conn.close()
+            self._pool.put(None)
+
+    def get_last_error(self):
+        return getattr(self._local, 'error', (0, ''))[0]
+
+    def get_last_strerror(self):
+        return getattr(self._local, 'error', (0, ''))[1]
+
+    @contextmanager
+    def time_limit(self, seconds):
+        """Wait no longer than seconds for each request made inside."""
+        old = getattr(self._local, 'timeout', None)
+        self._local.timeout = seconds
+        try:
+            yield
+        finally:
+            self._local.timeout = old
+
+    def _request(self, keys, func, failed=None):
+        """func(connection), or failed on errors."""
+        self._local.error = (0, '')
+        if not all(_valid(k) for k in keys):
+            self._local.error = (ERR_BAD_KEY, 'bad key')
+            return failed
+        timeout = getattr(self._local, 'timeout', None)
+        conn = self._pool.get()
+        done = False
+        try:
+            if conn is None:
+                conn = Connection(self.addr, self.connect_timeout)
+            conn.sock.settimeout(min(timeout, self.timeout)
+                                 if timeout is not None else self.timeout)
+            r = func(conn)
+            done = True
+            return r
+        except (IOError, socket.error), e:
+            self._local.error = (e.errno or ERR_PROTOCOL,
+                                 e.strerror or str(e))
+            return failed
+        finally:
+            if not done and conn is not None:
+                # a reply may be left unread on it
+                try:
+                    conn.close()
+                except socket.error:
+                    pass
+                conn = None
+            self._pool.put(conn)
+
+    # reads
+
+    def _retrieve(self, conn, keys):
+        conn.send('get %s\r\n' % ' '.join(keys))
+        rs = {}
+        while True:
+            line = conn.readline()
+            if line == 'END':
+                return rs
+            parts = line.split(' ')
+            if parts[0] != 'VALUE' or len(parts) < 4:
+                raise IOError(ERR_PROTOCOL, line)
+            rs[parts[1]] = (conn.read(int(parts[3])), int(parts[2]))
+
+    def get_raw(self, key):
+        r = self._request([key], lambda conn: self._retrieve(conn, [key]))
+        return (r or {}).get(key, (None, 0))
+
+    def get(self, key):
+        return self.serializer.loads(*self.get_raw(key))
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        rs = {}
+        if not keys:
+            return rs
+        raw = self._request(keys, lambda conn: self._retrieve(conn, keys))
+        for k, (data, flag) in (raw or {}).iteritems():
+            try:
+                rs[k] = self.serializer.loads(data, flag)
+            except ValueError:
+                pass
+        return rs
+
+    # writes
+
+    def _replies(self, conn, commands, ok):
+        """Send the commands at once, return the indexes of the ones whose
+        reply is not `ok`."""
+        conn.send(''.join(commands))
+        return [i for i in range(len(commands)) if conn.readline() != ok]
+
+    def _store(self, items, return_failure):
+        """items is [(key, data, rev, flag)]."""
+        keys = [k for k, _, _, _ in items]
+        commands = ['set %s %d %d %d\r\n%s\r\n' % (k, flag, rev, len(data),
+                                                   data)
+                    for k, data, rev, flag in items]
+        failed = self._request(keys, lambda conn: self._replies(
+            conn, commands, 'STORED'), range(len(items)))
+        failed = [keys[i] for i in failed]
+        return (not failed, failed) if return_failure else not failed
+
+    def set_raw(self, key, data, rev=0, flag=0):
+        return self._store([(key, data, rev, flag)], False)
+
+    def set(self, key, value, rev=0):
+        data, flag = self.serializer.dumps(value)
+        return self.set_raw(key, data, rev, flag)
+
+    def set_multi(self, values, return_failure=False):
+        items = []
+        for k, v in values.iteritems():
+            data, flag = self.serializer.dumps(v)
+            items.append((k, data, 0, flag))
+        return self._store(items, return_failure)
+
+    def delete_multi(self, keys, return_failure=False):
+        keys = list(keys)
+        failed = self._request(keys, lambda conn: self._replies(
+            conn, ['delete %s\r\n' % k for k in keys], 'DELETED'),
+            range(len(keys)))
+        failed = [keys[i] for i in failed]
+        return (not failed, failed) if return_failure else not failed
+
+    def delete(self, key):
+        return self.delete_multi([key])
+
+    def incr(self, key, value):
+        def incr(conn):
+            conn.send('incr %s %d\r\n' % (key, value))
+            r = conn.readline()
+            return int(r) if r.isdigit() else None
+        return self._request([key], incr)
+
+
+class GreenMCStore(MCStore):
+
+    """A MCStore on a PooledMC, the kwargs of the clients going to it."""
+
+    connector = PooledMC
+
+    def __init__(self, addr, threaded=False, **kwargs):
+        kwargs.setdefault('timeout', self.poll_timeout / 1000.0)
+        # the pool is shared by the threads or greenlets
+        MCStore.__init__(self, addr, threaded=False, **kwargs)
+
+    @contextmanager
+    def time_limit(self, seconds):
+        with self.mc.time_limit(seconds):
+            yield
+
+
+def cooperative(cls):
+    """A subclass of the client class cls, such as BeansDBProxy,
+    BeansdbClient or DoubanFS, using GreenMCStore."""
+    store_cls = type('Green' + cls.store_cls.__name__,
+                     (GreenMCStore, cls.store_cls), {})
+    return type('Green' + cls.__name__, (cls, ),
+                dict(store_cls=store_cls, threaded=False))
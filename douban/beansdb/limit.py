@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+limit.py
+
+Adaptive limits of the requests in flight to one server, and of the
+retries of failed requests.
+
+A slow server would otherwise take every worker thread which happens to
+ask it something.  With a limit, the requests over it wait shortly and
+then fail at once, so that the clients try another replica or proxy.
+The retry budget keeps that failover from multiplying the traffic when
+many requests fail at once.
+"""
+
+import time
+import threading
+
+
+class AIMDLimit(object):
+
+    """Additive increase, multiplicative decrease concurrency limit.
+
+    The limit grows by one every `limit` requests which were answered
+    within `target_latency` seconds while it was being used, and is
+    multiplied by `backoff` at a slower or failed request, at most once
+    every `backoff_interval` seconds, so that a pause slowing all the
+    requests in flight at once counts once.  Requests of several keys
+    have `per_key_latency` seconds more for every other key.  The
+    defaults shed load only when the server is much slower than a WAN
+    round trip or a collection pause.
+
+    max_wait:
+        seconds a request waits for a free slot.
+    max_waiting:
+        requests allowed to wait, more are rejected at once.
+    """
+
+    def __init__(self, initial=20, min_limit=1, max_limit=200,
+                 target_latency=0.5, per_key_latency=0.002, backoff=0.9,
+                 backoff_interval=1, max_wait=0.05, max_waiting=50):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.per_key_latency = per_key_latency
+        self.backoff = backoff
+        self.backoff_interval = backoff_interval
+        self._backed_off = 0
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.inflight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, return False if none is free in time."""
+        with self._cond:
+            if self.inflight >= int(self.limit):
+                if self.waiting >= self.max_waiting or not self.max_wait:
+                    self.rejected += 1
+                    return False
+                end = time.time() + self.max_wait
+                self.waiting += 1
+                try:
+                    while self.inflight >= int(self.limit):
+                        remaining = end - time.time()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.inflight += 1
+            return True
+
+    def release(self, latency, ok=True, size=1):
+        """Give back a slot taken by a request of `size` keys which took
+        `latency` seconds."""
+        target = self.target_latency + self.per_key_latency * (size - 1)
+        with self._cond:
+            self.inflight -= 1
+            if not ok or latency > target:
+                now = time.time()
+                if now - self._backed_off >= self.backoff_interval:
+                    self.limit = max(self.min_limit,
+                                     self.limit * self.backoff)
+                    self._backed_off = now
+            elif self.inflight * 2 >= self.limit:
+                # grow only while the limit is what bounds the load
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify()
+
+
+class RetryBudget(object):
+
+    """Token bucket limiting retries to a share of the requests.
+
+    Every request adds `ratio` token and every retry takes one, so that
+    when everything fails there are at most `ratio` retries per request,
+    after a burst of up to `max_tokens` retries.
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.requests += 1
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Take a token for a retry, return False if there is none."""
+        with self._lock:
+            if self.tokens >= 1 - 1e-9:  # float sum of the deposits
+                self.tokens -= 1
+                self.retries += 1
+                return True
+            self.exhausted += 1
+            return False
+
+
+class RateLimit(object):
+
+    """Block callers to keep a rate, in units per second.
+
+    Up to `burst` units, a second worth by default, may be taken at once
+    after a pause.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else self.rate
+        self.tokens = self.burst
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self, n=1):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
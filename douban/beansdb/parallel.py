@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+parallel.py
+
+Fan out calls to several backends and wait for only as many answers as
+needed.  Calls which are still running when the caller returns keep going
+in the background pool.
+"""
+
+import os
+import time
+import threading
+import Queue
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+POOL_SIZE = 32
+OUTER = 'outer'  # calls which fan out again
+
+_pools = {}
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(name=None):
+    """Return the shared thread pool, or the one called name, creating
+    new ones after fork.
+
+    A call which itself fans out must run in another pool than the calls
+    it waits for, the OUTER one, or the pool could be filled by callers
+    waiting on calls queued behind them.  Nothing run in the OUTER pool
+    may submit to it.
+    """
+    global _pool_pid
+    pid = os.getpid()
+    pool = _pools.get(name)
+    if pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool_pid != pid:
+                _pools.clear()
+                _pool_pid = pid
+            pool = _pools.get(name)
+            if pool is None:
+                pool = _pools[name] = ThreadPool(POOL_SIZE)
+    return pool
+
+
+class BoundedPool(object):
+
+    """A few threads with a bounded queue of calls, made again after fork.
+
+    apply_async() raises Queue.Full instead of queueing more than
+    `queue_size` calls behind the `size` running ones, so that a slow
+    backend given its own BoundedPool sheds calls instead of holding
+    threads shared with the others.
+    """
+
+    def __init__(self, size=4, queue_size=64):
+        self.size = size
+        self.queue_size = queue_size
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _get_pool(self):
+        pid = os.getpid()
+        if self._pool is None or self._pid != pid:
+            with self._lock:
+                if self._pool is None or self._pid != pid:
+                    self._slots = threading.Semaphore(
+                        self.size + self.queue_size)
+                    self._pool = ThreadPool(self.size)
+                    self._pid = pid
+        return self._pool
+
+    def apply_async(self, func, args=()):
+        pool = self._get_pool()
+        slots = self._slots
+        if not slots.acquire(False):
+            with self._lock:
+                self.rejected += 1
+            raise Queue.Full('%d calls pending' % (self.size + self.queue_size))
+
+        def run():
+            try:
+                return func(*args)
+            finally:
+                slots.release()
+        return pool.apply_async(run)
+
+
+class Fanout(object):
+
+    """Run `func(*args)` for every args in `args_list` concurrently.
+
+    A call counts as succeeded if it does not raise and `is_ok(result)` is
+    true.  Results and exceptions are kept by the index of their args.
+    `pool` runs the calls, the shared pool by default, or is a function of
+    the args of a call returning the pool to run it in.  A call the pool
+    rejects with Queue.Full fails with that exception.
+    """
+
+    def __init__(self, func, args_list, is_ok=None, pool=None):
+        self.args_list = list(args_list)
+        self.is_ok = is_ok or (lambda r: True)
+        self.results = {}
+        self.errors = {}
+        self.succeeded = 0
+        self._queue = Queue.Queue()
+        if pool is None:
+            pool = get_pool()
+        for i, args in enumerate(self.args_list):
+            p = pool(args) if callable(pool) else pool
+            try:
+                p.apply_async(self._run, (func, i, args))
+            except Queue.Full, e:
+                self._queue.put((i, False, e))
+
+    def _run(self, func, i, args):
+        try:
+            self._queue.put((i, True, func(*args)))
+        except Exception, e:
+            self._queue.put((i, False, e))
+
+    @property
+    def done(self):
+        return len(self.results) + len(self.errors) == len(self.args_list)
+
+    def wait(self, count=None, timeout=None):
+        """Wait until `count` calls succeeded or all calls finished.
+
+        Return the number of succeeded calls.  With `timeout` (seconds),
+        give up waiting once it is spent.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.done:
+            if count is not None and self.succeeded >= count:
+                break
+            try:
+                if deadline is None:
+                    # a blocking get() can not be interrupted by signals
+                    i, ok, r = self._queue.get(True, 3600)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    i, ok, r = self._queue.get(True, remaining)
+            except Queue.Empty:
+                if deadline is not None:
+                    break
+                continue
+            if ok:
+                self.results[i] = r
+                if self.is_ok(r):
+                    self.succeeded += 1
+            else:
+                self.errors[i] = r
+        return self.succeeded
+
+    def items(self):
+        """(args, result) of finished calls which did not raise."""
+        return [(self.args_list[i], r) for i, r in sorted(self.results.items())]
+
+
+def fanout(func, args_list, count=None, timeout=None, is_ok=None, pool=None):
+    f = Fanout(func, args_list, is_ok=is_ok, pool=pool)
+    f.wait(count, timeout)
+    return f
+
+
+def _call(func, i, batch, finished):
+    try:
+        finished.put((i, True, func(batch)))
+    except Exception, e:
+        finished.put((i, False, e))
+
+
+def iter_batches(func, items, batch_size, parallel=2, ordered=False,
+                 pool=None):
+    """Yield (batch, func(batch)) for the batches of batch_size items,
+    with up to `parallel` calls running ahead.
+
+    items is consumed as the calls are started, so it can be any iterable.
+    The batches are yielded as their calls finish, or in order with
+    `ordered`.  The exception of a failed call is raised when its batch
+    comes.  The calls run in the OUTER pool by default, so func may fan
+    out.
+    """
+    pool = pool or get_pool(OUTER)
+    items = iter(items)
+    finished = Queue.Queue()
+    pending = {}  # call index -> batch
+    results = {}  # call index -> (ok, result)
+    started = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < parallel:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                exhausted = True
+                break
+            pending[started] = batch
+            pool.apply_async(_call, (func, started, batch, finished))
+            started += 1
+        if not pending:
+            return
+        first = min(pending)
+        while (first not in results) if ordered else not results:
+            try:
+                i, ok, r = finished.get(True, 3600)
+            except Queue.Empty:
+                continue
+            results[i] = (ok, r)
+        i = first if ordered else min(results)
+        ok, r = results.pop(i)
+        batch = pending.pop(i)
+        if not ok:
+            raise r
+        yield batch, r
+
+
+def iter_workers(work, tasks, parallel, queue_size=16):
+    """Yield the results of `work(task)`, a generator, for every task,
+    run by `parallel` threads.
+
+    At most queue_size results wait to be consumed, holding the workers
+    back.  An exception escaping work() is raised here, and the workers
+    stop when the caller stops iterating.
+    """
+    todo = Queue.Queue()
+    for task in tasks:
+        todo.put(task)
+    results = Queue.Queue(queue_size)
+    stopped = threading.Event()
+
+    def put(r):
+        while not stopped.is_set():
+            try:
+                results.put(r, True, 1)
+                return True
+            except Queue.Full:
+                pass
+
+    def worker():
+        try:
+            while not stopped.is_set():
+                try:
+                    task = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                for r in work(task):
+                    if not put((r, None)):
+                        return
+        except Exception, e:
+            put((None, e))
+        finally:
+            put(None)
+
+    workers = [threading.Thread(target=worker)
+               for i in range(max(1, min(parallel, todo.qsize())))]
+    for t in workers:
+        t.setDaemon(True)
+        t.start()
+    try:
+        running = len(workers)
+        while running:
+            try:
+                r = results.get(True, 3600)
+            except Queue.Empty:
+                continue
+            if r is None:
+                running -= 1
+                continue
+            r, e = r
+            if e is not None:
+                raise e
+            yield r
+    finally:
+        stopped.set()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+profiler.py
+
+Profile the sizes of the values read and written by a MCStore or a
+CacheWrapper, per key prefix.
+
+Each prefix keeps op counts and a histogram of the value sizes in powers
+of two, so the memory used is bounded by the number of prefixes tracked.
+Keys with values over the size threshold are tracked with their access
+counts, up to `max_large` of them, the smallest being dropped first.
+The report tells which prefixes should be compressed or chunked.
+
+Values which are not strings are measured pickled, one in `sample` of
+them, the others of the same prefix taking the last size measured.
+Listings and meta keys, starting with '@' or '?', are not values and
+are not recorded.
+"""
+
+import re
+import time
+import heapq
+import cPickle
+import threading
+
+from douban.beansdb import log
+
+OTHER = '*'
+BUCKETS = 33
+META = ('@', '?')
+
+_prefix = re.compile(r'/?[^/:|_.\-]*')
+
+
+def key_prefix(key):
+    """The namespace of key: up to the first separator, with a leading
+    '/' for DoubanFS paths."""
+    return _prefix.match(key).group()
+
+
+def value_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    return len(cPickle.dumps(value, -1))
+
+
+def _bucket(size):
+    return min(int(size).bit_length(), BUCKETS - 1)
+
+
+class _PrefixStats(object):
+
+    __slots__ = ('ops', 'misses', 'values', 'bytes', 'max', 'hist')
+
+    def __init__(self):
+        self.ops = {}
+        self.misses = 0
+        self.values = 0
+        self.bytes = 0
+        self.max = 0
+        self.hist = [0] * BUCKETS
+
+    def add(self, op, value, size):
+        self.ops[op] = self.ops.get(op, 0) + 1
+        if value is None:
+            if op.startswith('get'):
+                self.misses += 1
+            return
+        self.values += 1
+        self.bytes += size
+        self.max = max(self.max, size)
+        self.hist[_bucket(size)] += 1
+
+    def percentile(self, p):
+        """Upper bound of the size under which are p of the values."""
+        n = self.values * p
+        seen = 0
+        for i, c in enumerate(self.hist):
+            seen += c
+            if c and seen >= n:
+                return (1 << i) - 1
+        return 0
+
+    def report(self):
+        return dict(ops=dict(self.ops), misses=self.misses,
+                    values=self.values, bytes=self.bytes, max=self.max,
+                    mean=self.bytes // max(self.values, 1),
+                    p50=self.percentile(0.5), p99=self.percentile(0.99),
+                    hist=dict(((1 << i) - 1, c)
+                              for i, c in enumerate(self.hist) if c))
+
+
+class SizeProfiler(object):
+
+    """Value sizes and op counts per key prefix.
+
+    threshold:
+        values of this size and more are tracked by key.
+    max_prefixes:
+        prefixes tracked, the others are counted under '*'.
+    prefix:
+        a function returning the prefix of a key, key_prefix by default.
+    dump_interval:
+        seconds between the reports logged to slog, never if None.
+    sample:
+        one in `sample` values which are not strings is pickled to be
+        measured.
+    """
+
+    def __init__(self, threshold=1 << 20, max_prefixes=1000, max_large=100,
+                 prefix=None, dump_interval=3600, sample=16):
+        self.threshold = threshold
+        self.max_prefixes = max_prefixes
+        self.max_large = max_large
+        self.prefix = prefix or key_prefix
+        self.dump_interval = dump_interval
+        self.sample = sample
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._large = {}  # key -> [size, count]
+            self._large_heap = []  # (size, key), stale ones included
+            self._estimates = {}  # prefix -> last size pickled
+            self._unsized = 0
+            self.started = self._dumped = time.time()
+
+    def _size(self, p, value):
+        if value is None or isinstance(value, (str, unicode)):
+            return value_size(value)
+        with self._lock:
+            self._unsized += 1
+            size = self._estimates.get(p)
+            measure = size is None or self._unsized % self.sample == 0
+        if measure:
+            # pickled out of the lock
+            size = value_size(value)
+            with self._lock:
+                self._estimates[p] = size
+        return size
+
+    def _track_large(self, key, size):
+        """Track key, dropping the smallest large key if there are too
+        many, or not tracking it if it is the smallest."""
+        heap = self._large_heap
+        if len(self._large) >= self.max_large:
+            while self._large.get(heap[0][1], (None,))[0] != heap[0][0]:
+                heapq.heappop(heap)
+            if size <= heap[0][0]:
+                return
+            del self._large[heapq.heappop(heap)[1]]
+        self._large[key] = [size, 1]
+        heapq.heappush(heap, (size, key))
+
+    def record(self, op, key, value):
+        if key[:1] in META:
+            return
+        p = self.prefix(key)
+        if p not in self._stats and len(self._stats) >= self.max_prefixes:
+            p = OTHER
+        size = self._size(p, value)
+        dump = False
+        with self._lock:
+            stats = self._stats.get(p)
+            if stats is None:
+                stats = self._stats[p] = _PrefixStats()
+            stats.add(op, value, size)
+            large = self._large.get(key)
+            if large is not None:
+                large[1] += 1
+                if value is not None and size != large[0]:
+                    large[0] = size
+                    heapq.heappush(self._large_heap, (size, key))
+                    if len(self._large_heap) > 2 * self.max_large:
+                        self._large_heap = [(v[0], k) for k, v in
+                                            self._large.iteritems()]
+                        heapq.heapify(self._large_heap)
+            elif size >= self.threshold:
+                self._track_large(key, size)
+            if self.dump_interval is not None and \
+                    time.time() - self._dumped >= self.dump_interval:
+                self._dumped = time.time()
+                dump = True
+        if dump:
+            self.dump()
+
+    def record_multi(self, op, values):
+        for key, value in values.iteritems():
+            self.record(op, key, value)
+
+    def report(self):
+        """{'prefixes': {prefix: stats}, 'large': [(key, size, count,
+        accesses per second)], 'elapsed': seconds profiled}, the large
+        keys sorted by access rate."""
+        with self._lock:
+            elapsed = max(time.time() - self.started, 0.001)
+            prefixes = dict((p, s.report()) for p, s in
+                            self._stats.iteritems())
+            large = sorted(((k, size, n, n / elapsed)
+                            for k, (size, n) in self._large.iteritems()),
+                           key=lambda it: -it[3])
+        return dict(prefixes=prefixes, large=large, elapsed=elapsed)
+
+    def format_report(self, top=20):
+        """The report in lines, the `top` prefixes by bytes."""
+        r = self.report()
+        prefixes = sorted(r['prefixes'].iteritems(),
+                          key=lambda it: -it[1]['bytes'])[:top]
+        lines = ['value sizes in %.0fs' % r['elapsed']]
+        for p, s in prefixes:
+            lines.append('%s %s: %d bytes, mean %d p50 %d p99 %d max %d, '
+                         '%d misses' % (
+                             p, ','.join('%s=%d' % it
+                                         for it in sorted(s['ops'].items())),
+                             s['bytes'], s['mean'], s['p50'], s['p99'],
+                             s['max'], s['misses']))
+        for k, size, n, rate in r['large'][:top]:
+            lines.append('large %r: %d bytes, %d accesses, %.2f/s'
+                         % (k, size, n, rate))
+        return lines
+
+    def dump(self):
+        for line in self.format_report():
+            log(line)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+rebalance.py
+
+Copy buckets to new beansdb servers.
+
+plan() chooses bucket moves which even out the number of buckets held by
+the servers of a BeansdbClient, new empty servers included.  A
+Rebalancer copies the raw values and flags of every moved bucket from a
+replica to the target server, keeping their versions, several buckets at
+a time and within the given ops and bytes rates.  The keys are copied in
+batches across the leaf directories, the keys of a batch at the same
+time by a bounded pool of threads.  The keys written or
+deleted on the source during the copy are copied again by catch-up
+passes, which compare the listings of the source and the target.  Its
+progress is saved in a checkpoint file, so that an interrupted run
+resumes where it stopped.
+
+The sources are not deleted: once the targets are configured to serve
+the buckets and the bucket table has picked them up, the sources can be
+cleaned out of the configuration.
+
+Usage: beansdb-rebalance [options] CONFIG CHECKPOINT
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+from optparse import OptionParser
+
+from douban.beansdb import beansdb_from_config, bucket_depth, log, \
+    MAX_KEYS_IN_GET_MULTI
+from douban.beansdb.limit import RateLimit
+from douban.beansdb.parallel import iter_workers, fanout, BoundedPool
+from douban.beansdb.scan import walk, healthy_replica, DONE
+
+
+def plan(client):
+    """[(bucket, source addr, target addr)] moves which even out the
+    number of buckets per server."""
+    client.update()
+    held = dict((s.addr, set()) for s in client.servers)
+    for b, ss in enumerate(client.buckets):
+        for s in ss:
+            held[s.addr].add(b)
+    moves = []
+    while True:
+        load = sorted((len(bs), addr) for addr, bs in held.items())
+        pairs = [(source, target) for high, source in reversed(load)
+                 for low, target in load if high - low > 1
+                 and held[source] - held[target]]
+        if not pairs:
+            return moves
+        source, target = pairs[0]
+        b = min(held[source] - held[target])
+        held[source].remove(b)
+        held[target].add(b)
+        moves.append((b, source, target))
+
+
+class Rebalancer(object):
+
+    """Copy the buckets of `moves` to their targets.
+
+    parallel:
+        buckets copied at the same time.
+    width:
+        keys copied at the same time, over all the buckets.
+    max_ops, max_bytes:
+        keys and value bytes copied per second, no limit if None.
+    catch_up_passes:
+        passes over a copied bucket to copy the keys changed meanwhile,
+        stopping at the first one which finds none.
+    """
+
+    def __init__(self, client, moves, path, parallel=4, batch_size=100,
+                 max_ops=None, max_bytes=None, progress=None,
+                 progress_interval=10, catch_up_passes=3, width=16):
+        self.client = client
+        self.catch_up_passes = catch_up_passes
+        self.path = path
+        self.parallel = parallel
+        self.batch_size = min(batch_size, MAX_KEYS_IN_GET_MULTI)
+        self._pool = BoundedPool(width, parallel * self.batch_size)
+        self.ops = RateLimit(max_ops) if max_ops else None
+        self.bytes = RateLimit(max_bytes) if max_bytes else None
+        self.progress = progress or (lambda stats: log(
+            'rebalance %(keys)d keys, %(moves)d/%(total)d buckets done '
+            'in %(elapsed).1fs' % stats))
+        self.progress_interval = progress_interval
+        ckpt = self.read_checkpoint(path)
+        if ckpt:
+            moves = [tuple(m) for m in ckpt['moves']]
+            self.cursors = ckpt['cursors']
+        else:
+            moves = [tuple(m) for m in moves]
+            self.cursors = {}
+        self.moves = moves
+        self.stats = dict(keys=0, bytes=0, moves=0, total=len(moves),
+                          failed=0, caught_up=0, elapsed=0)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def read_checkpoint(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except IOError:
+            pass
+
+    def checkpoint(self):
+        with self._lock:
+            data = json.dumps(dict(moves=self.moves, cursors=self.cursors))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self.path)
+
+    def _server(self, addr):
+        for s in self.client.servers:
+            if s.addr == addr:
+                return s
+        raise ValueError('unknown server %s' % addr)
+
+    def _throttle(self, keys, nbytes):
+        if self.ops:
+            self.ops.wait(keys)
+        if self.bytes:
+            self.bytes.wait(nbytes)
+
+    def _copy_key(self, source, target, key, ver):
+        """Copy the raw value of key at ver, return its size."""
+        if ver < 0:
+            ok = target.delete_at(key, ver)
+            n = 0
+        else:
+            data, flag = source.get_raw(key)
+            if data is None:
+                return 0  # deleted meanwhile, left to the catch-up
+            ok = target.set_raw(key, data, ver, flag)
+            n = len(data) if isinstance(data, str) else 0
+        if not ok:
+            raise IOError('copy %r to %s failed' % (key, target))
+        return n
+
+    def _copy(self, source, target, items):
+        """Copy the keys of items [(key, hash, ver)] in batches."""
+        for i in range(0, len(items), self.batch_size):
+            batch = items[i:i + self.batch_size]
+            f = fanout(self._copy_key,
+                       [(source, target, k, ver) for k, _, ver in batch],
+                       pool=self._pool)
+            if f.errors:
+                raise f.errors[min(f.errors)]
+            nbytes = sum(f.results.values())
+            self._throttle(len(batch), nbytes)
+            with self._lock:
+                self.stats['keys'] += len(batch)
+                self.stats['bytes'] += nbytes
+
+    def _catch_up(self, source, target, prefix):
+        """Copy the keys under prefix whose version on target is not
+        that on source, return their number."""
+        n = 0
+        for leaf, items in walk([source], prefix):
+            theirs = {}
+            for _, its in walk([target], leaf):
+                theirs.update((k, ver) for k, _, ver in its)
+            changed = [(k, h, ver) for k, h, ver in items
+                       if ver != theirs.get(k, 0)
+                       and (ver > 0 or theirs.get(k, 0) > 0)]
+            self._copy(source, target, changed)
+            n += len(changed)
+        return n
+
+    def _move(self, b, source, target):
+        """Copy bucket b, yielding the leaves as they are copied."""
+        name = '%d:%s' % (b, target)
+        depth = bucket_depth(self.client.buckets_count)
+        prefix = '%0*x' % (depth, b)
+        cursor = self.cursors.get(name)
+        if cursor == DONE:
+            return
+        target = self._server(target)
+        s = healthy_replica([self._server(source)] + [
+            s for s in self.client._get_bucket_servers(b)
+            if s.addr not in (source, target.addr)], prefix)
+        todo = []
+        for leaf, items in walk([s], prefix, cursor):
+            todo.extend(it for it in items if it[2] > 0)
+            if len(todo) >= self.batch_size:
+                self._copy(s, target, todo)
+                todo = []
+                with self._lock:
+                    self.cursors[name] = leaf
+                yield leaf
+        self._copy(s, target, todo)
+        n = 0
+        for i in range(self.catch_up_passes):
+            n = self._catch_up(s, target, prefix)
+            with self._lock:
+                self.stats['caught_up'] += n
+            if not n:
+                break
+        if n:
+            log('rebalance bucket %d to %s still changing after %d passes'
+                % (b, target, self.catch_up_passes))
+        with self._lock:
+            self.cursors[name] = DONE
+
+    def run(self):
+        """Copy (the rest of) the moves, return the stats."""
+        start = time.time()
+        self.client._check_update()
+
+        def move(m):
+            b, source, target = m
+            try:
+                for leaf in self._move(b, source, target):
+                    yield leaf
+                key = 'moves'
+            except Exception, e:
+                log('rebalance bucket %d to %s failed: %s' % (b, target, e))
+                key = 'failed'
+            with self._lock:
+                self.stats[key] += 1
+            yield
+
+        last = time.time()
+        for r in iter_workers(move, self.moves, self.parallel):
+            if time.time() - last > self.progress_interval:
+                self.checkpoint()
+                self.stats['elapsed'] = time.time() - start
+                self.progress(self.stats)
+                last = time.time()
+        self.checkpoint()
+        self.stats['elapsed'] = time.time() - start
+        return self.stats
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] CONFIG CHECKPOINT')
+    parser.add_option('-n', '--dry-run', action='store_true',
+                      help='print the planned moves only')
+    parser.add_option('-p', '--parallel', type='int', default=4,
+                      help='buckets copied at the same time [%default]')
+    parser.add_option('-b', '--batch-size', type='int', default=100,
+                      help='keys copied between throttling [%default]')
+    parser.add_option('--max-ops', type='float',
+                      help='keys copied per second')
+    parser.add_option('--max-bytes', type='float',
+                      help='bytes copied per second')
+    parser.add_option('-i', '--interval', type='float', default=10,
+                      help='seconds between progress reports [%default]')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('wrong number of arguments')
+
+    def progress(stats):
+        print >>sys.stderr, ('%(keys)d keys, %(moves)d/%(total)d buckets done'
+                             ', %(failed)d failed in %(elapsed).1fs' % stats)
+
+    client = beansdb_from_config(args[0], direct=True)
+    ckpt = Rebalancer.read_checkpoint(args[1])
+    moves = ckpt['moves'] if ckpt else plan(client)
+    if opts.dry_run:
+        for b, source, target in moves:
+            print '%x %s -> %s' % (b, source, target)
+        return 0
+    rebalancer = Rebalancer(client, moves, args[1], parallel=opts.parallel,
+                            batch_size=opts.batch_size,
+                            max_ops=opts.max_ops, max_bytes=opts.max_bytes,
+                            progress=progress,
+                            progress_interval=opts.interval)
+    stats = rebalancer.run()
+    progress(stats)
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+scan.py
+
+Walk the keys stored in beansdb through the `@<hex>` hash directory
+listings of every bucket.
+
+A cursor is a comma separated list of hex prefixes, one for each bucket
+with scanning progress: the last leaf directory which has been completely
+consumed, or the bucket prefix followed by '~' once the whole bucket is
+done.  Every directory ordered no later than the cursor prefix is skipped
+when resuming.  Keys may be seen twice when the hash tree of a bucket was
+split since the cursor was taken, but none is missed.
+"""
+
+from douban.beansdb import ReadFailedError, bucket_depth, fnv1a
+from douban.beansdb.parallel import iter_workers
+
+DONE = '~'  # sorts after every hex digit
+QUEUE_SIZE = 16  # leaf directories buffered by parallel scanning
+
+
+def parse_listing(r):
+    """Split a `@<hex>` listing into ([(sub_prefix, hash, count)],
+    [(key, hash, ver)])."""
+    dirs, items = [], []
+    for l in (r or '').strip().split('\n'):
+        parts = l.split(' ')
+        if len(parts) != 3:
+            continue
+        name, h, n = parts
+        if name.endswith('/'):
+            dirs.append((name[:-1], int(h), int(n)))
+        else:
+            items.append((name, int(h), int(n)))
+    return dirs, items
+
+
+def first_listing(servers, prefix):
+    """(server, listing) of `@prefix` from the first of servers which
+    answers."""
+    for s in servers:
+        try:
+            r = s.get('@' + prefix)
+            if r is not None:
+                return s, r
+        except IOError:
+            pass
+    raise ReadFailedError('@' + prefix, servers)
+
+
+def healthy_replica(servers, prefix):
+    """The first of the replicas servers which lists prefix."""
+    return first_listing(servers, prefix)[0]
+
+
+def _skip(prefix, cursor):
+    """Whether everything under prefix is ordered before cursor."""
+    return cursor is not None and prefix < cursor \
+        and not cursor.startswith(prefix)
+
+
+def walk(servers, prefix, cursor=None):
+    """Yield (leaf_prefix, items) of the directory tree under `@prefix`.
+
+    Each listing is read from the first server which answers.
+    """
+    s, r = first_listing(servers, prefix)
+    dirs, items = parse_listing(r)
+    if items or not dirs:
+        if cursor is None or prefix > cursor:
+            yield prefix, items
+        elif cursor.startswith(prefix):
+            # the directory was merged since the cursor was taken
+            yield prefix, [it for it in items
+                           if '%08x' % fnv1a(it[0]) > cursor + 'f' * 8]
+        return
+    for sub, h, count in sorted(dirs):
+        p = prefix + sub
+        if count > 0 and not _skip(p, cursor):
+            for leaf in walk(servers, p, cursor):
+                yield leaf
+
+
+class KeyScanner(object):
+
+    """Iterate (key, hash, version) of the keys in the given buckets.
+
+    Memory use is bounded by the listings being walked, plus a few
+    leaf listings queued by the workers when scanning in parallel.
+    `cursor` is updated as the items are consumed, so that a new scanner
+    created with it resumes after the last completed directory.
+    """
+
+    def __init__(self, client, buckets=None, cursor=None, parallel=1,
+                 deleted=False):
+        self.client = client
+        client._check_update()
+        self.depth = bucket_depth(client.buckets_count)
+        if buckets is None:
+            buckets = range(client.buckets_count)
+        self.buckets = list(buckets)
+        self.parallel = parallel
+        self.deleted = deleted
+        self.progress = {}
+        for c in (cursor or '').split(','):
+            if c:
+                self.progress[int(c[:self.depth], 16)] = c
+
+    @property
+    def cursor(self):
+        return ','.join(v for _, v in sorted(self.progress.items()))
+
+    def _bucket_prefix(self, b):
+        return '%0*x' % (self.depth, b)
+
+    def _leaves(self, b):
+        c = self.progress.get(b)
+        if c and c.endswith(DONE):
+            return
+        for leaf in walk(self.client._get_bucket_servers(b),
+                         self._bucket_prefix(b), c):
+            yield leaf
+
+    def _consume(self, b, prefix, items):
+        for key, h, ver in items:
+            if ver > 0 or self.deleted:
+                yield key, h, ver
+        self.progress[b] = prefix
+
+    def __iter__(self):
+        if self.parallel > 1:
+            return self._iter_parallel()
+        return self._iter_serial()
+
+    def _iter_serial(self):
+        for b in self.buckets:
+            for prefix, items in self._leaves(b):
+                for item in self._consume(b, prefix, items):
+                    yield item
+            self.progress[b] = self._bucket_prefix(b) + DONE
+
+    def _iter_parallel(self):
+        def leaves(b):
+            for prefix, items in self._leaves(b):
+                yield b, prefix, items
+            yield b, self._bucket_prefix(b) + DONE, []
+
+        for r in iter_workers(leaves, self.buckets, self.parallel,
+                              QUEUE_SIZE):
+            for item in self._consume(*r):
+                yield item
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+serializer.py
+
+Encode values for `set_raw` and decode them from `get_raw`, by the flag
+bits stored along with every value.
+
+The built-in flags are the ones used by cmemcached, so values written here
+stay readable by plain cmemcached clients.  Containers are marshalled
+instead of pickled, about twice as fast as pickle for lists of ids and on
+par for small dicts, see benchmark().  Values marshal can not handle fall
+back to pickle, and bad data always raises ValueError.  A new
+format is added by registering it under a new flag, keeping the decoder
+of the old flag registered so that existing values remain readable.
+
+Run this module to benchmark it against pickle.
+"""
+
+import zlib
+import time
+import marshal
+import cPickle
+
+FLAG_PICKLE = 1 << 0
+FLAG_INTEGER = 1 << 1
+FLAG_LONG = 1 << 2
+FLAG_BOOL = 1 << 3
+FLAG_COMPRESS = 1 << 4
+FLAG_MARSHAL = 1 << 5
+
+MARSHAL_VERSION = 2
+
+
+class Serializer(object):
+
+    """A registry of value formats keyed by flag.
+
+    compress_threshold:
+        serialized values longer than this are zlib compressed, None
+        to never compress.
+    """
+
+    def __init__(self, compress_threshold=None):
+        self.compress_threshold = compress_threshold
+        self._types = {}  # exact type -> (flag, dumps)
+        self._formats = {}  # flag -> (dumps, loads)
+        self._fallbacks = []  # flags tried in order for other types
+
+    def register(self, flag, dumps, loads, types=(), fallback=False):
+        """Register a format under flag.
+
+        Values of exactly one of `types` are encoded with it, and with
+        `fallback` it is tried, in registration order, for values of the
+        other types.  `dumps` raises ValueError or TypeError when it can not
+        encode a value.
+        """
+        if flag & FLAG_COMPRESS:
+            raise ValueError('flag %d overlaps FLAG_COMPRESS' % flag)
+        self._formats[flag] = (dumps, loads)
+        for t in types:
+            self._types[t] = (flag, dumps)
+        if fallback:
+            self._fallbacks.append(flag)
+
+    def _dumps_fallback(self, value, tried=None):
+        for flag in self._fallbacks:
+            if flag == tried:
+                continue
+            try:
+                return self._formats[flag][0](value), flag
+            except (ValueError, TypeError):
+                pass
+        raise ValueError('can not serialize %r' % type(value))
+
+    def dumps(self, value):
+        """Return (data, flag)."""
+        t = self._types.get(type(value))
+        if t is not None:
+            flag, dumps = t
+            try:
+                data = dumps(value)
+            except (ValueError, TypeError):
+                data, flag = self._dumps_fallback(value, flag)
+        else:
+            data, flag = self._dumps_fallback(value)
+        if self.compress_threshold is not None \
+                and len(data) > self.compress_threshold:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                return compressed, flag | FLAG_COMPRESS
+        return data, flag
+
+    def loads(self, data, flag):
+        """Decode data, raise ValueError if it can not be decoded."""
+        if data is None:
+            return None
+        try:
+            if flag & FLAG_COMPRESS:
+                data = zlib.decompress(data)
+                flag &= ~FLAG_COMPRESS
+            return self._formats[flag][1](data)
+        except KeyError:
+            raise ValueError('unknown flag %d' % flag)
+        except (ValueError, EOFError, TypeError, zlib.error,
+                cPickle.UnpicklingError), e:
+            raise ValueError('bad data with flag %d: %s' % (flag, e))
+
+
+def _loads_bool(data):
+    return data == '1'
+
+
+def _dumps_marshal(value):
+    return marshal.dumps(value, MARSHAL_VERSION)
+
+
+def _dumps_pickle(value):
+    try:
+        return cPickle.dumps(value, -1)
+    except cPickle.PicklingError, e:
+        raise TypeError(str(e))
+
+
+def default_serializer(compress_threshold=None):
+    s = Serializer(compress_threshold)
+    s.register(0, str, str, types=(str,))
+    s.register(FLAG_BOOL, lambda v: v and '1' or '0', _loads_bool,
+               types=(bool,))
+    s.register(FLAG_INTEGER, str, int, types=(int,))
+    s.register(FLAG_LONG, str, long, types=(long,))
+    s.register(FLAG_MARSHAL, _dumps_marshal, marshal.loads,
+               types=(dict, list, tuple, unicode, float, set, frozenset),
+               fallback=True)
+    s.register(FLAG_PICKLE, _dumps_pickle, cPickle.loads, fallback=True)
+    return s
+
+
+def benchmark(n=10000, serializer=None):
+    """Time dumps+loads of typical payloads, against pickle.
+
+    Return [(name, seconds, pickle seconds, size, pickle size)].
+    """
+    serializer = serializer or default_serializer()
+    payloads = [
+        ('int', 1234567),
+        ('small dict', {'id': 1234567, 'name': u'豆瓣',
+                        'score': 4.5, 'tags': ['a', 'b']}),
+        ('ids', range(1000000, 1000200)),
+    ]
+    results = []
+    for name, value in payloads:
+        t = time.time()
+        for i in xrange(n):
+            serializer.loads(*serializer.dumps(value))
+        fast = time.time() - t
+        t = time.time()
+        for i in xrange(n):
+            cPickle.loads(cPickle.dumps(value, -1))
+        pickle = time.time() - t
+        results.append((name, fast, pickle, len(serializer.dumps(value)[0]),
+                        len(cPickle.dumps(value, -1))))
+    return results
+
+
+if __name__ == '__main__':
+    for name, fast, pickle, size, pickle_size in benchmark():
+        print '%-12s serializer %.3fs %5dB   pickle %.3fs %5dB' % (
+            name, fast, size, pickle, pickle_size)
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+shmcache.py
+
+A cache in a shared memory segment, shared by the worker processes forked
+after it is made, or by the processes mapping the same file.
+
+The segment is split into stripes, each one holding a fixed hash table
+and a slab arena.  A key hashes to a bucket of `ways` slots in one stripe.
+The arena of a stripe is cut in pages, given on demand to a size class,
+and cut in chunks of that size holding the key and the value.  When a
+bucket is full its least recently read entry is dropped, and when a class
+has no free chunk left, the least recently read of a sample of its
+entries is dropped, expired entries first.  A class without entries to
+drop takes a page of another class, dropping the entries in it, so that
+the pages follow the sizes stored.
+
+Writers lock their stripe, with a file lock between processes.  Readers
+do not lock: every write to a stripe makes its sequence number odd
+before and even after, and a read is retried when the sequence number
+was odd or changed.  A writer finding the sequence number odd when it
+takes the lock knows that a process died writing the stripe, and clears
+the stripe.
+
+Values are encoded with a douban.beansdb.serializer.Serializer.
+"""
+
+import os
+import time
+import fcntl
+import mmap
+import random
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from douban.beansdb import fnv1a
+from douban.beansdb.serializer import default_serializer
+
+MAGIC = 'BSHMC002'
+HEADER = struct.Struct('!8sIIIIII')  # magic, stripes, buckets, ways, pages,
+                                     # page size, min chunk
+HEADER_SIZE = 64
+SLOT = struct.Struct('!IIdIIHH')  # hash, expire, access, chunk + 1, value
+                                  # length, key length, flag
+WORD = struct.Struct('!I')
+READ_TRIES = 3
+EVICT_SAMPLES = 32
+
+_now = time.time  # set() takes a `time` argument
+
+
+class SharedMemoryCache(object):
+
+    """A memcache like cache of up to `size` bytes in shared memory.
+
+    path:
+        file of the segment, to share it between unrelated processes,
+        better on a tmpfs like /dev/shm.  Without it the segment is
+        anonymous and shared by the processes forked after.
+    nstripes:
+        stripes locked separately.
+    avg_size:
+        expected size of an entry, for the number of slots.
+    page_size:
+        size of the arena pages, entries larger than it are not cached.
+    """
+
+    def __init__(self, size=64 << 20, path=None, nstripes=16, ways=8,
+                 avg_size=1024, page_size=64 << 10, min_chunk=64,
+                 serializer=None):
+        self.serializer = serializer or default_serializer()
+        self.hits = self.misses = self.evictions = self.failed = 0
+        self.reassigned = self.repaired = 0
+        if path is None:
+            fd, tmp = tempfile.mkstemp(
+                prefix='beansdb-shm.',
+                dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            os.unlink(tmp)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        self._fd = fd
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            if os.fstat(fd).st_size >= HEADER_SIZE:
+                header = HEADER.unpack(os.read(fd, HEADER.size))
+                if header[0] != MAGIC:
+                    raise ValueError('%s is not a shared cache' % path)
+                geometry = header[1:]
+                new = False
+            else:
+                per_stripe = size // nstripes
+                buckets = max(1, per_stripe // avg_size // ways)
+                pages = max(1, per_stripe // page_size)
+                geometry = (nstripes, buckets, ways, pages, page_size,
+                            min_chunk)
+                new = True
+            (self.nstripes, self.buckets, self.ways, self.pages,
+             self.page_size, self.min_chunk) = geometry
+            self.nclasses = 1
+            while self.min_chunk << (self.nclasses - 1) < self.page_size:
+                self.nclasses += 1
+            self._stripe_header = struct.Struct('!II%dI' % self.nclasses)
+            # the class + 1 of every page, 0 while it is not given
+            self._classes_offset = self._stripe_header.size
+            self._slots_offset = \
+                (self._classes_offset + self.pages + 7) // 8 * 8
+            self._pages_offset = self._slots_offset + \
+                self.buckets * self.ways * SLOT.size
+            self._stripe_size = self._pages_offset + \
+                self.pages * self.page_size
+            total = HEADER_SIZE + self.nstripes * self._stripe_size
+            if new:
+                os.ftruncate(fd, total)
+            self.mm = mmap.mmap(fd, total)
+            if new:
+                HEADER.pack_into(self.mm, 0, MAGIC, *geometry)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+        self._locks_pid = None
+
+    # locking
+
+    def _thread_locks(self):
+        if self._locks_pid != os.getpid():
+            self._locks = [threading.Lock() for i in range(self.nstripes)]
+            self._locks_pid = os.getpid()
+        return self._locks
+
+    @contextmanager
+    def _locked(self, stripe):
+        """Lock stripe and make it odd for the readers."""
+        with self._thread_locks()[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe + 1)
+            base = self._base(stripe)
+            try:
+                seq = WORD.unpack_from(self.mm, base)[0]
+                if seq & 1:
+                    # left odd by a writer which died, maybe half written
+                    self._clear_stripe(base)
+                    self.repaired += 1
+                seq |= 1
+                WORD.pack_into(self.mm, base, seq)
+                try:
+                    yield base
+                finally:
+                    WORD.pack_into(self.mm, base, (seq + 1) & 0xffffffff)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe + 1)
+
+    # layout
+
+    def _base(self, stripe):
+        return HEADER_SIZE + stripe * self._stripe_size
+
+    def _locate(self, key):
+        h = fnv1a(key)
+        return h, h % self.nstripes, (h // self.nstripes) % self.buckets
+
+    def _class(self, n):
+        cls = 0
+        while self.min_chunk << cls < n:
+            cls += 1
+        return cls
+
+    def _slot(self, base, i):
+        return base + self._slots_offset + i * SLOT.size
+
+    def _chunk(self, base, addr):
+        return base + self._pages_offset + addr - 1
+
+    def _find(self, base, key, h, bucket):
+        """(slot offset, slot) of key."""
+        mm = self.mm
+        for i in range(bucket * self.ways, (bucket + 1) * self.ways):
+            off = self._slot(base, i)
+            slot = SLOT.unpack_from(mm, off)
+            if slot[3] and slot[0] == h and slot[5] == len(key):
+                chunk = self._chunk(base, slot[3])
+                if mm[chunk:chunk + len(key)] == key:
+                    return off, slot
+        return None, None
+
+    # arena, with the stripe locked
+
+    def _heads(self, base):
+        return list(self._stripe_header.unpack_from(self.mm, base))
+
+    def _push(self, base, cls, addr):
+        header = self._heads(base)
+        WORD.pack_into(self.mm, self._chunk(base, addr), header[2 + cls])
+        header[2 + cls] = addr
+        self._stripe_header.pack_into(self.mm, base, *header)
+
+    def _pop(self, base, cls):
+        header = self._heads(base)
+        addr = header[2 + cls]
+        if addr:
+            header[2 + cls] = WORD.unpack_from(
+                self.mm, self._chunk(base, addr))[0]
+            self._stripe_header.pack_into(self.mm, base, *header)
+        return addr
+
+    def _carve(self, base, cls, page):
+        """Cut page in free chunks of class cls."""
+        header = self._heads(base)
+        size = self.min_chunk << cls
+        start = page * self.page_size
+        n = self.page_size // size
+        for j in range(n):
+            addr = start + j * size + 1
+            WORD.pack_into(self.mm, self._chunk(base, addr),
+                           addr + size if j + 1 < n else header[2 + cls])
+        header[2 + cls] = start + 1
+        self._stripe_header.pack_into(self.mm, base, *header)
+        self.mm[base + self._classes_offset + page] = chr(cls + 1)
+
+    def _new_page(self, base, cls):
+        header = self._heads(base)
+        page = header[1]
+        if page >= self.pages:
+            return False
+        header[1] = page + 1
+        self._stripe_header.pack_into(self.mm, base, *header)
+        self._carve(base, cls, page)
+        return True
+
+    def _reassign(self, base, cls):
+        """Give a page of another class to class cls, dropping the
+        entries in it."""
+        classes = base + self._classes_offset
+        pages = [p for p in range(self.pages)
+                 if ord(self.mm[classes + p]) not in (0, cls + 1)]
+        if not pages:
+            return False
+        page = random.choice(pages)
+        old = ord(self.mm[classes + page]) - 1
+        start = page * self.page_size + 1
+        end = start + self.page_size
+        for i in range(self.buckets * self.ways):
+            off = self._slot(base, i)
+            addr = SLOT.unpack_from(self.mm, off)[3]
+            if start <= addr < end:
+                SLOT.pack_into(self.mm, off, 0, 0, 0, 0, 0, 0, 0)
+                self.evictions += 1
+        # unlink the free chunks of the page
+        header = self._heads(base)
+        prev, addr = None, header[2 + old]
+        while addr:
+            link = WORD.unpack_from(self.mm, self._chunk(base, addr))[0]
+            if not start <= addr < end:
+                prev = addr
+            elif prev is None:
+                header[2 + old] = link
+            else:
+                WORD.pack_into(self.mm, self._chunk(base, prev), link)
+            addr = link
+        self._stripe_header.pack_into(self.mm, base, *header)
+        self._carve(base, cls, page)
+        self.reassigned += 1
+        return True
+
+    def _drop(self, base, off, slot):
+        """Free the entry of slot."""
+        self._push(base, self._class(slot[4] + slot[5]), slot[3])
+        SLOT.pack_into(self.mm, off, 0, 0, 0, 0, 0, 0, 0)
+
+    def _victim_order(self, slot, now):
+        expired = slot[1] and slot[1] <= now
+        return (not expired, slot[2])
+
+    def _evict(self, base, cls):
+        """Drop the least recently read of a sample of the entries of
+        class cls."""
+        now = _now()
+        nslots = self.buckets * self.ways
+        victim = None
+        for i in random.sample(xrange(nslots), min(EVICT_SAMPLES, nslots)):
+            off = self._slot(base, i)
+            slot = SLOT.unpack_from(self.mm, off)
+            if slot[3] and self._class(slot[4] + slot[5]) == cls and (
+                    victim is None or self._victim_order(slot, now)
+                    < self._victim_order(victim[1], now)):
+                victim = off, slot
+        if victim is None:
+            return False
+        self._drop(base, *victim)
+        self.evictions += 1
+        return True
+
+    def _alloc(self, base, cls):
+        addr = self._pop(base, cls)
+        if not addr and (self._new_page(base, cls) or self._evict(base, cls)
+                         or self._reassign(base, cls)):
+            addr = self._pop(base, cls)
+        return addr
+
+    # reads
+
+    def _read(self, base, key, h, bucket):
+        """(slot offset, expire, data, flag) of key, without locking."""
+        off, slot = self._find(base, key, h, bucket)
+        if off is None:
+            return None
+        chunk = self._chunk(base, slot[3]) + slot[5]
+        return off, slot[1], self.mm[chunk:chunk + slot[4]], slot[6]
+
+    def _get(self, key):
+        h, stripe, bucket = self._locate(key)
+        base = self._base(stripe)
+        for i in range(READ_TRIES):
+            seq = WORD.unpack_from(self.mm, base)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            r = self._read(base, key, h, bucket)
+            if WORD.unpack_from(self.mm, base)[0] == seq:
+                break
+        else:
+            with self._locked(stripe):
+                r = self._read(base, key, h, bucket)
+        if r is None:
+            return None
+        off, expire, data, flag = r
+        now = _now()
+        if expire and expire <= now:
+            return None
+        # for LRU, racing with a writer only makes some entry younger
+        struct.pack_into('!d', self.mm, off + 8, now)
+        try:
+            return self.serializer.loads(data, flag)
+        except ValueError:
+            return None
+
+    def get(self, key):
+        r = self._get(key)
+        if r is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return r
+
+    def get_multi(self, keys):
+        rs = {}
+        for k in keys:
+            r = self.get(k)
+            if r is not None:
+                rs[k] = r
+        return rs
+
+    # writes
+
+    def set(self, key, value, time=0):
+        """Cache value for `time` seconds, forever if 0."""
+        data, flag = self.serializer.dumps(value)
+        n = len(key) + len(data)
+        if not key or n > self.page_size:
+            return False
+        expire = int(_now() + time) if time else 0
+        cls = self._class(n)
+        h, stripe, bucket = self._locate(key)
+        with self._locked(stripe) as base:
+            off, slot = self._find(base, key, h, bucket)
+            if off is None:
+                ways = [(self._slot(base, i), SLOT.unpack_from(
+                    self.mm, self._slot(base, i)))
+                    for i in range(bucket * self.ways,
+                                   (bucket + 1) * self.ways)]
+                empty = [w for w in ways if not w[1][3]]
+                if empty:
+                    off, slot = empty[0]
+                else:
+                    now = _now()
+                    off, slot = min(ways, key=lambda w: self._victim_order(
+                        w[1], now))
+                    self.evictions += 1
+            if slot[3]:
+                self._drop(base, off, slot)
+            addr = self._alloc(base, cls)
+            if not addr:
+                self.failed += 1
+                return False
+            chunk = self._chunk(base, addr)
+            self.mm[chunk:chunk + n] = key + data
+            SLOT.pack_into(self.mm, off, h, expire, _now(), addr, len(data),
+                           len(key), flag)
+        return True
+
+    def set_multi(self, values, time=0):
+        return all([self.set(k, v, time) for k, v in values.iteritems()])
+
+    def delete(self, key, time=0):
+        h, stripe, bucket = self._locate(key)
+        with self._locked(stripe) as base:
+            off, slot = self._find(base, key, h, bucket)
+            if off is not None:
+                self._drop(base, off, slot)
+        return True
+
+    def delete_multi(self, keys, time=0):
+        for k in keys:
+            self.delete(k)
+        return True
+
+    def _clear_stripe(self, base):
+        start = base + WORD.size
+        end = base + self._pages_offset
+        self.mm[start:end] = '\0' * (end - start)
+
+    def clear(self):
+        for stripe in range(self.nstripes):
+            with self._locked(stripe) as base:
+                self._clear_stripe(base)
+
+    def close(self):
+        self.mm.close()
+        os.close(self._fd)
+
+
+class SharedCachedMC(object):
+
+    """A memcache client read through a SharedMemoryCache.
+
+    Values read from mc are kept in the cache for `ttl` seconds, and the
+    keys written through it are dropped from the cache.  The writes made
+    on other hosts are seen after `ttl` at worst.
+    """
+
+    def __init__(self, mc, cache, ttl=5):
+        self.mc = mc
+        self.cache = cache
+        self.ttl = ttl
+
+    def __getattr__(self, name):
+        return getattr(self.mc, name)
+
+    def get(self, key):
+        r = self.cache.get(key)
+        if r is None:
+            r = self.mc.get(key)
+            if r is not None:
+                self.cache.set(key, r, self.ttl)
+        return r
+
+    def get_multi(self, keys):
+        rs = self.cache.get_multi(keys)
+        missing = [k for k in keys if k not in rs]
+        if missing:
+            found = self.mc.get_multi(missing)
+            self.cache.set_multi(found, self.ttl)
+            rs.update(found)
+        return rs
+
+    def set(self, key, value, *args, **kwargs):
+        self.cache.delete(key)
+        return self.mc.set(key, value, *args, **kwargs)
+
+    def set_multi(self, values, *args, **kwargs):
+        self.cache.delete_multi(values)
+        return self.mc.set_multi(values, *args, **kwargs)
+
+    def delete(self, key, *args, **kwargs):
+        self.cache.delete(key)
+        return self.mc.delete(key, *args, **kwargs)
+
+    def delete_multi(self, keys, *args, **kwargs):
+        self.cache.delete_multi(keys)
+        return self.mc.delete_multi(keys, *args, **kwargs)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+trace.py
+
+Record a sample of the calls made to a BeansDBProxy, BeansdbClient or
+CacheWrapper, and replay them against another client.
+
+Keys are sampled by their hash, so that every access to a sampled key is
+recorded.  A record keeps the op, the fnv1a hash of the key, the size of
+the value, the time and the latency of the call, but neither the key nor
+the value.  Every key of a multi call gets a record with the time and the
+latency of the call, and the id of the call, made of the pid of the
+process and a counter, so that the records of a call are told apart from
+those of other processes sharing the trace file.
+
+Record layout: op, flags, key hash, value size, timestamp, latency, call
+id as '!BBIIdfQ'.
+
+Usage: beansdb-replay [options] TRACE CONFIG
+"""
+
+import os
+import sys
+import time
+import atexit
+import struct
+import cPickle
+import threading
+import itertools
+import Queue
+from collections import namedtuple
+from optparse import OptionParser
+
+from douban.beansdb import beansdb_from_config, fnv1a, _mix32
+
+RECORD = struct.Struct('!BBIIdfQ')
+
+GET, GET_MULTI, SET, SET_MULTI, DELETE, DELETE_MULTI, EXISTS, INCR = \
+    range(1, 9)
+OPS = dict(get=GET, get_multi=GET_MULTI, set=SET, set_multi=SET_MULTI,
+           delete=DELETE, delete_multi=DELETE_MULTI, exists=EXISTS,
+           incr=INCR)
+MULTI = {GET_MULTI: GET, SET_MULTI: SET, DELETE_MULTI: DELETE}
+
+FLAG_ERROR = 1
+
+Record = namedtuple('Record', 'op flags hash size timestamp latency call')
+
+
+def _size(value):
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value)
+    return len(cPickle.dumps(value, -1))
+
+
+class TraceRecorder(object):
+
+    """Append sampled records to a trace file.
+
+    rate:
+        share of the keys recorded, 0.01 for 1%.
+
+    Records are buffered and written in whole records, so that forked
+    processes can share a trace file, where the buffers of the processes
+    are out of the order of their timestamps.
+    """
+
+    def __init__(self, path, rate=0.01, buffer_size=64 << 10):
+        self.path = path
+        self.threshold = int(rate * 0xffffffff)
+        self.buffer_size = buffer_size
+        self.recorded = 0
+        self._buffer = []
+        self._size = 0
+        self._pid = os.getpid()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0644)
+        atexit.register(self.flush)
+
+    def sampled(self, key):
+        """The hash of key if it is sampled, else None."""
+        h = fnv1a(key)
+        if _mix32(h) <= self.threshold:
+            return h
+
+    def call_id(self):
+        """A new id for the records of a call, unique in the trace."""
+        return os.getpid() << 32 | next(self._counter) & 0xffffffff
+
+    def record(self, op, h, size, timestamp, latency, flags=0, call=0):
+        data = RECORD.pack(op, flags, h, size, timestamp, latency, call)
+        with self._lock:
+            if self._pid != os.getpid():
+                # the records of the parent are written by the parent
+                self._buffer = []
+                self._size = 0
+                self._pid = os.getpid()
+            self._buffer.append(data)
+            self._size += len(data)
+            self.recorded += 1
+            if self._size >= self.buffer_size:
+                self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            os.write(self._fd, ''.join(self._buffer))
+            self._buffer = []
+            self._size = 0
+
+    def flush(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._flush()
+
+    def close(self):
+        self.flush()
+        os.close(self._fd)
+
+
+def read_trace(path):
+    """Yield the Records of a trace file."""
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            yield Record(*RECORD.unpack(data))
+
+
+class TracedClient(object):
+
+    """Record the calls made to client with a TraceRecorder."""
+
+    def __init__(self, client, recorder):
+        self.client = client
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _call(self, name, keys, values, *args, **kwargs):
+        """Call client.name, record the sampled keys with their sizes from
+        `values`, a function of the result."""
+        sampled = [(k, h) for k, h in ((k, self.recorder.sampled(k))
+                                       for k in keys) if h is not None]
+        call = sampled and self.recorder.call_id()
+        t = time.time()
+        try:
+            r = getattr(self.client, name)(*args, **kwargs)
+        except Exception:
+            if sampled:
+                latency = time.time() - t
+                for k, h in sampled:
+                    self.recorder.record(OPS[name], h, 0, t, latency,
+                                         FLAG_ERROR, call=call)
+            raise
+        if sampled:
+            latency = time.time() - t
+            sizes = values(r)
+            for k, h in sampled:
+                self.recorder.record(OPS[name], h, _size(sizes(k)), t,
+                                     latency, call=call)
+        return r
+
+    def get(self, key, *args, **kwargs):
+        return self._call('get', [key], lambda r: lambda k: r,
+                          key, *args, **kwargs)
+
+    def get_multi(self, keys, *args, **kwargs):
+        return self._call('get_multi', keys, lambda r: r.get,
+                          keys, *args, **kwargs)
+
+    def exists(self, key, *args, **kwargs):
+        return self._call('exists', [key], lambda r: lambda k: None,
+                          key, *args, **kwargs)
+
+    def set(self, key, value, *args, **kwargs):
+        return self._call('set', [key], lambda r: lambda k: value,
+                          key, value, *args, **kwargs)
+
+    def set_multi(self, values, *args, **kwargs):
+        return self._call('set_multi', values, lambda r: values.get,
+                          values, *args, **kwargs)
+
+    def delete(self, key, *args, **kwargs):
+        return self._call('delete', [key], lambda r: lambda k: None,
+                          key, *args, **kwargs)
+
+    def delete_multi(self, keys, *args, **kwargs):
+        return self._call('delete_multi', keys, lambda r: lambda k: None,
+                          keys, *args, **kwargs)
+
+    def incr(self, key, *args, **kwargs):
+        return self._call('incr', [key], lambda r: lambda k: None,
+                          key, *args, **kwargs)
+
+
+def _calls(records):
+    """Group the records by their call, return [(timestamp, op, [records])]
+    in the order of the timestamps of the calls."""
+    calls = {}
+    for r in records:
+        calls.setdefault(r.call, (r.timestamp, r.op, []))[2].append(r)
+    return [c for _, c in sorted(calls.items(),
+                                 key=lambda (call, c): (c[0], call))]
+
+
+def _key(h):
+    return 'trace:%08x' % h
+
+
+def _value(size):
+    return 'x' * max(size, 1)
+
+
+def _do(client, op, records):
+    if op == GET:
+        client.get(_key(records[0].hash))
+    elif op == GET_MULTI:
+        client.get_multi([_key(r.hash) for r in records])
+    elif op == SET:
+        client.set(_key(records[0].hash), _value(records[0].size))
+    elif op == SET_MULTI:
+        client.set_multi(dict((_key(r.hash), _value(r.size))
+                              for r in records))
+    elif op == DELETE:
+        client.delete(_key(records[0].hash))
+    elif op == DELETE_MULTI:
+        client.delete_multi([_key(r.hash) for r in records])
+    elif op == EXISTS:
+        client.exists(_key(records[0].hash))
+    elif op == INCR:
+        client.incr(_key(records[0].hash), 1)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * p))]
+
+
+def replay(records, client, speed=1.0, concurrency=4, prefill=False):
+    """Issue the recorded calls to client, return the stats.
+
+    speed:
+        multiplier of the recorded pace, 0 to replay as fast as possible.
+    prefill:
+        set every key read by the trace before, with its recorded size.
+    """
+    calls = _calls(records)
+    if prefill:
+        sizes = {}
+        for _, op, rs in calls:
+            for r in rs:
+                sizes.setdefault(r.hash, r.size)
+        for h, size in sizes.iteritems():
+            client.set(_key(h), _value(size))
+    todo = Queue.Queue(concurrency * 4)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            call = todo.get()
+            if call is None:
+                break
+            t = time.time()
+            try:
+                _do(client, call[1], call[2])
+                ok = True
+            except Exception:
+                ok = False
+            latency = time.time() - t
+            with lock:
+                latencies.append(latency)
+                if not ok:
+                    errors[0] += 1
+
+    workers = [threading.Thread(target=worker) for i in range(concurrency)]
+    for w in workers:
+        w.setDaemon(True)
+        w.start()
+    start = time.time()
+    t0 = calls[0][0] if calls else 0
+    for ts, op, rs in calls:
+        if speed:
+            delay = (ts - t0) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        todo.put((ts, op, rs))
+    for w in workers:
+        todo.put(None)
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return dict(calls=len(latencies), errors=errors[0], elapsed=elapsed,
+                throughput=len(latencies) / max(elapsed, 0.001),
+                p50=percentile(latencies, 0.5),
+                p90=percentile(latencies, 0.9),
+                p99=percentile(latencies, 0.99),
+                max=latencies[-1] if latencies else 0)
+
+
+def format_stats(stats):
+    return ('%(calls)d calls, %(errors)d errors in %(elapsed).1fs, '
+            '%(throughput).0f/s, latency p50 %(p50).4fs p90 %(p90).4fs '
+            'p99 %(p99).4fs max %(max).4fs' % stats)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] TRACE CONFIG')
+    parser.add_option('-s', '--speed', type='float', default=1.0,
+                      help='multiplier of the recorded pace, 0 for as fast '
+                      'as possible [%default]')
+    parser.add_option('-c', '--concurrency', type='int', default=4,
+                      help='concurrent calls [%default]')
+    parser.add_option('--direct', action='store_true',
+                      help='replay to the servers instead of the proxies')
+    parser.add_option('--prefill', action='store_true',
+                      help='write the keys of the trace first')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('wrong number of arguments')
+    client = beansdb_from_config(args[1], direct=opts.direct)
+    stats = replay(read_trace(args[0]), client, opts.speed,
+                   opts.concurrency, opts.prefill)
+    print >>sys.stderr, format_stats(stats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,6 +19,12 @@ PACKAGES = find_packages(exclude=['tests.*',
                                   'examples.*',
                                   'examples'])
 ENTRY_POINTS = """
+[console_scripts]
+beansdb-bulkload = douban.beansdb.bulkload:main
+beansdb-diff = douban.beansdb.antientropy:main
+beansdb-export = douban.beansdb.export:main
+beansdb-rebalance = douban.beansdb.rebalance:main
+beansdb-replay = douban.beansdb.trace:main
 """
 
 # dependencies
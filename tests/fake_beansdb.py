@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fake_beansdb.py
+
+An in-memory stand-in for a beansdb node which speaks the cmemcached API,
+including revisions, `?key` meta and `@prefix` hash listings.
+"""
+
+import time
+import zlib
+
+from douban.beansdb import MCStore, fnv1a
+
+
+def _hash(ver, value):
+    return (zlib.crc32('%d:%r' % (ver, value)) & 0xffff)
+
+
+class FakeBeansdb(object):
+
+    def __init__(self, leaf_depth=2):
+        self.items = {}  # key -> [ver, value, flag]
+        self.leaf_depth = leaf_depth
+        self.down = False
+        self.delay = 0
+        self.poll_timeout = None
+        self.last_error = 0
+
+    def set_behavior(self, behavior, value):
+        from cmemcached import BEHAVIOR_POLL_TIMEOUT
+        if behavior == BEHAVIOR_POLL_TIMEOUT:
+            self.poll_timeout = value / 1000.0
+
+    def _call(self):
+        if self.delay:
+            if self.poll_timeout is not None \
+                    and self.delay > self.poll_timeout:
+                time.sleep(self.poll_timeout)
+                self.last_error = 1
+                return False
+            time.sleep(self.delay)
+        self.last_error = 1 if self.down else 0
+        return not self.down
+
+    def get_last_error(self):
+        return self.last_error
+
+    def get_last_strerror(self):
+        return 'fake server down' if self.last_error else ''
+
+    def _listing(self, prefix):
+        matched = [(k, v) for k, v in self.items.items()
+                   if ('%08x' % fnv1a(k)).startswith(prefix)]
+        if len(prefix) >= self.leaf_depth:
+            return ''.join('%s %d %d\n' % (k, _hash(ver, value), ver)
+                           for k, (ver, value, flag) in sorted(matched))
+        lines = []
+        for c in '0123456789abcdef':
+            sub = [(k, v) for k, v in matched
+                   if ('%08x' % fnv1a(k))[len(prefix)] == c]
+            h = sum(fnv1a(k) * 97 + _hash(ver, value)
+                    for k, (ver, value, flag) in sub) & 0xffffffff
+            lines.append('%s/ %d %d\n' % (c, h, len(sub)))
+        return ''.join(lines)
+
+    def _get(self, key):
+        if key.startswith('@'):
+            return self._listing(key[1:])
+        if key.startswith('?'):
+            it = self.items.get(key[1:])
+            if it is None:
+                return None
+            return '%d %d %d %d %d 0 0' % (
+                it[0], _hash(it[0], it[1]), it[2], len(repr(it[1])),
+                int(time.time()))
+        it = self.items.get(key)
+        if it is not None and it[0] > 0:
+            return it[1]
+
+    def get(self, key):
+        if self._call():
+            return self._get(key)
+
+    def get_raw(self, key):
+        if not self._call():
+            return None, 0
+        it = self.items.get(key)
+        if it is not None and it[0] > 0:
+            return it[1], it[2]
+        return None, 0
+
+    def get_multi(self, keys):
+        if not self._call():
+            return {}
+        rs = {}
+        for k in keys:
+            v = self._get(k)
+            if v is not None:
+                rs[k] = v
+        return rs
+
+    def _set(self, key, value, rev=0, flag=0):
+        old = self.items.get(key)
+        oldver = abs(old[0]) if old else 0
+        if rev < 0:
+            # the deletion of another replica
+            if -rev > oldver:
+                self.items[key] = [rev, None, 0]
+            return True
+        if rev > 0:
+            if rev <= oldver:
+                return True
+            ver = rev
+        else:
+            ver = oldver + 1
+        self.items[key] = [ver, value, flag]
+        return True
+
+    def set(self, key, value, rev=0):
+        return self._call() and self._set(key, value, rev)
+
+    def set_raw(self, key, data, rev=0, flag=0):
+        return self._call() and self._set(key, data, rev, flag)
+
+    def set_multi(self, values, return_failure=False, time=0):
+        if not self._call():
+            return (False, list(values)) if return_failure else False
+        for k, v in values.iteritems():
+            self._set(k, v)
+        return (True, []) if return_failure else True
+
+    def _delete(self, key):
+        old = self.items.get(key)
+        if old is None or old[0] < 0:
+            return False
+        self.items[key] = [-(old[0] + 1), None, 0]
+        return True
+
+    def delete(self, key, time=0):
+        return self._call() and self._delete(key)
+
+    def delete_multi(self, keys, return_failure=False, time=0):
+        if not self._call():
+            return (False, list(keys)) if return_failure else False
+        for k in keys:
+            self._delete(k)
+        return (True, []) if return_failure else True
+
+    def incr(self, key, value):
+        if not self._call():
+            return 0
+        it = self.items.get(key)
+        v = int(it[1]) + value if it and it[0] > 0 else value
+        self._set(key, v)
+        return v
+
+
+class FakeBeansdbStore(MCStore):
+
+    """MCStore over a FakeBeansdb, nodes are shared by address."""
+
+    nodes = {}
+
+    def __init__(self, addr, threaded=True, serializer=None, limit=None,
+                 **kwargs):
+        self.addr = addr
+        self.serializer = serializer
+        if limit is not None:
+            self.limit = limit()
+        self.mc = self.nodes.setdefault(addr, FakeBeansdb())
+
+    @classmethod
+    def reset(cls):
+        cls.nodes.clear()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_antientropy.py
+"""
+
+import unittest
+
+from douban.beansdb import BeansdbClient
+from douban.beansdb.antientropy import ReplicaDiff
+
+from fake_beansdb import FakeBeansdb, FakeBeansdbStore
+from test_beansdb_client import keys_with_prefix
+
+
+class LocalBeansdbClient(BeansdbClient):
+    store_cls = FakeBeansdbStore
+
+
+class ReplicaDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.db = LocalBeansdbClient(['a', 'b', 'c'], buckets_count=16)
+        self.keys = [k for i in range(16)
+                     for k in keys_with_prefix('%x' % i, 20)]
+        self.db.set_multi(dict((k, 'v:' + k) for k in self.keys))
+        self.a, self.b, self.c = [FakeBeansdbStore.nodes[n] for n in 'abc']
+
+    def test_in_sync(self):
+        d = ReplicaDiff(self.db)
+        self.assertEqual(d.run(), [])
+        # only the bucket listings
+        self.assertEqual(d.stats['listings'], 16 * 3)
+
+    def test_find_divergence(self):
+        k1, k2, k3 = self.keys[5], self.keys[100], self.keys[200]
+        self.a._set(k1, 'new')
+        self.b._delete(k2)
+        del self.c.items[k3]
+        d = ReplicaDiff(self.db)
+        found = dict(d.run())
+        self.assertEqual(found, {k1: dict(a=2, b=1, c=1),
+                                 k2: dict(a=1, b=-2, c=1),
+                                 k3: dict(a=1, b=1, c=0)})
+        # 16 buckets, then a leaf directory for each divergent key
+        self.assertEqual(d.stats['listings'], 16 * 3 + 3 * 3)
+
+    def test_repair(self):
+        k1, k2, k3 = self.keys[5], self.keys[100], self.keys[200]
+        self.a._set(k1, 'new')
+        self.b._delete(k2)
+        del self.c.items[k3]
+        found = self.db.diff(parallel=4, repair=True)
+        self.assertEqual(len(found), 3)
+        self.assertEqual(self.db.diff(), [])
+        for node in (self.a, self.b, self.c):
+            self.assertEqual(node.items[k1][:2], [2, 'new'])
+            self.assertEqual(node.items[k2][0], -2)
+            self.assertEqual(node.items[k3][:2], [1, 'v:' + k3])
+
+    def test_repair_raw_value(self):
+        k = self.keys[5]
+        self.a._set(k, 'packed', flag=4)
+        d = ReplicaDiff(self.db, repair=True)
+        self.assertEqual(len(d.run()), 1)
+        self.assertEqual(d.stats['repaired'], 1)
+        for node in (self.b, self.c):
+            self.assertEqual(node.items[k], [2, 'packed', 4])
+
+    def test_deleted_everywhere(self):
+        k1, k2 = self.keys[5], self.keys[100]
+        for node in (self.a, self.b, self.c):
+            node._delete(k1)
+            node._delete(k2)
+        self.a._set(k1, 'again')
+        self.a._delete(k1)
+        del self.c.items[k2]
+        d = ReplicaDiff(self.db, repair=True)
+        self.assertEqual(d.run(), [])
+        self.assertEqual((d.stats['divergent'], d.stats['repaired']), (0, 0))
+        for node in (self.a, self.b, self.c):
+            self.assertEqual(node.items[k1][0], -4)
+            self.assertEqual(node.items[k2][0], -2)
+        d = ReplicaDiff(self.db)
+        d.run()
+        self.assertEqual(d.stats['listings'], 16 * 3)
+
+    def test_replica_far_behind(self):
+        missing = self.keys[:5]  # of bucket 0
+        for k in missing:
+            del self.c.items[k]
+        # with the key counts of the filled replicas
+        db = LocalBeansdbClient(['a', 'b', 'c'], buckets_count=16)
+        self.assertFalse(db.servers[2] in db._get_bucket_servers(0))
+        d = ReplicaDiff(db, repair=True)
+        self.assertEqual(sorted(k for k, _ in d.run()), sorted(missing))
+        self.assertEqual(d.stats['repaired'], len(missing))
+        for k in missing:
+            self.assertEqual(self.c.items[k][:2], [1, 'v:' + k])
+
+    def test_conflict(self):
+        k = self.keys[0]
+        self.a.items[k][1] = 'other'
+        d = ReplicaDiff(self.db, repair=True)
+        self.assertEqual(len(d.run()), 1)
+        self.assertEqual(d.stats['conflicts'], 1)
+        self.assertEqual(self.a.items[k][1], 'other')
+
+    def test_tree_split_differently(self):
+        node = FakeBeansdb(leaf_depth=3)
+        node.items = dict((k, list(v)) for k, v in self.a.items.items())
+        FakeBeansdbStore.nodes['a'].items = node.items
+        self.db.servers[0].mc = node
+        self.assertEqual(self.db.diff(), [])
+        k = self.keys[7]
+        node._set(k, 'new')
+        self.assertEqual([key for key, _ in self.db.diff()], [k])
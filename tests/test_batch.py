@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_batch.py
+"""
+
+import unittest
+from mock import patch
+
+from douban.beansdb import BeansdbClient, BeansDBProxy, WriteFailedError, \
+    ReadFailedError
+from douban.beansdb import parallel
+
+from fake_beansdb import FakeBeansdbStore
+
+
+class LocalBeansdbClient(BeansdbClient):
+    store_cls = FakeBeansdbStore
+
+
+class LocalBeansDBProxy(BeansDBProxy):
+    store_cls = FakeBeansdbStore
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.db = LocalBeansdbClient(['a', 'b', 'c'], buckets_count=16)
+        self.db.set('x', 'old')
+
+    def test_mixed(self):
+        with self.db.batch() as b:
+            x = b.get('x')
+            y = b.get('y', 'none')
+            e = b.exists('x')
+            s = b.set('z', [1, 2])
+            d = b.delete('w')
+        self.assertEqual(x.result(), 'old')
+        self.assertEqual(y.result(), 'none')
+        self.assertEqual(e.result(), True)
+        self.assertEqual(s.result(), True)
+        self.assertEqual(d.result(), True)
+        self.assertEqual(self.db.get('z'), [1, 2])
+
+    def test_one_multi_call_per_kind(self):
+        b = self.db.batch()
+        for i in range(10):
+            b.get('k%d' % i)
+            b.set('v%d' % i, i)
+        with patch.object(self.db, 'get_multi',
+                          wraps=self.db.get_multi) as get_multi:
+            with patch.object(self.db, 'set_multi',
+                              wraps=self.db.set_multi) as set_multi:
+                rs = b.flush()
+        self.assertEqual(get_multi.call_count, 1)
+        self.assertEqual(set_multi.call_count, 1)
+        self.assertEqual(rs, [None, True] * 10)
+        self.assertEqual(len(b), 0)
+
+    def test_order_of_a_key(self):
+        b = self.db.batch()
+        before = b.get('x')
+        b.set('x', 'new')
+        after = b.get('x')
+        b.delete('x')
+        gone = b.get('x', 'gone')
+        self.assertEqual(len(b._rounds(b._ops)), 5)
+        b.flush()
+        self.assertEqual((before.result(), after.result(), gone.result()),
+                         ('old', 'new', 'gone'))
+
+    def test_flush_with_one_thread_per_pool(self):
+        # the multi operations fan out again, never in the pool they run in
+        with patch.object(parallel, 'POOL_SIZE', 1):
+            with patch.dict(parallel._pools, clear=True):
+                with self.db.batch(timeout=5) as b:
+                    x = b.get('x')
+                    s = b.set('y', 1)
+                    d = b.delete('z')
+                self.assertEqual((x.result(), s.result(), d.result()),
+                                 ('old', True, True))
+                self.assertEqual(dict(self.db.iter_multi(['x', 'y'])),
+                                 {'x': 'old', 'y': 1})
+
+    def test_not_flushed(self):
+        b = self.db.batch()
+        f = b.get('x')
+        self.assertRaises(RuntimeError, f.result)
+        try:
+            with b:
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertFalse(f.done)
+
+
+class BatchErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+
+    def test_proxy_down(self):
+        db = LocalBeansDBProxy(['p1'])
+        db.set('x', 'old')
+        FakeBeansdbStore.nodes['p1'].down = True
+        b = db.batch()
+        g = b.get('x')
+        s = b.set('y', 1)
+        rs = b.flush()
+        self.assert_(isinstance(rs[0], ReadFailedError))
+        self.assert_(isinstance(rs[1], WriteFailedError))
+        self.assertRaises(ReadFailedError, g.result)
+        self.assertEqual(s.exception(), rs[1])
+
+    def test_failed_keys_only(self):
+        db = LocalBeansdbClient(['a', 'b'], buckets_count=16)
+        db._check_update()
+        with patch.object(db, 'set_multi',
+                          side_effect=WriteFailedError(['bad'])):
+            b = db.batch()
+            good = b.set('good', 1)
+            bad = b.set('bad', 2)
+            b.flush()
+        self.assertEqual(good.result(), True)
+        self.assertRaises(WriteFailedError, bad.result)
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_beansdb_client.py
+"""
+
+import time
+import unittest
+from mock import patch
+
+from douban.beansdb import BeansdbClient, BeansDBProxy, MCStore, fnv1a, \
+    bucket_depth, Deadline, ReadFailedError, WriteFailedError, \
+    DeleteFailedError
+
+from fake_beansdb import FakeBeansdb, FakeBeansdbStore
+
+
+class LocalBeansdbClient(BeansdbClient):
+    store_cls = FakeBeansdbStore
+
+
+def keys_with_prefix(prefix, n, start=0):
+    """n keys whose hashes start with the hex prefix."""
+    r = []
+    i = start
+    while len(r) < n:
+        k = 'key:%d' % i
+        if ('%08x' % fnv1a(k)).startswith(prefix):
+            r.append(k)
+        i += 1
+    return r
+
+
+class BucketsCountTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+
+    def client(self, **kw):
+        db = LocalBeansdbClient(['a', 'b'], **kw)
+        self.a, self.b = [s.mc for s in db.servers]
+        return db
+
+    def test_bucket_depth(self):
+        self.assertEqual(bucket_depth(16), 1)
+        self.assertEqual(bucket_depth(4096), 3)
+        self.assertRaises(ValueError, bucket_depth, 100)
+        self.assertRaises(ValueError, LocalBeansdbClient, ['a'],
+                          buckets_count=32)
+
+    def test_route_by_256_buckets(self):
+        db = self.client(buckets_count=256)
+        ka, = keys_with_prefix('00', 1)
+        kb, = keys_with_prefix('01', 1)
+        self.a.set(ka, 'v')
+        self.b.set(kb, 'v')
+        self.assertEqual(len(db.buckets), 0)
+        self.assertEqual([s.addr for s in db._get_servers(ka)], ['a'])
+        self.assertEqual([s.addr for s in db._get_servers(kb)], ['b'])
+        self.assertEqual(len(db.buckets), 256)
+
+    def test_route_by_16_buckets(self):
+        db = self.client(buckets_count=16)
+        ka, = keys_with_prefix('00', 1)
+        kb, = keys_with_prefix('01', 1)
+        self.a.set(ka, 'v')
+        self.b.set(kb, 'v')
+        self.assertEqual(sorted(s.addr for s in db._get_servers(ka)),
+                         ['a', 'b'])
+
+    def test_discover_buckets_count(self):
+        db = self.client()
+        for k in keys_with_prefix('0', 512):
+            if ('%08x' % fnv1a(k))[1] < '8':
+                self.a.set(k, 'v')
+            else:
+                self.b.set(k, 'v')
+        db.get('k')
+        self.assertEqual(db.buckets_count, 256)
+
+    def test_discover_16_buckets(self):
+        db = self.client()
+        for k in keys_with_prefix('', 16 * 300):
+            self.a.set(k, 'v')
+        db.get('k')
+        self.assertEqual(db.buckets_count, 16)
+
+    def fill_256(self):
+        # a holds the buckets 00-0f and 10-17, b 18-1f
+        for k in keys_with_prefix('0', 300):
+            self.a.set(k, 'v')
+        for k in keys_with_prefix('1', 600):
+            (self.a if ('%08x' % fnv1a(k))[1] < '8' else self.b).set(k, 'v')
+
+    def test_discover_past_complete_directory(self):
+        db = self.client()
+        self.fill_256()
+        db.get('k')
+        self.assertEqual(db.buckets_count, 256)
+
+    def test_ambiguous_layout(self):
+        db = self.client()
+        for k in keys_with_prefix('0', 300):
+            self.a.set(k, 'v')
+        for k in keys_with_prefix('1', 600):
+            if ('%08x' % fnv1a(k))[1] < '8':
+                self.a.set(k, 'v')
+        self.assertRaises(ValueError, db.get, 'k')
+        self.assertRaises(ValueError, self.client().get, 'k')  # empty
+
+    def test_rediscover_on_update(self):
+        db = self.client()
+        self.fill_256()
+        db.update()
+        self.assertEqual(db.buckets_count, 256)
+        self.a.items.update(self.b.items)
+        self.b.items.clear()
+        with patch('douban.beansdb.log') as log:
+            db.update()
+        self.assertEqual(db.buckets_count, 16)
+        self.assertEqual(len(db.buckets), 16)
+        self.assert_('changed from 256 to 16' in log.call_args[0][0])
+        configured = self.client(buckets_count=256)
+        configured.update()
+        self.assertEqual(configured.buckets_count, 256)
+
+
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.db = LocalBeansdbClient(['a', 'b'], buckets_count=16)
+        self.keys = set('scan:%d' % i for i in range(200))
+        for k in self.keys:
+            self.db.set(k, 'v')
+
+    def test_scan_all_keys(self):
+        items = list(self.db.scan())
+        self.assertEqual(set(k for k, h, ver in items), self.keys)
+        self.assertEqual(len(items), len(self.keys))
+        self.assertTrue(all(ver == 1 for k, h, ver in items))
+
+    def test_scan_deleted(self):
+        self.db.delete('scan:0')
+        self.assertTrue('scan:0' not in set(k for k, _, _ in self.db.scan()))
+        deleted = [(k, ver) for k, _, ver in self.db.scan(deleted=True)
+                   if k == 'scan:0']
+        self.assertEqual(deleted, [('scan:0', -2)])
+
+    def test_scan_buckets_in_parallel(self):
+        self.assertEqual(set(k for k, _, _ in self.db.scan(parallel=4)),
+                         self.keys)
+
+    def test_scan_256_buckets(self):
+        db = LocalBeansdbClient(['a', 'b'], buckets_count=256)
+        self.assertEqual(set(k for k, _, _ in db.scan(parallel=3)),
+                         self.keys)
+
+    def test_resume(self):
+        for parallel in (1, 3):
+            scanner = self.db.scan(parallel=parallel)
+            it = iter(scanner)
+            first = set(it.next()[0] for i in range(80))
+            cursor = scanner.cursor
+            it.close()
+            self.assertTrue(cursor)
+            rest = set(k for k, _, _ in self.db.scan(cursor=cursor))
+            self.assertEqual(first | rest, self.keys)
+            self.assertTrue(len(first & rest) < 40)
+
+    def test_resume_finished(self):
+        scanner = self.db.scan(buckets=[1, 2])
+        list(scanner)
+        self.assertEqual(scanner.cursor, '1~,2~')
+        self.assertEqual(list(self.db.scan(cursor=scanner.cursor,
+                                           buckets=[1, 2])), [])
+
+
+class CountingStore(MCStore):
+    connected = []
+
+    @staticmethod
+    def connector(addr, **kw):
+        CountingStore.connected.append(addr)
+        return FakeBeansdb()
+
+
+class LazyConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        CountingStore.connected = []
+
+    def test_connect_at_first_request(self):
+        for threaded in (True, False):
+            CountingStore.connected = []
+            s = CountingStore('x', threaded=threaded)
+            self.assertEqual(CountingStore.connected, [])
+            s.set('k', 'v')
+            self.assertEqual(s.get('k'), 'v')
+            self.assertEqual(CountingStore.connected, ['x'])
+
+    def test_reconnect_after_fork(self):
+        s = CountingStore('x', threaded=False)
+        s.warmup()
+        with patch('os.getpid') as mock_getpid:
+            mock_getpid.return_value = -1
+            s.get('k')
+            s.get('k')
+        self.assertEqual(CountingStore.connected, ['x', 'x'])
+
+    def test_client_warmup(self):
+        FakeBeansdbStore.reset()
+        db = LocalBeansdbClient(['a', 'b', 'c'], buckets_count=16)
+        FakeBeansdbStore.nodes['c'].down = True
+        self.assertEqual(db.warmup(), 2)
+        self.assertEqual(len(db.buckets), 16)
+        self.assertTrue(db.last_update > 0)
+        self.assertEqual(db.stat[2], None)
+
+
+class LocalBeansDBProxy(BeansDBProxy):
+    store_cls = FakeBeansdbStore
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+
+    def assertFailsWithin(self, seconds, func, *args, **kw):
+        t = time.time()
+        self.assertRaises(ReadFailedError, func, *args, **kw)
+        self.assertTrue(time.time() - t < seconds)
+
+    def test_deadline(self):
+        self.assertEqual(Deadline().remaining(), None)
+        d = Deadline.of(None, 10)
+        self.assertTrue(9 < d.remaining() <= 10)
+        self.assertTrue(Deadline.of(d) is d)
+
+    def test_proxy_failover_stops_at_deadline(self):
+        db = LocalBeansDBProxy(['p1', 'p2', 'p3'])
+        for node in FakeBeansdbStore.nodes.values():
+            node.delay = 1
+        self.assertFailsWithin(0.5, db.get, 'k', timeout=0.2)
+        self.assertFailsWithin(0.5, db.get_multi, ['k'], timeout=0.2)
+        for node in FakeBeansdbStore.nodes.values():
+            self.assertEqual(node.poll_timeout, 3)
+
+    def test_unthreaded_store_keeps_poll_timeout(self):
+        s = FakeBeansdbStore('p1')
+        s.threaded = False
+        with s.time_limit(0.2):
+            self.assertEqual(s.mc.poll_timeout, None)
+        s.threaded = True
+        with s.time_limit(0.2):
+            self.assertEqual(s.mc.poll_timeout, 0.2)
+
+    def test_client_default_timeout(self):
+        db = LocalBeansDBProxy(['p1', 'p2'], timeout=0.2)
+        for s in db.servers:
+            s.set('k', 'v')
+            s.mc.delay = 1
+        self.assertEqual(db.get('k', timeout=2), 'v')
+        self.assertFailsWithin(0.5, db.get, 'k')
+
+    def test_beansdb_client_replicas(self):
+        db = LocalBeansdbClient(['a', 'b', 'c'], buckets_count=16)
+        db.set('k', 'v')
+        for node in FakeBeansdbStore.nodes.values():
+            node.delay = 1
+        self.assertFailsWithin(0.5, db.get, 'k', timeout=0.2)
+
+
+class AffinityTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.db = LocalBeansdbClient(['a', 'b', 'c'], buckets_count=16,
+                                     affinity=True)
+        self.keys = ['key:%d' % i for i in range(3000)]
+
+    def primaries(self):
+        return [self.db._get_servers(k)[0].addr for k in self.keys]
+
+    def test_stable_and_balanced(self):
+        first = self.primaries()
+        self.db.update()
+        self.assertEqual(self.primaries(), first)
+        for addr in 'abc':
+            self.assertTrue(900 < first.count(addr) < 1100)
+
+    def test_fallback(self):
+        k = self.keys[0]
+        self.db.set(k, 'v')
+        primary = self.db._get_servers(k)[0]
+        primary.mc.down = True
+        self.assertEqual(self.db.get(k), 'v')
+        self.assertEqual(self.db.get_multi([k]), {k: 'v'})
+
+    def test_get_multi_reads_primaries(self):
+        keys = self.keys[:30]
+        self.db.set_multi(dict((k, k) for k in keys))
+        asked = {}
+        for s in self.db.servers:
+            s.mc.get_multi = (lambda mc, addr: lambda ks: asked.setdefault(
+                addr, []).extend(ks) or FakeBeansdb.get_multi(mc, ks))(
+                    s.mc, s.addr)
+        self.assertEqual(self.db.get_multi(keys), dict((k, k) for k in keys))
+        for addr, ks in asked.items():
+            self.assertEqual(
+                sorted(ks), sorted(k for k in keys
+                                   if self.db._get_servers(k)[0].addr == addr))
+
+
+class WriteMultiTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.partial = []
+        self.db = LocalBeansdbClient(
+            ['a', 'b', 'c'], buckets_count=16,
+            on_partial_write=lambda op, ks: self.partial.append(
+                (op, sorted(ks))))
+        self.db._check_update()
+        self.nodes = FakeBeansdbStore.nodes
+        self.values = dict(('key:%d' % i, i) for i in range(10))
+
+    def test_quorum(self):
+        self.nodes['a'].down = True
+        self.assertTrue(self.db.set_multi(self.values))
+        self.assertEqual(self.partial, [('set', sorted(self.values))])
+        self.assertEqual(self.db.get_multi(self.values.keys()), self.values)
+        self.assertTrue(self.db.delete_multi(['key:1']))
+        self.assertEqual(self.partial[-1], ('delete', ['key:1']))
+
+    def test_bucket_listed_on_fewer_servers(self):
+        self.db.buckets = [ss[:2] for ss in self.db.buckets]
+        self.assertTrue(self.db.set_multi(self.values))
+        self.assertEqual(self.partial, [('set', sorted(self.values))])
+
+    def test_fail_without_quorum(self):
+        self.nodes['a'].down = True
+        self.nodes['b'].down = True
+        try:
+            self.db.set_multi(self.values)
+            self.fail('no WriteFailedError')
+        except WriteFailedError, e:
+            self.assertEqual(sorted(e.key), sorted(self.values))
+        self.assertRaises(DeleteFailedError, self.db.delete_multi, ['key:1'])
+
+    def test_all_acked(self):
+        self.db.set_multi(self.values)
+        self.db.delete_multi(self.values.keys())
+        self.assertEqual(self.partial, [])
+
+    def test_concurrent(self):
+        for node in self.nodes.values():
+            node.delay = 0.2
+        t = time.time()
+        self.db.set_multi(self.values)
+        self.assertTrue(time.time() - t < 0.4)
+        for node in self.nodes.values():
+            node.delay = 1
+        t = time.time()
+        self.assertRaises(WriteFailedError, self.db.set_multi, self.values,
+                          timeout=0.2)
+        self.assertTrue(time.time() - t < 0.5)
+
+
+class IterMultiTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.keys = ['key:%d' % i for i in range(250)]
+
+    def check(self, db):
+        db.set_multi(dict((k, 'v:' + k) for k in self.keys[::2]))
+        keys = iter(self.keys)  # any iterable
+        rs = list(db.iter_multi(keys, default='-', batch_size=40,
+                                ordered=True))
+        self.assertEqual([k for k, v in rs], self.keys)
+        self.assertEqual(rs[0], ('key:0', 'v:key:0'))
+        self.assertEqual(rs[1], ('key:1', '-'))
+        rs = dict(db.iter_multi(self.keys, batch_size=40, parallel=4))
+        self.assertEqual(len(rs), len(self.keys))
+        self.assertEqual(rs['key:1'], None)
+
+    def test_client(self):
+        self.check(LocalBeansdbClient(['a', 'b'], buckets_count=16))
+
+    def test_proxy(self):
+        self.check(LocalBeansDBProxy(['p1']))
+
+    def test_cache_wrapper(self):
+        from douban.beansdb import CacheWrapper
+        from douban.mc.debug import LocalMemcache
+        self.check(CacheWrapper(LocalBeansDBProxy(['p1']), LocalMemcache()))
+
+    def test_lazy(self):
+        db = LocalBeansDBProxy(['p1'])
+        consumed = []
+
+        def keys():
+            for k in self.keys:
+                consumed.append(k)
+                yield k
+        it = db.iter_multi(keys(), batch_size=10, parallel=2, ordered=True)
+        self.assertEqual(next(it)[0], 'key:0')
+        self.assertTrue(len(consumed) <= 30)
+
+    def test_error(self):
+        db = LocalBeansDBProxy(['p1'])
+        FakeBeansdbStore.nodes['p1'].down = True
+        self.assertRaises(ReadFailedError, list, db.iter_multi(self.keys))
+
+
+if __name__ == '__main__':
+    unittest.main()
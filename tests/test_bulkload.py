@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_bulkload.py
+"""
+
+import time
+import marshal
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+from mock import patch
+
+from douban.beansdb import BeansdbClient
+from douban.beansdb.bulkload import BulkLoader, read_records, _ServerStream
+
+from fake_beansdb import FakeBeansdbStore
+
+
+class LocalBeansdbClient(BeansdbClient):
+    store_cls = FakeBeansdbStore
+
+
+class BulkLoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.db = LocalBeansdbClient(['a', 'b', 'c'], buckets_count=16)
+        self.records = [('bulk:%d' % i, 'value:%d' % i) for i in range(500)]
+
+    def test_load(self):
+        reports = []
+        loader = BulkLoader(self.db, batch_size=20, progress=reports.append,
+                            progress_interval=0)
+        stats = loader.load(iter(self.records + [('none', None)]))
+        self.assertEqual(stats['records'], 500)
+        self.assertEqual(stats['written'], 500)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['failed_keys'], [])
+        self.assertTrue(reports)
+        self.assertEqual(self.db.get_multi([k for k, v in self.records]),
+                         dict(self.records))
+        for node in FakeBeansdbStore.nodes.values():
+            self.assertEqual(len(node.items), 500)
+
+    def test_quorum(self):
+        FakeBeansdbStore.nodes['a'].down = True
+        stats = BulkLoader(self.db).load(self.records)
+        self.assertEqual(stats['written'], 500)
+        FakeBeansdbStore.nodes['b'].down = True
+        stats = BulkLoader(self.db).load(self.records[:10])
+        self.assertEqual(stats['failed'], 10)
+        self.assertEqual(sorted(stats['failed_keys']),
+                         sorted(k for k, v in self.records[:10]))
+
+    def test_failed_keys_are_capped(self):
+        self.db._check_update()
+        for node in FakeBeansdbStore.nodes.values():
+            node.down = True
+        out = StringIO()
+        stats = BulkLoader(self.db, failed=out, max_failed_keys=3).load(
+            self.records[:10])
+        self.assertEqual(stats['failed'], 10)
+        self.assertEqual(len(stats['failed_keys']), 3)
+        self.assertEqual(sorted(out.getvalue().split()),
+                         sorted(k for k, v in self.records[:10]))
+
+    def test_thread_error_is_raised(self):
+        errors = []
+
+        def load():
+            try:
+                BulkLoader(self.db, streams=1, batch_size=10,
+                           min_batch_size=10).load(self.records)
+            except RuntimeError, e:
+                errors.append(e)
+        with patch.object(_ServerStream, '_adapt',
+                          side_effect=RuntimeError('boom')):
+            t = threading.Thread(target=load)
+            t.setDaemon(True)
+            t.start()
+            t.join(5)
+        self.assertFalse(t.isAlive())
+        self.assertEqual(len(errors), 1)
+
+    def test_duplicated_keys(self):
+        stats = BulkLoader(self.db).load([('k', 'v1'), ('k', 'v2')])
+        self.assertEqual(stats['written'], 1)
+        self.assertEqual(self.db.get('k'), 'v2')
+
+    def test_batch_size_adapts(self):
+        loader = BulkLoader(self.db, batch_size=20, min_batch_size=10,
+                            target_latency=1)
+        stats = loader.load(self.records)
+        self.assertTrue(all(n > 20 for n in stats['batch_sizes'].values()))
+
+    def test_max_rate(self):
+        t = time.time()
+        BulkLoader(self.db, max_rate=100).load(self.records[:20])
+        self.assertTrue(time.time() - t >= 0.19)
+
+
+def test_read_records():
+    f = StringIO('a\t1\nb\tx\ty\n\n')
+    assert list(read_records(f)) == [('a', '1'), ('b', 'x\ty')]
+    f = tempfile.TemporaryFile()
+    marshal.dump(('a', {'x': 1}), f)
+    marshal.dump(('b', 2), f)
+    f.seek(0)
+    assert list(read_records(f, 'marshal')) == [('a', {'x': 1}), ('b', 2)]
+
+
+if __name__ == '__main__':
+    unittest.main()
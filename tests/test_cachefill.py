@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_cachefill.py
+"""
+
+import unittest
+import os
+import Queue
+from mock import Mock
+
+from douban.beansdb import CacheWrapper, DelayCleaner, ONE_DAY, ONE_MINUTE
+from douban.beansdb.cachefill import CacheFillPipeline, TimerWheelCleaner
+from douban.mc.debug import LocalMemcache
+
+from test_beansdb import LocalBeansDBProxy
+
+
+class CacheFillPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc = Mock()
+        self.pipeline = CacheFillPipeline(self.mc, batch_size=100)
+
+    def test_fill_is_batched(self):
+        self.pipeline._send([(0, {'a': 1}, ONE_DAY), (0, {'b': 2}, ONE_DAY)])
+        self.mc.set_multi.assert_called_once_with({'a': 1, 'b': 2},
+                                                  time=ONE_DAY)
+
+    def test_cleaned_keys_are_not_filled(self):
+        self.pipeline._send([(0, {'a': 1, 'b': 2}, ONE_DAY),
+                             (1, ['a'], ONE_MINUTE)])
+        self.mc.set_multi.assert_called_once_with({'b': 2}, time=ONE_DAY)
+        self.mc.delete_multi.assert_called_once_with(['a'], time=ONE_MINUTE)
+
+    def test_flush(self):
+        self.pipeline.fill({'a': 1, 'b': None})
+        self.pipeline.clean_multi(['c', 'd'])
+        self.pipeline.flush()
+        self.mc.set_multi.assert_called_once_with({'a': 1}, time=ONE_DAY)
+        args, kw = self.mc.delete_multi.call_args
+        self.assertEqual(sorted(args[0]), ['c', 'd'])
+        self.assertEqual(kw, dict(time=ONE_MINUTE))
+
+    def test_full_queue(self):
+        self.pipeline._get_queue = lambda: FullQueue()
+        # fills are dropped, cleans are sent right now
+        self.pipeline.fill({'a': 1})
+        self.assertEqual(self.pipeline.dropped, 1)
+        self.assertFalse(self.mc.set_multi.called)
+        self.pipeline.clean_multi(['a'])
+        self.mc.delete_multi.assert_called_once_with(['a'], time=ONE_MINUTE)
+
+
+class FullQueue(object):
+
+    def put_nowait(self, item):
+        raise Queue.Full
+
+
+class BatchCleaner(DelayCleaner):
+
+    def __init__(self):
+        self.batches = []
+
+    def clean_multi(self, keys):
+        self.batches.append(sorted(keys))
+
+
+class CacheWrapperPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc = LocalMemcache()
+        self.pipeline = CacheFillPipeline(self.mc)
+        self.db = CacheWrapper(LocalBeansDBProxy(), self.mc,
+                               pipeline=self.pipeline)
+
+    def test_get_multi_fills_in_background(self):
+        self.db.db.set_multi({'a': 1, 'b': 2})
+        self.assertEqual(self.db.get_multi(['a', 'b', 'c']),
+                         {'a': 1, 'b': 2, 'c': None})
+        self.pipeline.flush()
+        self.assertEqual(self.mc.get_multi(['a', 'b', 'c']),
+                         {'a': 1, 'b': 2})
+
+    def test_pipeline_is_the_delay_cleaner(self):
+        self.assert_(self.db.delay_cleaner is self.pipeline)
+        self.assert_(self.db.set('a', 1))
+        self.pipeline.flush()
+        self.assertEqual(self.mc.get('a'), None)
+        self.assertEqual(self.db.get('a'), 1)
+
+    def test_delay_cleaner_gets_all_keys_at_once(self):
+        cleaner = BatchCleaner()
+        db = CacheWrapper(LocalBeansDBProxy(), self.mc,
+                          delay_cleaner=cleaner)
+        db.set_multi({'a': 1, 'b': 2})
+        db.delete_multi(['a', 'b'])
+        db.delete('a')
+        self.assertEqual(cleaner.batches, [['a', 'b'], ['a', 'b'], ['a']])
+
+    def test_delay_cleaner_of_one_key_at_a_time(self):
+        cleaned = []
+
+        class KeyCleaner(DelayCleaner):
+            def __call__(self, key):
+                cleaned.append(key)
+        db = CacheWrapper(LocalBeansDBProxy(), self.mc,
+                          delay_cleaner=KeyCleaner())
+        db.set_multi({'a': 1, 'b': 2})
+        db.delete('a')
+        self.assertEqual(sorted(cleaned[:2]), ['a', 'b'])
+        self.assertEqual(cleaned[2:], ['a'])
+
+
+class TimerWheelCleanerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc = Mock()
+        self.cleaner = TimerWheelCleaner(self.mc, delay=3, tick=1,
+                                         batch_size=2)
+        self.cleaner._pid = os.getpid()  # no background thread
+
+    def deleted(self):
+        return sorted(k for args, kw in self.mc.delete_multi.call_args_list
+                      for k in args[0])
+
+    def test_fire_after_delay(self):
+        self.cleaner('a')
+        for i in range(3):
+            self.assertEqual(self.deleted(), [])
+            self.cleaner.advance()
+        self.assertEqual(self.deleted(), [])
+        self.cleaner.advance()
+        self.assertEqual(self.deleted(), ['a'])
+        self.assertEqual(self.cleaner.pending, 0)
+
+    def test_coalesce(self):
+        self.cleaner.clean_multi(['a', 'b', 'c'])
+        self.cleaner.advance()
+        self.cleaner.clean_multi(['a'])
+        self.cleaner.advance()
+        self.cleaner.advance()
+        self.cleaner.advance()
+        # in batches of 2
+        self.assertEqual(self.mc.delete_multi.call_count, 1)
+        self.assertEqual(self.deleted(), ['b', 'c'])
+        self.cleaner.advance()
+        self.assertEqual(self.deleted(), ['a', 'b', 'c'])
+        self.assertEqual(self.cleaner.coalesced, 1)
+
+    def test_batches_and_flush(self):
+        self.cleaner.clean_multi(['a', 'b', 'c'])
+        self.cleaner.flush()
+        self.assertEqual(self.mc.delete_multi.call_count, 2)
+        self.assertEqual(self.deleted(), ['a', 'b', 'c'])
+        self.assertEqual(self.cleaner.pending, 0)
+
+    def test_with_cache_wrapper(self):
+        mc = LocalMemcache()
+        cleaner = TimerWheelCleaner(mc, delay=3)
+        cleaner._pid = os.getpid()
+        db = CacheWrapper(LocalBeansDBProxy(), mc, delay_cleaner=cleaner)
+        for i in range(10):
+            db.set('a', i)
+        mc.set('a', 'stale')
+        cleaner.flush()
+        self.assertEqual(mc.get('a'), None)
+        self.assertEqual(db.get('a'), 9)
+        self.assertEqual(cleaner.coalesced, 9)
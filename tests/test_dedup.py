@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_dedup.py
+"""
+
+import hashlib
+import threading
+import unittest
+from mock import patch
+
+from douban.beansdb.doubanfs import DoubanFS, OfflineDoubanFS
+from douban.beansdb import dedup
+from douban.beansdb.dedup import DedupFS, POINTER, blob_key
+
+from fake_beansdb import FakeBeansdbStore
+
+
+class LocalDoubanFS(DoubanFS):
+    store_cls = FakeBeansdbStore
+
+
+class LocalOfflineDoubanFS(OfflineDoubanFS):
+    store_cls = FakeBeansdbStore
+
+
+class DedupFSTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.raw = LocalDoubanFS(['p1'])
+        self.fs = DedupFS(self.raw)
+        self.digest = hashlib.sha1('image').hexdigest()
+
+    def test_store_once(self):
+        self.assert_(self.fs.set('/a.jpg', 'image'))
+        self.assert_(self.fs.set('/b.jpg', 'image'))
+        self.assertEqual(self.fs.get('/a.jpg'), 'image')
+        self.assertEqual(self.fs.get('/b.jpg'), 'image')
+        self.assertEqual(self.raw.get('/a.jpg'), POINTER + self.digest)
+        self.assertEqual(self.raw.get(blob_key(self.digest)), 'image')
+
+    def test_skip_upload_of_stored_blob(self):
+        self.fs.set('/a.jpg', 'image')
+        node = FakeBeansdbStore.nodes['p1']
+        ver = node.items[blob_key(self.digest)][0]
+        self.fs.set('/b.jpg', 'image')
+        self.assertEqual(node.items[blob_key(self.digest)][0], ver)
+
+    def test_overwrite_and_delete(self):
+        self.fs.set('/a.jpg', 'image')
+        self.fs.set('/b.jpg', 'image')
+        self.fs.set('/a.jpg', 'other')
+        self.assert_(self.fs.delete('/b.jpg'))
+        self.assertEqual(self.fs.get('/b.jpg'), None)
+        self.assertEqual(self.fs.get('/a.jpg'), 'other')
+
+    def test_rename_moves_the_pointer(self):
+        self.fs.set('/a.jpg', 'image')
+        self.assert_(self.fs.rename('/a.jpg', '/b.jpg'))
+        self.assertEqual(self.fs.get('/a.jpg'), None)
+        self.assertEqual(self.fs.get('/b.jpg'), 'image')
+        self.assertEqual(self.raw.get('/b.jpg'), POINTER + self.digest)
+        self.assertFalse(self.fs.rename('/a.jpg', '/c.jpg'))
+
+    def test_failed_upload_writes_no_pointer(self):
+        set = self.raw.set
+        self.raw.set = lambda path, *args, **kwargs: \
+            not path.startswith('/.blob/') and set(path, *args, **kwargs)
+        self.assertFalse(self.fs.set('/a.jpg', 'image'))
+        self.assertEqual(self.raw.get('/a.jpg'), None)
+
+    def test_multi(self):
+        self.raw.set('/old.jpg', 'old')
+        self.assert_(self.fs.set_multi({'/a.jpg': 'image', '/b.jpg': 'image'}))
+        rs = self.fs.get_multi(['/a.jpg', '/b.jpg', '/old.jpg', '/missing'])
+        self.assertEqual(rs['/a.jpg'], 'image')
+        self.assertEqual(rs['/b.jpg'], 'image')
+        self.assertEqual(rs['/old.jpg'], 'old')
+        self.assertEqual(rs.get('/missing'), None)
+        self.assert_(self.fs.delete_multi(['/a.jpg', '/b.jpg']))
+        self.assertEqual(self.fs.get_multi(['/a.jpg']).get('/a.jpg'), None)
+
+    def test_passthrough(self):
+        self.assertEqual(self.fs.timeout, self.raw.timeout)
+        self.assertRaises(AttributeError, getattr, self.fs, 'scan')
+
+    def test_files_stored_before(self):
+        self.raw.set('/old.jpg', 'image')
+        self.assertEqual(self.fs.get('/old.jpg'), 'image')
+        self.assert_(self.fs.rename('/old.jpg', '/new.jpg'))
+        self.assertEqual(self.raw.get('/new.jpg'), POINTER + self.digest)
+        self.assertEqual(self.fs.get('/new.jpg'), 'image')
+
+
+class DedupGCTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.fs = DedupFS(LocalOfflineDoubanFS(['a', 'b'], buckets_count=16))
+
+    def test_gc(self):
+        self.fs.set('/a.jpg', 'image')
+        self.fs.set('/b.jpg', 'image')
+        self.fs.set('/c.jpg', 'other')
+        self.fs.delete('/a.jpg')
+        self.fs.delete('/c.jpg')
+        self.assertEqual(self.fs.gc(grace=0), 1)
+        self.assertEqual(self.fs.get('/b.jpg'), 'image')
+        other = blob_key(hashlib.sha1('other').hexdigest())
+        self.assertEqual(self.fs.fs.get(other), None)
+        # written again after its blob was collected
+        self.fs.set('/c.jpg', 'other')
+        self.assertEqual(self.fs.get('/c.jpg'), 'other')
+        self.assertEqual(self.fs.gc(grace=0), 0)
+
+    def test_blob_taken_during_gc(self):
+        self.fs.set('/a.jpg', 'image')
+        self.fs.set('/c.jpg', 'other')
+        self.fs.delete('/a.jpg')
+        self.fs.delete('/c.jpg')
+        key = blob_key(hashlib.sha1('image').hexdigest())
+        raw = self.fs.fs
+
+        def taken(grace):
+            # by a path which looked for the mark before it was set
+            raw.set('/b.jpg', POINTER + hashlib.sha1('image').hexdigest())
+            # and by one which uploads it again
+            self.fs.set('/d.jpg', 'other')
+        with patch.object(dedup.time, 'sleep', side_effect=taken):
+            self.assertEqual(self.fs.gc(), 0)
+        self.assertEqual(self.fs.get('/b.jpg'), 'image')
+        self.assertEqual(self.fs.get('/d.jpg'), 'other')
+        self.assertEqual(raw.get(key + '.gc'), None)
+
+    def test_upload_racing_the_deletion(self):
+        self.fs.set('/a.jpg', 'image')
+        self.fs.delete('/a.jpg')
+        key = blob_key(hashlib.sha1('image').hexdigest())
+        s = self.fs.fs._get_servers(key)[0]
+        delete_at = s.delete_at
+
+        def deleted_after_upload(k, rev):
+            self.fs.set('/b.jpg', 'image')
+            return delete_at(k, rev)
+        with patch.object(s, 'delete_at', side_effect=deleted_after_upload):
+            self.fs.gc(grace=0)
+        self.assertEqual(self.fs.get('/b.jpg'), 'image')
+
+    def test_concurrent_writers(self):
+        self.fs.set('/a.jpg', 'image')
+        self.fs.set('/b.jpg', 'image')
+        ts = [threading.Thread(target=self.fs.set, args=('/a.jpg', 'v%d' % i))
+              for i in range(8)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        value = self.fs.get('/a.jpg')
+        self.assertEqual(self.fs.gc(grace=0), 7)
+        self.assertEqual(self.fs.get('/a.jpg'), value)
+        self.assertEqual(self.fs.get('/b.jpg'), 'image')
+        self.assertEqual(self.fs.gc(grace=0), 0)
+
+    def test_marked_blob_is_uploaded_again(self):
+        self.fs.set('/a.jpg', 'image')
+        self.fs.delete('/a.jpg')
+        key = blob_key(hashlib.sha1('image').hexdigest())
+        self.fs.fs.set(key + '.gc', 1)
+        node = FakeBeansdbStore.nodes['a']
+        ver = node.items[key][0]
+        self.fs.set('/b.jpg', 'image')
+        self.assertNotEqual(node.items[key][0], ver)
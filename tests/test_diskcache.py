@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_diskcache.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from douban.beansdb.diskcache import DiskCache, DiskCachedFS, HEADER
+from douban.beansdb.doubanfs import DoubanFS
+
+from fake_beansdb import FakeBeansdbStore
+
+
+def run_in_child(func):
+    """Run func in a forked process, fail if it raises."""
+    pid = os.fork()
+    if not pid:
+        code = 1
+        try:
+            func()
+            code = 0
+        finally:
+            os._exit(code)
+    assert os.waitpid(pid, 0)[1] == 0, 'failed in the child process'
+
+
+class LocalDoubanFS(DoubanFS):
+    store_cls = FakeBeansdbStore
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self, **kw):
+        kw.setdefault('segment_size', 1024)
+        kw.setdefault('max_size', 4096)
+        return DiskCache(self.dir, **kw)
+
+    def reopen(self, c):
+        c.close()
+        return self.cache()
+
+    def value_offset(self, c, key):
+        n, pos = c._index[key]
+        return c._segments[n].mm, pos + HEADER.size + len(key)
+
+    def test_put_get_delete(self):
+        c = self.cache()
+        self.assertEqual(c.get('/a'), None)
+        c.put('/a', 'avatar')
+        c.put('/b', '')
+        self.assertEqual(c.get('/a'), 'avatar')
+        self.assertEqual(c.get('/b'), '')
+        c.put('/a', 'new')
+        self.assertEqual(c.get('/a'), 'new')
+        c.delete('/a')
+        self.assertEqual(c.get('/a'), None)
+        self.assertEqual((c.hits, c.misses), (3, 2))
+
+    def test_view_is_zero_copy(self):
+        c = self.cache()
+        c.put('/a', 'avatar')
+        view = c.get_view('/a')
+        self.assertEqual(view.tobytes(), 'avatar')
+        mm, offset = self.value_offset(c, '/a')
+        mm[offset] = 'A'
+        self.assertEqual(view.tobytes(), 'Avatar')
+        # found by the crc when read again
+        self.assertEqual(c.get_view('/a'), None)
+        self.assertEqual(c.get('/a'), None)
+
+    def test_reopen(self):
+        c = self.cache()
+        for i in range(20):
+            c.put('/%d' % i, 'x' * 100)
+        c.delete('/19')
+        c = self.reopen(c)
+        self.assertEqual(c.get('/18'), 'x' * 100)
+        self.assertEqual(c.get('/19'), None)
+        c.put('/19', 'y')
+        self.assertEqual(self.reopen(c).get('/19'), 'y')
+
+    def test_torn_record(self):
+        c = self.cache()
+        c.put('/a', 'avatar')
+        c.put('/b', 'thumb')
+        mm, offset = self.value_offset(c, '/b')
+        mm[offset] = 'T'
+        c = self.reopen(c)
+        self.assertEqual(c.get('/a'), 'avatar')
+        self.assertEqual(c.get('/b'), None)
+        c.put('/c', 'icon')
+        self.assertEqual(self.reopen(c).get('/c'), 'icon')
+
+    def test_size_bound_and_eviction(self):
+        c = self.cache()
+        for i in range(100):
+            c.put('/%d' % i, 'x' * 100)
+        self.assertEqual(len(os.listdir(self.dir)), 4 + 1)  # and the lock
+        self.assertEqual(c.get('/0'), None)
+        self.assertEqual(c.get('/99'), 'x' * 100)
+        self.assert_(len(c) < 40)
+        self.assertEqual(c.get_view('/0'), None)
+
+    def test_hot_files_stay(self):
+        c = self.cache()
+        c.put('/hot', 'h' * 100)
+        for i in range(100):
+            c.put('/%d' % i, 'x' * 100)
+            self.assertEqual(c.get('/hot'), 'h' * 100)
+
+    def test_shared_by_the_processes(self):
+        c = self.cache()
+        c.put('/a', 'avatar')
+        other = self.cache()
+        self.assertEqual(other.get('/a'), 'avatar')
+        other.delete('/a')
+        other.put('/b', 'thumb')
+        self.assertEqual(c.get('/a'), None)
+        self.assertEqual(c.get('/b'), 'thumb')
+        for i in range(100):
+            c.put('/%d' % i, 'x' * 100)
+        # evicted by c, read again by other
+        self.assertEqual(len(os.listdir(self.dir)), 4 + 1)
+        self.assertEqual(other.get('/b'), None)
+        self.assertEqual(other.get('/99'), 'x' * 100)
+        other.close()
+
+    def test_put_by_a_child_process(self):
+        c = self.cache()
+        c.put('/a', 'avatar')
+        run_in_child(lambda: self.assertEqual(c.get('/a'), 'avatar')
+                     or c.put('/b', 'thumb') or c.delete('/a'))
+        self.assertEqual(c.get('/b'), 'thumb')
+        self.assertEqual(c.get('/a'), None)
+
+    def test_max_age(self):
+        c = self.cache()
+        c.put('/a', 'avatar')
+        self.assertEqual(c.get('/a', 60), 'avatar')
+        self.assertEqual(c.get('/a', -1), None)
+
+    def test_put_after_delete_is_dropped(self):
+        c = self.cache()
+        stamp = c.stamp('/a')
+        c.delete('/a')
+        c.put('/a', 'stale', stamp)
+        self.assertEqual(c.get('/a'), None)
+        c.put('/a', 'new', c.stamp('/a'))
+        self.assertEqual(c.get('/a'), 'new')
+
+    def test_too_large(self):
+        c = self.cache()
+        c.put('/big', 'x' * 2000)
+        self.assertEqual(c.get('/big'), None)
+
+
+class DiskCachedFSTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.dir = tempfile.mkdtemp()
+        self.fs = DiskCachedFS(LocalDoubanFS(['p1']), DiskCache(self.dir))
+        self.node = FakeBeansdbStore.nodes['p1']
+
+    def tearDown(self):
+        self.fs.cache.close()
+        shutil.rmtree(self.dir)
+
+    def test_read_through(self):
+        self.fs.set('/a.jpg', 'image')
+        self.assertEqual(self.fs.get('/a.jpg'), 'image')
+        self.node.down = True
+        self.assertEqual(self.fs.get('/a.jpg'), 'image')
+        self.assertEqual(self.fs.get_view('/a.jpg').tobytes(), 'image')
+
+    def test_invalidation(self):
+        self.fs.set('/a.jpg', 'image')
+        self.fs.get('/a.jpg')
+        self.fs.set('/a.jpg', 'new')
+        self.assertEqual(self.fs.get('/a.jpg'), 'new')
+        self.fs.get('/b.jpg')
+        self.fs.rename('/a.jpg', '/b.jpg')
+        self.assertEqual(self.fs.get('/a.jpg'), None)
+        self.assertEqual(self.fs.get('/b.jpg'), 'new')
+        self.fs.delete('/b.jpg')
+        self.assertEqual(self.fs.get('/b.jpg'), None)
+
+    def test_multi_invalidation(self):
+        self.fs.set_multi({'/a.jpg': 'image', '/b.jpg': 'thumb'})
+        self.assertEqual(self.fs.get_multi(['/a.jpg', '/b.jpg']),
+                         {'/a.jpg': 'image', '/b.jpg': 'thumb'})
+        self.fs.set_multi({'/a.jpg': 'new'})
+        self.assertEqual(self.fs.get('/a.jpg'), 'new')
+        self.fs.delete_multi(['/b.jpg'])
+        self.assertEqual(self.fs.get('/b.jpg'), None)
+        self.assertRaises(AttributeError, getattr, self.fs, 'get_raw')
+
+    def test_written_by_another_host(self):
+        self.fs.set('/a.jpg', 'image')
+        self.fs.get('/a.jpg')
+        self.fs.fs.set('/a.jpg', 'new')
+        self.assertEqual(self.fs.get('/a.jpg'), 'image')
+        self.fs.ttl = -1
+        self.assertEqual(self.fs.get('/a.jpg'), 'new')
+
+    def test_read_racing_a_write(self):
+        get = self.fs.fs.get
+        self.fs.set('/a.jpg', 'image')
+
+        def read_before_write(path, **kwargs):
+            r = get(path, **kwargs)
+            self.fs.set(path, 'new')
+            return r
+        self.fs.fs.get = read_before_write
+        self.assertEqual(self.fs.get('/a.jpg'), 'image')
+        del self.fs.fs.get
+        self.assertEqual(self.fs.get('/a.jpg'), 'new')
+
+    def test_written_by_another_worker(self):
+        self.fs.set('/a.jpg', 'image')
+        self.assertEqual(self.fs.get('/a.jpg'), 'image')
+        # the file as stored, and the same write by a forked worker
+        self.node._set('/a.jpg', 'new')
+        run_in_child(lambda: self.fs.set('/a.jpg', 'new'))
+        self.assertEqual(self.fs.get('/a.jpg'), 'new')
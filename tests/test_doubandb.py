@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_doubandb.py
+"""
+
+import time
+import unittest
+from mock import patch
+
+from douban.beansdb import CacheWrapper, ReadFailedError, WriteFailedError, \
+    DeleteFailedError
+from douban.beansdb.doubandb import DoubanDB
+from douban.mc.debug import LocalMemcache
+
+from fake_beansdb import FakeBeansdbStore
+
+
+class LocalDoubanDB(DoubanDB):
+    store_cls = FakeBeansdbStore
+
+
+class SmallPoolDoubanDB(LocalDoubanDB):
+    write_threads = 1
+    write_queue = 1
+
+
+class DoubanDBTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        servers = dict(('s%d' % i, range(16)) for i in range(3))
+        self.db = LocalDoubanDB(servers, N=3, W=2, R=2)
+        self.nodes = FakeBeansdbStore.nodes
+
+    def test_set_and_get(self):
+        self.assertTrue(self.db.set('k', 'v'))
+        self.assertEqual(self.db.get('k'), 'v')
+        self.assertEqual(self.db.get('missing', 'd'), 'd')
+        for node in self.nodes.values():
+            self.assertEqual(node.items['k'][1], 'v')
+
+    def test_get_returns_newest_revision(self):
+        self.db.set('k', 'v1')
+        self.db.set('k', 'v2')
+        stale = self.db._get_servers('k')[0]
+        stale.mc.items['k'] = [1, 'v1', 0]
+        self.db.R = 3
+        self.assertEqual(self.db.get('k'), 'v2')
+        self.assertEqual(self.db.get_multi(['k']), {'k': 'v2'})
+
+    def test_deleted_is_newer_than_stale_value(self):
+        self.db.set('k', 'v')
+        self.db.R = 3
+        self.assertTrue(self.db.delete('k'))
+        self.db._get_servers('k')[0].mc.items['k'] = [1, 'v', 0]
+        self.assertEqual(self.db.get('k'), None)
+
+    def test_write_quorum(self):
+        ss = self.db._get_servers('k')
+        ss[0].mc.down = True
+        self.assertTrue(self.db.set('k', 'v'))
+        ss[1].mc.down = True
+        self.assertRaises(WriteFailedError, self.db.set, 'k', 'v')
+        self.assertRaises(ReadFailedError, self.db.get, 'k')
+
+    def test_set_does_not_wait_for_slow_replica(self):
+        self.db._get_servers('k')[0].mc.delay = 0.5
+        t = time.time()
+        self.db.set('k', 'v')
+        self.assertTrue(time.time() - t < 0.4)
+
+    def test_read_in_one_request(self):
+        self.db.set('k', 'v')
+        with patch.object(FakeBeansdbStore, 'get_multi', autospec=True,
+                          side_effect=FakeBeansdbStore.get_multi) as get_multi:
+            with patch.object(FakeBeansdbStore, 'get_version') as get_version:
+                self.db.R = 3
+                self.assertEqual(self.db.get('k'), 'v')
+        self.assertEqual(get_multi.call_count, 3)
+        self.assertFalse(get_version.called)
+
+    def test_slow_replica_sheds_writes(self):
+        servers = dict(('s%d' % i, range(16)) for i in range(3))
+        db = SmallPoolDoubanDB(servers, N=3, W=2, R=1)
+        slow = db._get_servers('k')[0]
+        slow.mc.delay = 0.3
+        t = time.time()
+        for i in range(5):
+            self.assertTrue(db.set('k', 'v%d' % i))
+        self.assertTrue(time.time() - t < 0.25)
+        self.assertTrue(db.shed_writes >= 3)
+        self.assertEqual(db.get('k'), 'v4')
+
+    def test_failed_replica_writes_are_counted(self):
+        self.db._get_servers('k')[0].mc.down = True
+        self.assertTrue(self.db.set('k', 'v'))
+        for i in range(50):
+            if self.db.write_failures:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.db.write_failures, 1)
+
+    def test_multi(self):
+        values = dict(('k%d' % i, 'v%d' % i) for i in range(50))
+        self.assertTrue(self.db.set_multi(values))
+        self.assertEqual(self.db.get_multi(values.keys() + ['x']),
+                         dict(values, x=None))
+
+    def test_set_multi_quorum(self):
+        for node in self.nodes.values()[:2]:
+            node.down = True
+        self.assertRaises(WriteFailedError, self.db.set_multi, {'k': 'v'})
+
+    def test_set_multi_deletes_in_one_call_per_replica(self):
+        values = dict(('k%d' % i, 'v%d' % i) for i in range(50))
+        self.db.set_multi(values)
+        with patch.object(FakeBeansdbStore, 'delete') as delete:
+            self.assertTrue(self.db.set_multi(dict.fromkeys(values)))
+        self.assertFalse(delete.called)
+        self.assertEqual(self.db.get_multi(values.keys()),
+                         dict.fromkeys(values))
+
+    def test_delete_multi_quorum(self):
+        self.db.set_multi({'k': 'v'})
+        for node in self.nodes.values()[:2]:
+            node.down = True
+        self.assertRaises(DeleteFailedError, self.db.delete_multi, ['k'])
+
+    def test_cache_wrapper(self):
+        db = CacheWrapper(self.db, LocalMemcache())
+        db.set('k', 'v')
+        self.assertTrue(db.exists('k'))
+        self.assertEqual(db.get('k'), 'v')
+
+
+if __name__ == '__main__':
+    unittest.main()
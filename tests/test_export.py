@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_export.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from douban.beansdb import BeansdbClient
+from douban.beansdb.export import Exporter, SnapshotReader, sort_index
+
+from fake_beansdb import FakeBeansdbStore
+
+
+class LocalBeansdbClient(BeansdbClient):
+    store_cls = FakeBeansdbStore
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.db = LocalBeansdbClient(['a', 'b'], buckets_count=16)
+        self.values = dict(('export:%d' % i, 'value:%d' % i)
+                           for i in range(300))
+        self.values['dict'] = {'ids': [1, 2, 3]}
+        self.values['int'] = 42
+        self.db.set_multi(self.values)
+        self.db.set('deleted', 'x')
+        self.db.delete('deleted')
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_version_read_with_value(self):
+        exporter = Exporter(self.db, self.path, parallel=1)
+        fetch = exporter._fetch
+
+        def written_after_listing(s, keys):
+            if 'export:1' in keys:
+                self.db.set('export:1', 'newer')
+            return fetch(s, keys)
+        exporter._fetch = written_after_listing
+        exporter.run()
+        self.values['export:1'] = 'newer'
+        r = SnapshotReader(self.path)
+        vers = dict((k, ver) for k, ver, v in r)
+        r.close()
+        self.assertEqual(vers['export:1'], 2)
+        self.check_snapshot()
+
+    def test_missing_keys_counted(self):
+        exporter = Exporter(self.db, self.path, parallel=1)
+        fetch = exporter._fetch
+
+        def lose_one(s, keys):
+            return fetch(s, keys)[1:]
+        exporter._fetch = lose_one
+        stats = exporter.run()
+        self.assertTrue(stats['missing'] > 0)
+        self.assertEqual(stats['keys'] + stats['missing'], len(self.values))
+
+    def test_sorted_index(self):
+        Exporter(self.db, self.path).run()
+        sort_index(self.path, chunk=7)
+        self.check_snapshot()
+        os.remove(self.path + '.idx.sorted')
+        self.assertRaises(ValueError, SnapshotReader, self.path)
+
+    def check_snapshot(self):
+        r = SnapshotReader(self.path)
+        self.assertEqual(len(r), len(self.values))
+        for k, v in self.values.items():
+            self.assertEqual(r.get(k), v)
+        self.assertEqual(r.get('deleted'), None)
+        self.assertEqual(dict((k, v) for k, ver, v in r), self.values)
+        r.close()
+
+    def test_export(self):
+        for codec in ('none', 'zlib'):
+            stats = Exporter(self.db, self.path + codec, parallel=3,
+                             codec=codec).run()
+            self.assertEqual(stats['keys'], len(self.values))
+            self.assertEqual(stats['buckets'], 16)
+        self.path += 'zlib'
+        self.check_snapshot()
+
+    def test_read_from_one_replica(self):
+        FakeBeansdbStore.nodes['a'].down = True
+        Exporter(self.db, self.path).run()
+        self.check_snapshot()
+
+    def test_resume(self):
+        Exporter(self.db, self.path, batch_size=7).run(range(8))
+        # garbage after the checkpoint is dropped when resuming
+        with open(self.path, 'ab') as f:
+            f.write('garbage')
+        stats = Exporter(self.db, self.path).run()
+        self.assertEqual(stats['buckets'], 8)
+        self.check_snapshot()
+        self.assertEqual(Exporter(self.db, self.path).run()['keys'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
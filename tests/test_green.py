@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_green.py
+"""
+
+import time
+import threading
+import unittest
+import SocketServer
+
+from douban.beansdb import BeansDBProxy, BeansdbClient, CacheWrapper
+from douban.beansdb.doubanfs import DoubanFS
+from douban.beansdb.green import PooledMC, cooperative, ERR_BAD_KEY
+from douban.mc.debug import LocalMemcache
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.server.active += 1
+        try:
+            self.serve()
+        finally:
+            self.server.active -= 1
+
+    def serve(self):
+        items = self.server.items
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            self.server.requests += 1
+            parts = line.split()
+            cmd, args = parts[0], parts[1:]
+            if cmd == 'get':
+                for k in args:
+                    if k in items:
+                        flag, data = items[k]
+                        self.wfile.write('VALUE %s %d %d\r\n%s\r\n'
+                                         % (k, flag, len(data), data))
+                self.wfile.write('END\r\n')
+            elif cmd == 'set':
+                k, flag, rev, n = args
+                data = self.rfile.read(int(n) + 2)[:-2]
+                items[k] = (int(flag), data)
+                self.wfile.write('STORED\r\n')
+            elif cmd == 'delete':
+                self.wfile.write('DELETED\r\n' if items.pop(args[0], None)
+                                 else 'NOT_FOUND\r\n')
+            elif cmd == 'incr':
+                if args[0] in items:
+                    flag, data = items[args[0]]
+                    items[args[0]] = (flag, str(int(data) + int(args[1])))
+                    self.wfile.write(items[args[0]][1] + '\r\n')
+                else:
+                    self.wfile.write('NOT_FOUND\r\n')
+            else:
+                self.wfile.write('ERROR\r\n')
+
+
+class MemcachedServer(SocketServer.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 MemcachedHandler)
+        self.items = {}
+        self.requests = 0
+        self.active = 0
+        self.addr = '127.0.0.1:%d' % self.server_address[1]
+        t = threading.Thread(target=self.serve_forever, args=(0.05,))
+        t.setDaemon(True)
+        t.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for i in range(100):
+            if not self.active:
+                break
+            time.sleep(0.01)
+
+
+class PooledMCTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MemcachedServer()
+        self.mc = PooledMC(self.server.addr, pool_size=2)
+
+    def tearDown(self):
+        self.mc.close()
+        self.server.stop()
+
+    def test_requests(self):
+        mc = self.mc
+        self.assert_(mc.set('a', 'value'))
+        self.assert_(mc.set('b', {'id': 1}))
+        self.assert_(mc.set('n', 1))
+        self.assertEqual(mc.get('a'), 'value')
+        self.assertEqual(mc.get_raw('a'), ('value', 0))
+        self.assertEqual(mc.get_multi(['a', 'b', 'c']),
+                         {'a': 'value', 'b': {'id': 1}})
+        self.assertEqual(mc.incr('n', 2), 3)
+        self.assertEqual(mc.incr('m', 2), None)
+        self.assert_(mc.delete('a'))
+        self.assertFalse(mc.delete('a'))
+        self.assertEqual(mc.get('a'), None)
+        self.assertEqual(mc.get_last_error(), 0)
+
+    def test_pipelined_multi(self):
+        values = dict(('k%d' % i, 'v%d' % i) for i in range(50))
+        self.assert_(self.mc.set_multi(values))
+        self.assertEqual(self.mc.get_multi(values.keys()), values)
+        self.assertEqual(self.mc.delete_multi(['k1', 'k2', 'x'],
+                                              return_failure=True),
+                         (False, ['x']))
+
+    def test_errors(self):
+        self.assertEqual(self.mc.get('bad key'), None)
+        self.assertEqual(self.mc.get_last_error(), ERR_BAD_KEY)
+        mc = PooledMC('127.0.0.1:1', connect_timeout=0.1)  # refused
+        self.assertEqual(mc.get('a'), None)
+        self.assertNotEqual(mc.get_last_error(), 0)
+        self.assertEqual(mc.set_multi({'a': '1'}, return_failure=True),
+                         (False, ['a']))
+
+    def test_interrupted_request_drops_connection(self):
+        self.mc.set('a', 'value')
+
+        class Timeout(BaseException):
+            pass
+
+        def interrupted(conn):
+            conn.send('get a\r\n')
+            conn.readline()
+            raise Timeout()
+        self.assertRaises(Timeout, self.mc._request, ['a'], interrupted)
+        conns = [self.mc._pool.get_nowait() for i in range(2)]
+        self.assertEqual(conns, [None, None])
+        for conn in conns:
+            self.mc._pool.put(conn)
+        # the unread value is not taken for the reply of the next request
+        self.assert_(self.mc.set('b', 'other'))
+        self.assertEqual(self.mc.get('b'), 'other')
+        self.assertEqual(self.mc.get('a'), 'value')
+
+    def test_shared_by_threads(self):
+        errors = []
+
+        def work(i):
+            for j in range(20):
+                k = 'k%d:%d' % (i, j)
+                if not self.mc.set(k, k) or self.mc.get(k) != k:
+                    errors.append(k)
+        ts = [threading.Thread(target=work, args=(i,)) for i in range(10)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertEqual(errors, [])
+
+
+class CooperativeClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [MemcachedServer() for i in range(2)]
+        self.addrs = [s.addr for s in self.servers]
+
+    def close(self, client):
+        for s in client.servers:
+            s.mc.close()
+
+    def tearDown(self):
+        for s in self.servers:
+            s.stop()
+
+    def test_proxy(self):
+        db = cooperative(BeansDBProxy)(self.addrs, pool_size=2)
+        self.assertFalse(db.servers[0].threaded)
+        self.assert_(db.set('a', 'value'))
+        self.assertEqual(db.get('a'), 'value')
+        self.assertEqual(db.get_multi(['a', 'b'])['a'], 'value')
+        self.assert_(db.delete('a'))
+        self.assertEqual(db.get('a', timeout=1), None)
+        cached = CacheWrapper(db, LocalMemcache())
+        cached.set('b', [1, 2])
+        self.assertEqual(cached.get('b'), [1, 2])
+        self.close(db)
+
+    def test_store_classes(self):
+        fs = cooperative(DoubanFS)(self.addrs)
+        self.assertEqual(fs.servers[0].mc.timeout, 5)
+        self.assert_(fs.set('/a.jpg', 'image'))
+        self.assert_(fs.rename('/a.jpg', '/b.jpg'))
+        self.assertEqual(fs.get('/b.jpg'), 'image')
+        client = cooperative(BeansdbClient)(self.addrs, buckets_count=16)
+        self.assertEqual(client.servers[0].mc.timeout, 3)
+        self.close(fs)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_limit.py
+"""
+
+import time
+import threading
+import unittest
+
+from douban.beansdb import BeansdbClient, BeansDBProxy, OverloadedError, \
+    ReadFailedError, WriteFailedError
+from douban.beansdb.limit import AIMDLimit, RetryBudget
+
+from fake_beansdb import FakeBeansdbStore
+
+
+class LocalBeansdbClient(BeansdbClient):
+    store_cls = FakeBeansdbStore
+
+
+class LocalBeansDBProxy(BeansDBProxy):
+    store_cls = FakeBeansdbStore
+
+
+class AIMDLimitTest(unittest.TestCase):
+
+    def test_reject_over_limit(self):
+        l = AIMDLimit(initial=2, max_wait=0)
+        self.assert_(l.acquire())
+        self.assert_(l.acquire())
+        self.assertFalse(l.acquire())
+        self.assertEqual(l.rejected, 1)
+        l.release(0.001)
+        self.assert_(l.acquire())
+
+    def test_wait_for_a_slot(self):
+        l = AIMDLimit(initial=1, max_wait=1)
+        l.acquire()
+        threading.Timer(0.05, l.release, (0.001,)).start()
+        t = time.time()
+        self.assert_(l.acquire())
+        self.assert_(time.time() - t < 0.5)
+
+    def test_too_many_waiting(self):
+        l = AIMDLimit(initial=1, max_wait=1, max_waiting=0)
+        l.acquire()
+        t = time.time()
+        self.assertFalse(l.acquire())
+        self.assert_(time.time() - t < 0.5)
+
+    def test_increase_and_decrease(self):
+        l = AIMDLimit(initial=4, max_limit=5, target_latency=0.1,
+                      backoff_interval=0)
+        for i in range(100):
+            for j in range(4):
+                l.acquire()
+            for j in range(4):
+                l.release(0.01)
+        self.assertEqual(l.limit, 5)
+        l.acquire()
+        l.release(1)
+        self.assertEqual(l.limit, 4.5)
+        for i in range(100):
+            l.acquire()
+            l.release(0.01, ok=False)
+        self.assertEqual(l.limit, 1)
+
+    def test_latency_target_of_multi_requests(self):
+        l = AIMDLimit(initial=4, target_latency=0.05, per_key_latency=0.001)
+        l.acquire()
+        l.release(0.1, size=100)
+        self.assertEqual(l.limit, 4)
+        l.acquire()
+        l.release(0.1, size=10)
+        self.assertEqual(l.limit, 3.6)
+
+    def test_one_backoff_per_interval(self):
+        l = AIMDLimit(initial=10, backoff_interval=60)
+        for i in range(10):
+            l.acquire()
+        for i in range(10):
+            l.release(1)
+        self.assertEqual(l.limit, 9)
+
+    def test_defaults_keep_slow_requests(self):
+        l = AIMDLimit()
+        for i in range(100):
+            l.acquire()
+            l.release(0.2)
+        self.assertEqual(l.limit, 20)
+
+    def test_no_increase_when_idle(self):
+        l = AIMDLimit(initial=10)
+        for i in range(100):
+            l.acquire()
+            l.release(0.001)
+        self.assertEqual(l.limit, 10)
+
+
+class OverloadTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        limit = lambda: AIMDLimit(initial=1, max_wait=0)
+        self.db = LocalBeansdbClient(['a', 'b'], buckets_count=16,
+                                     limit=limit)
+        self.proxy = LocalBeansDBProxy(['a', 'b'], limit=limit)
+
+    def overload(self, addr):
+        for s in self.db.servers + self.proxy.servers:
+            if s.addr == addr:
+                s.limit.acquire()
+
+    def test_store(self):
+        self.overload('a')
+        s = self.db.servers[0]
+        self.assertRaises(OverloadedError, s.get, 'k')
+        self.assertRaises(OverloadedError, s.get_multi, ['k'])
+        self.assertEqual(s.set('k', 'v'), False)
+        self.assertEqual(s.set_multi({'k': 'v'}, return_failure=True),
+                         (False, ['k']))
+        self.assertEqual(s.delete('k'), False)
+        self.assertEqual(s.limit.rejected, 5)
+
+    def test_failed_writes_back_off(self):
+        s = FakeBeansdbStore('w', limit=lambda: AIMDLimit(
+            initial=10, backoff_interval=0))
+        self.assertFalse(s.delete('missing'))
+        self.assertEqual(s.limit.limit, 10)
+        s.mc.down = True
+        self.assertFalse(s.set('k', 'v'))
+        self.assertEqual(s.limit.limit, 9)
+        self.assertEqual(s.set_multi({'k': 'v'}, return_failure=True),
+                         (False, ['k']))
+        self.assertEqual(s.limit.limit, 9 * 0.9)
+
+    def test_client_reads_other_replica(self):
+        self.db.set('k', 'v')
+        self.overload('a')
+        self.assertEqual(self.db.get('k'), 'v')
+        self.assertEqual(self.db.get_multi(['k']), {'k': 'v'})
+        self.assert_(self.db.exists('k'))
+        self.overload('b')
+        self.assertRaises(ReadFailedError, self.db.get, 'k')
+
+    def test_client_write_fails_without_quorum(self):
+        self.overload('a')
+        self.assertRaises(WriteFailedError, self.db.set, 'k', 'v')
+
+    def test_rejection_leaves_proxy_healthy(self):
+        proxy = LocalBeansDBProxy(['a', 'b'], retry_budget=RetryBudget(
+            0.1, max_tokens=0), limit=lambda: AIMDLimit(initial=1,
+                                                        max_wait=0))
+        for s in proxy.servers:
+            s.set('k', 'v')
+        busy = proxy.servers[0]
+        busy.limit.acquire()
+        # the error of an earlier request
+        busy.mc.last_error = 1
+        self.assertEqual(proxy.get('k'), 'v')
+        self.assertEqual(proxy.get_multi(['k']), {'k': 'v'})
+        proxy.servers = [busy] + [s for s in proxy.servers if s is not busy]
+        self.assert_(proxy.set('k', 'v2'))
+        proxy.servers = [busy] + [s for s in proxy.servers if s is not busy]
+        self.assert_(proxy.delete('k'))
+        self.assertEqual(proxy._failures, {})
+        self.assertEqual(proxy.retry_budget.retries, 0)
+        self.assertEqual(busy.limit.limit, 1)
+
+    def test_proxy_diverts(self):
+        self.db.set('k', 'v')
+        self.overload(self.proxy.servers[0].addr)
+        self.assertEqual(self.proxy.get('k'), 'v')
+        self.assert_(self.proxy.set('k', 'v2'))
+        self.assertEqual(self.proxy.get('k'), 'v2')
+
+
+class RetryBudgetTest(unittest.TestCase):
+
+    def test_budget(self):
+        b = RetryBudget(ratio=0.1, max_tokens=2)
+        self.assert_(b.withdraw())
+        self.assert_(b.withdraw())
+        self.assertFalse(b.withdraw())
+        for i in range(10):
+            b.deposit()
+        self.assert_(b.withdraw())
+        self.assertFalse(b.withdraw())
+        self.assertEqual((b.requests, b.retries, b.exhausted), (10, 3, 2))
+
+    def test_proxy_retries_within_budget(self):
+        FakeBeansdbStore.reset()
+        db = LocalBeansDBProxy(['p1', 'p2', 'p3'],
+                               retry_budget=RetryBudget(0.1, max_tokens=2))
+        for node in FakeBeansdbStore.nodes.values():
+            node.down = True
+        self.assertRaises(ReadFailedError, db.get, 'k')
+        self.assertEqual(db.retry_budget.retries, 2)
+        self.assertRaises(ReadFailedError, db.get, 'k')
+        self.assertEqual(db.retry_budget.retries, 2)
+        self.assertEqual(db.retry_budget.exhausted, 1)
+        # every proxy is tried once per 100 calls in average
+        for i in range(100):
+            self.assertRaises(WriteFailedError, db.set, 'k', 'v')
+        self.assertEqual(db.retry_budget.retries, 12)
+
+    def test_failed_proxy_backs_off(self):
+        FakeBeansdbStore.reset()
+        db = LocalBeansDBProxy(['p1', 'p2'])
+        bad, good = db.servers
+        bad.mc.down = True
+        self.assert_(db.set('k', 'v'))
+        self.assertEqual(db.servers, [good, bad])
+        # tried last, even when it is the first one again
+        db.servers = [bad, good]
+        bad.mc.down = False
+        good.set('k', 'v2')
+        self.assertEqual(db.get('k'), 'v2')
+        self.assertEqual(db.retry_budget.retries, 1)
+        db._failures[bad] = (1, 0)
+        db.servers = [bad, good]
+        bad.set('k', 'v3')
+        self.assertEqual(db.get('k'), 'v3')
+        self.assertEqual(db._failures, {})
+
+    def test_missing_key_does_not_back_off(self):
+        FakeBeansdbStore.reset()
+        db = LocalBeansDBProxy(['p1', 'p2'])
+        servers = list(db.servers)
+        self.assertFalse(db.delete('missing'))
+        db.delete_multi(['missing', 'other'])
+        self.assertEqual(db._failures, {})
+        self.assertEqual(db.servers, servers)
+
+    def test_concurrent_deposits(self):
+        budget = RetryBudget(ratio=1, max_tokens=100000)
+        budget.tokens = 0
+
+        def deposit():
+            for i in range(1000):
+                budget.deposit()
+        ts = [threading.Thread(target=deposit) for i in range(8)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertEqual(budget.requests, 8000)
+        self.assertEqual(budget.tokens, 8000)
+
+    def test_backoff_grows(self):
+        FakeBeansdbStore.reset()
+        db = LocalBeansDBProxy(['p1'])
+        s = db.servers[0]
+        s.mc.down = True
+        ends = []
+        for i in range(8):
+            t = time.time()
+            self.assertRaises(ReadFailedError, db.get, 'k')
+            ends.append(db._failures[s][1] - t)
+        self.assertEqual(db._failures[s][0], 8)
+        self.assert_(0.25 <= ends[0] <= 0.75)
+        self.assert_(15 <= ends[-1] <= 45)
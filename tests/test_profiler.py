@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_profiler.py
+"""
+
+import unittest
+import threading
+from mock import patch
+
+from douban.beansdb import CacheWrapper
+from douban.beansdb.profiler import SizeProfiler, key_prefix, value_size, \
+    OTHER
+from douban.mc.debug import LocalMemcache
+
+from test_beansdb import LocalMCStore, LocalBeansDBProxy
+
+
+class SizeProfilerTest(unittest.TestCase):
+
+    def test_key_prefix(self):
+        self.assertEqual(key_prefix('user:1'), 'user')
+        self.assertEqual(key_prefix('/photo/a.jpg'), '/photo')
+        self.assertEqual(key_prefix('plain'), 'plain')
+
+    def test_sizes(self):
+        p = SizeProfiler(dump_interval=None)
+        for i in range(99):
+            p.record('get', 'user:%d' % i, 'x' * 100)
+        p.record('set', 'user:x', 'x' * 5000)
+        p.record('get', 'user:y', None)
+        s = p.report()['prefixes']['user']
+        self.assertEqual(s['ops'], {'get': 100, 'set': 1})
+        self.assertEqual(s['misses'], 1)
+        self.assertEqual(s['values'], 100)
+        self.assertEqual(s['bytes'], 99 * 100 + 5000)
+        self.assertEqual(s['max'], 5000)
+        self.assertEqual(s['p50'], 127)
+        self.assertEqual(s['p99'], 127)
+        self.assertEqual(s['hist'], {127: 99, 8191: 1})
+
+    def test_bounded_prefixes(self):
+        p = SizeProfiler(max_prefixes=3, dump_interval=None)
+        for i in range(10):
+            p.record('get', 'p%d:1' % i, 'v')
+        prefixes = p.report()['prefixes']
+        self.assertEqual(sorted(prefixes), ['*', 'p0', 'p1', 'p2'])
+        self.assertEqual(prefixes[OTHER]['values'], 7)
+
+    def test_large_keys(self):
+        p = SizeProfiler(threshold=1000, max_large=2, dump_interval=None)
+        p.record('set', 'a', 'x' * 1000)
+        p.record('get', 'small', 'x' * 10)
+        for i in range(3):
+            p.record('get', 'b', 'x' * 2000)
+        p.record('set', 'c', 'x' * 3000)
+        large = p.report()['large']
+        self.assertEqual([(k, size, n) for k, size, n, rate in large],
+                         [('b', 2000, 3), ('c', 3000, 1)])
+        self.assert_(large[0][3] > large[1][3])
+
+    def test_smallest_large_key_dropped(self):
+        p = SizeProfiler(threshold=1000, max_large=2, dump_interval=None)
+        p.record('get', 'a', 'x' * 1000)
+        for i in range(10):
+            p.record('get', 'b', 'x' * 2000)
+        p.record('get', 'c', 'x' * 1500)
+        p.record('get', 'd', 'x' * 1200)
+        p.record('get', 'b', 'x' * 1100)
+        p.record('get', 'e', 'x' * 1300)
+        large = p.report()['large']
+        self.assertEqual(sorted((k, size) for k, size, n, rate in large),
+                         [('c', 1500), ('e', 1300)])
+
+    def test_meta_keys_skipped(self):
+        p = SizeProfiler(dump_interval=None)
+        p.record('get', '@0a', '0/ 1 2\n')
+        p.record('get_multi', '?user:1', '1 2 0 5 0 0 0')
+        self.assertEqual(p.report()['prefixes'], {})
+
+    def test_sampled_sizes(self):
+        p = SizeProfiler(dump_interval=None, sample=4)
+        with patch('douban.beansdb.profiler.value_size',
+                   side_effect=value_size) as size:
+            for i in range(8):
+                p.record('get', 'user:%d' % i, {'id': i})
+            p.record('get', 'user:s', 'x' * 10)
+        self.assertEqual(size.call_count, 3 + 1)
+        s = p.report()['prefixes']['user']
+        self.assertEqual(s['values'], 9)
+        self.assertEqual(s['bytes'], 8 * value_size({'id': 0}) + 10)
+
+    def test_concurrent_records(self):
+        p = SizeProfiler(threshold=10, max_large=5, dump_interval=None,
+                         sample=4)
+
+        def record(t):
+            for i in range(200):
+                p.record('get', 'user:%d:%d' % (t, i % 20), {'id': i})
+                p.record('set', 'big:%d:%d' % (t, i % 20), 'x' * (10 + i))
+        ts = [threading.Thread(target=record, args=(t,)) for t in range(8)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertEqual(p._unsized, 8 * 200)
+        r = p.report()
+        self.assertEqual(r['prefixes']['user']['values'], 8 * 200)
+        self.assertEqual(len(r['large']), 5)
+
+    def test_dump(self):
+        p = SizeProfiler(threshold=10, dump_interval=0)
+        with patch('douban.beansdb.profiler.log') as log:
+            p.record('get', 'user:1', 'x' * 100)
+        lines = [c[0][0] for c in log.call_args_list]
+        self.assert_(lines[1].startswith('user get=1: 100 bytes'))
+        self.assert_(lines[2].startswith("large 'user:1': 100 bytes"))
+
+
+class ProfiledClientTest(unittest.TestCase):
+
+    def test_mcstore(self):
+        s = LocalMCStore(threaded=False)
+        s.profiler = SizeProfiler(dump_interval=None)
+        s.set('user:1', 'value')
+        s.get('user:1')
+        s.get_multi(['user:1', 'user:2'])
+        s.get_multi(['?user:1'])
+        s.delete('user:1')
+        self.assertEqual(sorted(s.profiler.report()['prefixes']), ['user'])
+        r = s.profiler.report()['prefixes']['user']
+        self.assertEqual(r['ops'], {'set': 1, 'get': 1, 'get_multi': 2,
+                                    'delete': 1})
+        self.assertEqual(r['misses'], 1)
+        self.assertEqual(r['bytes'], 15)
+
+    def test_cache_wrapper(self):
+        p = SizeProfiler(dump_interval=None)
+        db = CacheWrapper(LocalBeansDBProxy(), LocalMemcache(), profiler=p)
+        db.set('user:1', 'value')
+        db.get('user:1')
+        db.get_multi(['user:1', 'user:2'])
+        db.set('user:1', None)
+        r = p.report()['prefixes']['user']
+        self.assertEqual(r['ops'], {'set': 1, 'get': 1, 'get_multi': 2,
+                                    'delete': 1})
+        self.assertEqual(r['bytes'], 15)
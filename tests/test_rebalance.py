@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_rebalance.py
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from douban.beansdb import BeansdbClient, fnv1a
+from douban.beansdb.limit import RateLimit
+from douban.beansdb.rebalance import Rebalancer, plan
+
+from fake_beansdb import FakeBeansdbStore
+from test_beansdb_client import keys_with_prefix
+
+
+class LocalBeansdbClient(BeansdbClient):
+    store_cls = FakeBeansdbStore
+
+
+class RebalanceTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        old = LocalBeansdbClient(['a', 'b'], buckets_count=16)
+        self.values = dict((k, 'value:' + k) for i in range(16)
+                           for k in keys_with_prefix('%x' % i, 10))
+        old.set_multi(self.values)
+        old.set('deleted', 'x')
+        old.delete('deleted')
+        self.db = LocalBeansdbClient(['a', 'b', 'c'], buckets_count=16)
+        self.db.N = 2
+        self.nodes = FakeBeansdbStore.nodes
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'rebalance.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_copied(self, moves):
+        buckets = set(b for b, _, _ in moves)
+        c = dict((k, it) for k, it in self.nodes['c'].items.items()
+                 if it[0] > 0)
+        expected = [k for k in self.values if fnv1a(k) >> 28 in buckets]
+        self.assertEqual(sorted(c), sorted(expected))
+        for k in expected:
+            self.assertEqual(c[k], self.nodes['a'].items[k])
+
+    def test_plan(self):
+        moves = plan(self.db)
+        self.assertEqual(len(moves), 10)
+        self.assertEqual(set(t for _, _, t in moves), set(['c']))
+        self.assertEqual(len(set(b for b, _, _ in moves)), 10)
+
+    def test_rebalance(self):
+        moves = plan(self.db)
+        stats = Rebalancer(self.db, moves, self.path, parallel=3).run()
+        self.assertEqual(stats['moves'], 10)
+        self.assertEqual(stats['failed'], 0)
+        self.check_copied(moves)
+
+    def test_raw_copy(self):
+        moves = plan(self.db)[:1]
+        b, source, target = moves[0]
+        key = keys_with_prefix('%x' % b, 1)[0]
+        self.nodes[source].items[key][2] = 4
+        Rebalancer(self.db, moves, self.path).run()
+        self.assertEqual(self.nodes['c'].items[key],
+                         self.nodes[source].items[key])
+
+    def test_keys_copied_together(self):
+        moves = plan(self.db)[:1]
+        target = [s for s in self.db.servers if s.addr == 'c'][0]
+        set_raw = target.set_raw
+        running = [0, 0]
+        lock = threading.Lock()
+
+        def slow_set_raw(*args):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return set_raw(*args)
+        target.set_raw = slow_set_raw
+        stats = Rebalancer(self.db, moves, self.path, width=4).run()
+        self.assertEqual(stats['moves'], 1)
+        self.assertEqual(running[1], 4)
+        self.check_copied(moves)
+
+    def test_revision_of_a_deletion(self):
+        s = self.db.servers[0]
+        self.assertRaises(ValueError, s.set_raw, 'k', 'v', -2, 0)
+        self.assertRaises(ValueError, s.delete_at, 'k', 2)
+        self.assert_(s.delete_at('k', -2))
+        self.assertEqual(self.nodes['a'].items['k'][0], -2)
+
+    def test_catch_up(self):
+        moves = plan(self.db)[:1]
+        b, source, target = moves[0]
+        written, deleted = keys_with_prefix('%x' % b, 2)
+        r = Rebalancer(self.db, moves, self.path)
+        copy = r._copy
+
+        def written_during_copy(s, t, items):
+            copy(s, t, items)
+            if self.nodes['c'].items.get(deleted, [0])[0] > 0:
+                r._copy = copy
+                self.nodes[source].set(written, 'newer')
+                self.nodes[source].delete(deleted)
+        r._copy = written_during_copy
+        stats = r.run()
+        self.assert_(stats['caught_up'] >= 2)
+        for k in (written, deleted):
+            self.assertEqual(self.nodes['c'].items[k],
+                             self.nodes[source].items[k])
+        self.assertEqual(self.nodes['c'].items[deleted][1], None)
+
+    def test_resume(self):
+        moves = plan(self.db)
+        self.nodes['c'].down = True
+        stats = Rebalancer(self.db, moves, self.path).run()
+        self.assertEqual(stats['failed'], 10)
+        self.nodes['c'].down = False
+        # the moves are taken from the checkpoint
+        stats = Rebalancer(self.db, [], self.path).run()
+        self.assertEqual((stats['moves'], stats['failed']), (10, 0))
+        self.check_copied(moves)
+        stats = Rebalancer(self.db, [], self.path).run()
+        self.assertEqual(stats['keys'], 0)
+
+    def test_throttle(self):
+        l = RateLimit(100, burst=0)
+        t = time.time()
+        l.wait(10)
+        l.wait(10)
+        self.assert_(0.15 < time.time() - t < 0.5)
+        moves = plan(self.db)[:2]
+        t = time.time()
+        stats = Rebalancer(self.db, moves, self.path, max_ops=100).run()
+        self.assert_(time.time() - t > stats['keys'] / 100.0 - 1.1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_serializer.py
+"""
+
+import marshal
+import unittest
+from collections import OrderedDict
+
+from douban.beansdb.serializer import default_serializer, benchmark, \
+    FLAG_BOOL, FLAG_INTEGER, FLAG_LONG, FLAG_MARSHAL, FLAG_PICKLE, \
+    FLAG_COMPRESS
+
+from fake_beansdb import FakeBeansdbStore
+
+
+class SerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s = default_serializer()
+
+    def roundtrip(self, value, flag):
+        data, f = self.s.dumps(value)
+        self.assertEqual(f, flag)
+        r = self.s.loads(data, f)
+        self.assertEqual(r, value)
+        self.assertEqual(type(r), type(value))
+
+    def test_builtin_types(self):
+        self.roundtrip('abc', 0)
+        self.roundtrip(True, FLAG_BOOL)
+        self.roundtrip(42, FLAG_INTEGER)
+        self.roundtrip(1L << 70, FLAG_LONG)
+        self.roundtrip({'id': 1, 'tags': [u'a']}, FLAG_MARSHAL)
+        self.roundtrip(range(100), FLAG_MARSHAL)
+        self.roundtrip(OrderedDict(a=1), FLAG_PICKLE)
+        self.roundtrip({'d': OrderedDict(a=1)}, FLAG_PICKLE)
+
+    def test_compress(self):
+        s = default_serializer(compress_threshold=100)
+        value = range(1000)
+        data, flag = s.dumps(value)
+        self.assertEqual(flag, FLAG_MARSHAL | FLAG_COMPRESS)
+        self.assertEqual(s.loads(data, flag), value)
+        self.assertEqual(s.dumps('short'), ('short', 0))
+
+    def test_bad_data_raises_value_error(self):
+        self.assertRaises(ValueError, self.s.loads, 'xx', FLAG_PICKLE)
+        self.assertRaises(ValueError, self.s.loads, 'xx', FLAG_MARSHAL)
+        self.assertRaises(ValueError, self.s.loads, 'xx', 1 << 9)
+
+    def test_versioned_format(self):
+        v2 = 1 << 8
+        self.s.register(v2, lambda v: 'v2' + marshal.dumps(v),
+                        lambda d: marshal.loads(d[2:]), types=(dict,))
+        data, flag = self.s.dumps({'a': 1})
+        self.assertEqual(flag, v2)
+        self.assertEqual(self.s.loads(data, flag), {'a': 1})
+        old = marshal.dumps({'a': 1})
+        self.assertEqual(self.s.loads(old, FLAG_MARSHAL), {'a': 1})
+
+    def test_benchmark(self):
+        self.assertEqual(len(benchmark(10)), 3)
+
+
+class MCStoreSerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        self.store = FakeBeansdbStore('a', serializer=default_serializer())
+
+    def test_set_get(self):
+        self.assertTrue(self.store.set('k', {'ids': [1, 2]}))
+        self.assertEqual(self.store.mc.get_raw('k')[1], FLAG_MARSHAL)
+        self.assertEqual(self.store.get('k'), {'ids': [1, 2]})
+        self.assertEqual(self.store.get('missing'), None)
+
+    def test_bad_data_is_kept(self):
+        self.store.mc.set_raw('k', 'bad', 0, FLAG_PICKLE)
+        self.assertEqual(self.store.get('k'), None)
+        self.assertEqual(self.store.mc.get_raw('k'), ('bad', FLAG_PICKLE))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_shmcache.py
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+from douban.beansdb import CacheWrapper
+from douban.beansdb.shmcache import SharedMemoryCache, SharedCachedMC, WORD
+from douban.mc.debug import LocalMemcache
+
+from test_beansdb import LocalBeansDBProxy
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SharedMemoryCache(size=1 << 20, nstripes=4,
+                                       page_size=4096)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get_set_delete(self):
+        c = self.cache
+        self.assertEqual(c.get('a'), None)
+        self.assert_(c.set('a', 'value'))
+        self.assert_(c.set('b', {'id': 1}))
+        self.assertEqual(c.get('a'), 'value')
+        self.assertEqual(c.get_multi(['a', 'b', 'c']),
+                         {'a': 'value', 'b': {'id': 1}})
+        self.assert_(c.set('a', 'x' * 1000))
+        self.assertEqual(c.get('a'), 'x' * 1000)
+        c.delete('a')
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual((c.hits, c.misses), (4, 3))
+        c.clear()
+        self.assertEqual(c.get('b'), None)
+
+    def test_too_large(self):
+        self.assertFalse(self.cache.set('a', 'x' * 5000))
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_expire(self):
+        self.cache.set('a', 'value', time=1)
+        self.cache.set('b', 'value')
+        with patch('douban.beansdb.shmcache._now',
+                   return_value=time.time() + 2):
+            self.assertEqual(self.cache.get('a'), None)
+            self.assertEqual(self.cache.get('b'), 'value')
+
+    def test_eviction(self):
+        c = self.cache
+        keys = ['key%d' % i for i in range(3000)]
+        for k in keys:
+            c.set(k, 'x' * 500)
+        self.assert_(c.evictions > 0)
+        found = c.get_multi(keys)
+        self.assert_(0 < len(found) < len(keys))
+        self.assert_(all(v == 'x' * 500 for v in found.values()))
+        # the recent ones are kept
+        self.assert_(len([k for k in keys[-20:] if k in found]) >= 15)
+
+    def test_pages_follow_the_sizes(self):
+        c = SharedMemoryCache(size=1 << 18, nstripes=1, page_size=4096,
+                              avg_size=64)
+        n = 0
+        while c._heads(c._base(0))[1] < c.pages and n < 20000:
+            c.set('small%d' % n, 'x' * 30)
+            n += 1
+        self.assertEqual(c._heads(c._base(0))[1], c.pages)
+        for i in range(50):
+            self.assert_(c.set('large%d' % i, 'x' * 2000))
+        self.assertEqual(c.failed, 0)
+        self.assert_(c.reassigned > 0)
+        self.assertEqual(c.get('large49'), 'x' * 2000)
+        found = c.get_multi(['small%d' % i for i in range(n)])
+        self.assert_(found)
+        self.assert_(all(v == 'x' * 30 for v in found.values()))
+        c.close()
+
+    def test_dead_writer_repaired(self):
+        c = self.cache
+        c.set('a', 'value')
+        h, stripe, bucket = c._locate('a')
+        base = c._base(stripe)
+        # as left by a process killed while writing
+        WORD.pack_into(c.mm, base, WORD.unpack_from(c.mm, base)[0] + 1)
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(c.repaired, 1)
+        self.assertEqual(WORD.unpack_from(c.mm, base)[0] & 1, 0)
+        self.assert_(c.set('a', 'again'))
+        self.assertEqual(c.get('a'), 'again')
+        self.assertEqual(c.repaired, 1)
+
+    def test_shared_with_forked_process(self):
+        self.cache.set('a', 'parent')
+        pid = os.fork()
+        if not pid:
+            ok = False
+            try:
+                ok = self.cache.get('a') == 'parent' \
+                    and self.cache.set('b', 'child')
+                self.cache.delete('a')
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 'child')
+
+
+class SharedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_reopen(self):
+        path = os.path.join(self.dir, 'cache')
+        c = SharedMemoryCache(size=1 << 20, path=path)
+        c.set('a', 'value')
+        other = SharedMemoryCache(size=1 << 16, path=path)
+        self.assertEqual(other.buckets, c.buckets)
+        self.assertEqual(other.get('a'), 'value')
+        other.set('b', 'other')
+        self.assertEqual(c.get('b'), 'other')
+        c.close()
+        other.close()
+
+
+class SharedCachedMCTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SharedMemoryCache(size=1 << 20, nstripes=4)
+        self.mc = LocalMemcache()
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_read_through(self):
+        mc = SharedCachedMC(self.mc, self.cache)
+        self.mc.set('a', 'value')
+        self.assertEqual(mc.get('a'), 'value')
+        self.mc.delete('a')
+        self.assertEqual(mc.get('a'), 'value')
+        mc.delete('a')
+        self.assertEqual(mc.get('a'), None)
+
+    def test_cache_wrapper_writes_invalidate(self):
+        db = CacheWrapper(LocalBeansDBProxy(), self.mc,
+                          shared_cache=self.cache)
+        db.set('a', 'v1')
+        self.assertEqual(db.get('a'), 'v1')  # from db, into mc
+        self.assertEqual(db.get('a'), 'v1')  # from mc, into the cache
+        self.assertEqual(self.cache.get('a'), 'v1')
+        db.set('a', 'v2')
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(db.get('a'), 'v2')
+        self.assertEqual(db.get_multi(['a']), {'a': 'v2'})
+        db.delete('a')
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(db.get('a'), None)
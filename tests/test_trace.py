@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_trace.py
+"""
+
+import os
+import tempfile
+import unittest
+
+from douban.beansdb import BeansDBProxy, CacheWrapper, fnv1a
+from douban.beansdb.trace import TraceRecorder, TracedClient, read_trace, \
+    replay, Record, GET, GET_MULTI, SET, FLAG_ERROR
+from douban.mc.debug import LocalMemcache
+
+from fake_beansdb import FakeBeansdbStore
+
+
+class LocalBeansDBProxy(BeansDBProxy):
+    store_cls = FakeBeansdbStore
+
+
+class TraceTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBeansdbStore.reset()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.recorder = TraceRecorder(self.path, rate=1)
+        self.db = LocalBeansDBProxy(['p1'])
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def records(self):
+        self.recorder.flush()
+        return list(read_trace(self.path))
+
+    def test_record(self):
+        db = TracedClient(self.db, self.recorder)
+        self.assert_(db.set('a', 'value'))
+        self.assertEqual(db.get('a'), 'value')
+        self.assertEqual(db.get_multi(['a', 'b'])['a'], 'value')
+        rs = self.records()
+        self.assertEqual([(r.op, r.hash, r.size) for r in rs],
+                         [(SET, fnv1a('a'), 5), (GET, fnv1a('a'), 5),
+                          (GET_MULTI, fnv1a('a'), 5),
+                          (GET_MULTI, fnv1a('b'), 0)])
+        self.assertEqual(rs[2].timestamp, rs[3].timestamp)
+        self.assertEqual(rs[2].call, rs[3].call)
+        self.assertEqual(len(set(r.call for r in rs)), 3)
+        self.assertEqual(rs[0].call >> 32, os.getpid())
+        self.assert_(all(r.latency >= 0 for r in rs))
+
+    def test_error(self):
+        db = TracedClient(self.db, self.recorder)
+        FakeBeansdbStore.nodes['p1'].down = True
+        self.assertRaises(IOError, db.get, 'a')
+        self.assertEqual(self.records()[0].flags, FLAG_ERROR)
+
+    def test_sampling(self):
+        recorder = TraceRecorder(self.path, rate=0.1)
+        keys = ['key%d' % i for i in range(1000)]
+        sampled = [k for k in keys if recorder.sampled(k) is not None]
+        self.assert_(50 < len(sampled) < 150)
+        self.assertEqual(recorder.sampled(sampled[0]), fnv1a(sampled[0]))
+        recorder.close()
+
+    def test_cache_wrapper(self):
+        db = TracedClient(CacheWrapper(self.db, LocalMemcache()),
+                          self.recorder)
+        db.set('a', 'value')
+        db.get('a')
+        self.assertEqual(len(self.records()), 2)
+        self.assert_(db.mc)
+
+    def test_replay(self):
+        db = TracedClient(self.db, self.recorder)
+        db.set('a', 'value')
+        db.get_multi(['a', 'b', 'c'])
+        db.get('a')
+        target = LocalBeansDBProxy(['p2'])
+        stats = replay(self.records(), target, speed=0, concurrency=2,
+                       prefill=True)
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['errors'], 0)
+        self.assert_(stats['p50'] <= stats['p99'] <= stats['max'])
+        self.assertEqual(len(FakeBeansdbStore.nodes['p2'].items), 3)
+
+    def test_replay_records_of_several_processes(self):
+        # a late buffer of one process, and a multi call of each process
+        # at the same time
+        rs = [Record(GET_MULTI, 0, 1, 1, 10.0, 0, 1 << 32),
+              Record(GET_MULTI, 0, 2, 1, 10.0, 0, 2 << 32),
+              Record(GET, 0, 3, 1, 10.2, 0, 2 << 32 | 1),
+              Record(GET_MULTI, 0, 4, 1, 10.0, 0, 1 << 32),
+              Record(GET, 0, 5, 1, 10.1, 0, 1 << 32 | 1)]
+        calls = []
+
+        class Target(object):
+            def get(self, key):
+                calls.append([key])
+
+            def get_multi(self, keys):
+                calls.append(sorted(keys))
+        stats = replay(rs, Target(), speed=100, concurrency=1)
+        self.assertEqual(stats['calls'], 4)
+        self.assertEqual(calls, [['trace:00000001', 'trace:00000004'],
+                                 ['trace:00000002'], ['trace:00000005'],
+                                 ['trace:00000003']])
+        self.assert_(stats['elapsed'] < 0.1)